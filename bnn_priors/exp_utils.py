@@ -1,4 +1,9 @@
+import copy
 import math
+from collections.abc import Mapping
+import os
+import queue
+import threading
 import h5py
 import numpy as np
 import time
@@ -60,6 +65,20 @@ def get_data(data: str, device: t.device):
     return dataset
 
 
+def share_data_(dataset):
+    """Moves the CPU tensors of a data set from `get_data` to shared memory, in
+    place. Worker processes that receive it then map the same memory, instead
+    of each having its own copy. The `TensorDataset`s keep working, because
+    they hold the same tensors."""
+    for obj in [dataset, getattr(dataset, "norm", None), getattr(dataset, "unnorm", None)]:
+        if obj is None:
+            continue
+        for v in vars(obj).values():
+            if isinstance(v, t.Tensor) and v.device.type == "cpu":
+                v.share_memory_()
+    return dataset
+
+
 def he_initialize(model):
     for name, param in model.named_parameters():
         if "weight_prior.p" in name:
@@ -235,6 +254,8 @@ def get_model(x_train, y_train, model, width, depth, weight_prior, weight_loc,
 
 
 def _n_samples_dict(samples):
+    if isinstance(samples, (list, tuple)):
+        return sum(_n_samples_dict(s) for s in samples)
     n_samples = min(len(v) for _, v in samples.items())
 
     if not all((len(v) == n_samples) for _, v in samples.items()):
@@ -243,6 +264,19 @@ def _n_samples_dict(samples):
     return n_samples
 
 def sample_iter(samples):
+    """The state dict of each sample of `samples`: a dict of tensors or
+    columns with one row per sample, `LazySamples`, or a list of those (for
+    example one per chain) to go through one after the other."""
+    if isinstance(samples, (list, tuple)):
+        for s in samples:
+            yield from sample_iter(s)
+        return
+    if isinstance(samples, LazySamples):
+        # Read a few samples at a time, instead of one entry of one sample
+        for block in samples.blocks():
+            for i in range(_n_samples_dict(block)):
+                yield {k: v[i] for k, v in block.items()}
+        return
     for i in range(_n_samples_dict(samples)):
         yield dict((k, v[i]) for k, v in samples.items())
 
@@ -258,15 +292,21 @@ def evaluate_model(model: bnn_priors.models.AbstractModel,
     else:
         raise ValueError("I cannot find the labels in the dataloader.")
     N, *possibly_D = labels.shape
-    E = _n_samples_dict(samples)
 
     if len(possibly_D) == 0:
         n_classes_or_funs = labels.max().item() + 1
     else:
         n_classes_or_funs, = possibly_D
 
-    lps = t.zeros((E, N), dtype=t.float64, device='cpu')
-    acc_data = t.zeros((E, N, n_classes_or_funs), dtype=t.float64, device='cpu')
+    # Reduce over the samples as they come, so memory does not grow with their
+    # number. lps_lse: log-sum-exp of the log-likelihoods of the samples.
+    # acc_data_reduced: log-sum-exp of the class log-probabilities, or sum of
+    # the means. acc_data_last: the predictions of the last sample.
+    lps_lse = t.zeros((N,), dtype=t.float64, device='cpu')
+    acc_data_reduced = t.zeros((N, n_classes_or_funs), dtype=t.float64, device='cpu')
+    acc_data_last = t.zeros((N, n_classes_or_funs), dtype=t.float64, device='cpu')
+    # Sum of the log-likelihoods of each sample
+    lps_totals = []
 
     device = next(iter(model.parameters())).device
 
@@ -274,6 +314,7 @@ def evaluate_model(model: bnn_priors.models.AbstractModel,
         with t.no_grad():
             model.load_state_dict(sample)
             i = 0
+            lps_total = t.zeros((), dtype=t.float64)
             for batch_x, batch_y in dataloader_test:
                 batch_x = batch_x.to(device)
                 batch_y = batch_y.to(device)
@@ -293,29 +334,38 @@ def evaluate_model(model: bnn_priors.models.AbstractModel,
                                          f"for predictions of type {type(preds)}")
 
                 next_i = i+len(batch_x)
-                lps[sample_i, i:next_i] = lps_batch.detach()
-                acc_data[sample_i, i:next_i, :] = acc_data_batch.detach()
+                lps_batch = lps_batch.detach().to('cpu', t.float64)
+                acc_data_batch = acc_data_batch.detach().to('cpu', t.float64)
+                lps_total += lps_batch.sum()
+                if sample_i == 0:
+                    lps_lse[i:next_i] = lps_batch
+                    acc_data_reduced[i:next_i, :] = acc_data_batch
+                else:
+                    lps_lse[i:next_i] = t.logaddexp(lps_lse[i:next_i], lps_batch)
+                    if isinstance(preds, t.distributions.Categorical):
+                        acc_data_reduced[i:next_i, :] = t.logaddexp(
+                            acc_data_reduced[i:next_i, :], acc_data_batch)
+                    else:
+                        acc_data_reduced[i:next_i, :] += acc_data_batch
+                acc_data_last[i:next_i, :] = acc_data_batch
                 i = next_i
+            lps_totals.append(lps_total)
 
-    def _log_space_mean(tensor, dim):
-        return tensor.logsumexp(dim) - math.log(tensor.size(dim))
-
-    # lps: n_samples,len(dataset)
-    lps_each_model = lps.mean(1)
-    lp_ensemble = _log_space_mean(lps, 0).mean()
+    E = len(lps_totals)
+    lps_each_model = t.stack(lps_totals) / N
+    lp_ensemble = (lps_lse - math.log(E)).mean()
 
-    # acc_data: n_samples,len(dataset), (n_classes or n_outputs)
     if isinstance(preds, t.distributions.Categorical):
-        ensemble_preds = t.distributions.Categorical(logits=_log_space_mean(acc_data, 0))
-        last_preds = t.distributions.Categorical(logits=acc_data[-1])
+        ensemble_preds = t.distributions.Categorical(logits=acc_data_reduced - math.log(E))
+        last_preds = t.distributions.Categorical(logits=acc_data_last)
 
         assert t.allclose(ensemble_preds.log_prob(labels).mean(0),
                           lp_ensemble)
         assert t.allclose(last_preds.log_prob(labels).mean(0), lps_each_model[-1])
 
     elif isinstance(preds, t.distributions.Normal):
-        ensemble_preds = t.distributions.Normal(acc_data.mean(0), t.ones_like(acc_data[0]))
-        last_preds = t.distributions.Normal(acc_data[-1], ensemble_preds.scale)
+        ensemble_preds = t.distributions.Normal(acc_data_reduced / E, t.ones_like(acc_data_last))
+        last_preds = t.distributions.Normal(acc_data_last, ensemble_preds.scale)
 
     acc_or_mse_ensemble = model.acc_mse(ensemble_preds, labels).mean(0)
     acc_or_mse_last = model.acc_mse(last_preds, labels).mean(0)
@@ -406,31 +456,166 @@ def evaluate_marglik(model, train_samples, eval_samples):
     return results
 
 
+# Fill value of the int64 datasets, which have no NaN. The `steps` of the rows
+# of a pre-sized file that were not written yet.
+_UNWRITTEN_STEP = -2**63
+
+
+def _fill_value(dtype):
+    "The value of the missing entries of an array of `dtype`: NaN, or `_UNWRITTEN_STEP`"
+    return _UNWRITTEN_STEP if np.issubdtype(dtype, np.integer) else np.nan
+
+
+def _written_rows(f) -> int:
+    """Number of rows written to the file `f` of `HDF5ModelSaver`. The datasets
+    are longer if they were pre-sized, and the file was not closed."""
+    if "steps" not in f:
+        return 0
+    steps = f["steps"]
+    n = len(steps)
+    if n > 0 and steps[n-1] == _UNWRITTEN_STEP:
+        n = int(np.argmax(steps[:] == _UNWRITTEN_STEP))
+    return n
+
+
 class HDF5ModelSaver:
-    def __init__(self, path, mode):
+    """Appends samples of the model to an HDF5 file.
+
+    With `queue_size > 0`, the writes and flushes happen in a background
+    thread, so the caller does not wait for the disk. The caller hands over
+    copies of its data through a queue of at most `queue_size` writes, and
+    only waits when the queue is full. Errors of the writes are raised by
+    the next call, or by `wait` or `__exit__`.
+
+    The samples are written `chunk_size` at a time, one HDF5 chunk each.
+    Larger chunks are faster to read back and compress better. `flush` also
+    writes the samples of a chunk that is not complete yet.
+
+    Args:
+        path (str or Path): the HDF5 file
+        mode (str): mode to open it with, as in `h5py.File`
+        queue_size (int): number of writes that can wait for the background
+            thread. 0 writes in the calling thread.
+        chunk_size (int): number of samples in each HDF5 chunk
+        n_rows (int): expected number of samples. The datasets are created
+            with that many rows, instead of growing with every chunk. Until
+            the file is closed, the rows not written yet have step -2**63.
+        compression (str): lossless compression of the chunks, None, "gzip"
+            or "lzf"
+        shuffle (bool): reorder the bytes of each chunk before compressing
+            it, which compresses floating point numbers better
+        cache_bytes (int): size of the HDF5 chunk cache of each dataset
+    """
+    def __init__(self, path, mode, queue_size=0, chunk_size=1, n_rows=None,
+                 compression=None, shuffle=False, cache_bytes=0):
         self.path = path
         self.mode = mode
-        self.chunk_size = 1
+        self.chunk_size = chunk_size
+        self.n_rows = n_rows
+        self.compression = compression
+        self.shuffle = shuffle
+        self.cache_bytes = cache_bytes
+        self.queue_size = queue_size
         self.__i = 0
         self.__init_dsets = True
+        self._pending = []
+        self.last_flush = time.time()
+        self._queue = None
+        self._thread = None
+        self._error = None
 
     def __enter__(self):
         self.f = h5py.File(self.path, self.mode, libver="latest",
-                           rdcc_nbytes=0)
+                           rdcc_nbytes=self.cache_bytes)
+        if self.queue_size > 0:
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.flush()  # Make sure to save all in-memory cache before closing
-        self.f.close()
-
-    def add_state_dict(self, state_dict, step):
-        d = {k: v.cpu().detach().unsqueeze(0).numpy()
+        try:
+            self._write_pending()
+            if self.n_rows is not None:
+                self._submit(self._truncate)
+            self.flush()  # Make sure to save all in-memory cache before closing
+            self.wait()
+        finally:
+            self._stop_writer()
+            self.f.close()
+
+    def _submit(self, fn, *args):
+        "Call `fn(*args)` in the writer thread, or right away if there is none"
+        if self._thread is None:
+            return fn(*args)
+        self._raise_error()
+        self._queue.put((fn, args))  # Blocks while the queue is full
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                # After an error, drop the remaining writes
+                if self._error is None:
+                    fn, args = item
+                    fn(*args)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        "Wait until the writes so far are done"
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"writing to {self.path} failed") from self._error
+
+    def _stop_writer(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def add_state_dict(self, state_dict, step, chain=None):
+        """Append the sample `state_dict` from `step`. If the samples come from
+        several chains, `chain` is stored along with each sample. It has to be
+        given for all the samples in the file, or for none."""
+        # The writer thread and the pending samples need a copy that the
+        # caller does not change
+        copy_data = self._thread is not None or self.chunk_size > 1
+        d = {k: v.detach().to("cpu", copy=copy_data).unsqueeze(0).numpy()
              for (k, v) in state_dict.items()}
         d["steps"] = np.array([step], dtype=np.int64)
+        if chain is not None:
+            d["chains"] = np.array([chain], dtype=np.int64)
         d["timestamps"] = np.array([time.time()], dtype=np.float64)
-        self._extend_dict(d)
+        if self.chunk_size == 1:
+            self._extend_dict(d)
+        else:
+            self._pending.append(d)
+            if len(self._pending) == self.chunk_size:
+                self._write_pending()
+
+    def _pending_dict(self):
+        "The samples of the chunk that is not complete, as one block of rows"
+        return {k: np.concatenate([d[k] for d in self._pending])
+                for k in self._pending[0].keys()}
+
+    def _write_pending(self):
+        if len(self._pending) > 0:
+            self._extend_dict(self._pending_dict())
+            self._pending = []
 
     def _extend_dict(self, d):
+        self._submit(self._write_dict, d)
+
+    def _write_dict(self, d):
         length = self._assign_dict_current(d)
         self.__i += length
 
@@ -465,41 +650,232 @@ class HDF5ModelSaver:
         return length
 
     def _create_dset(self, name, shape, dtype):
-        # int64 stores NaN as -2**63
-        assert dtype in [np.float32, np.float64, np.int64], "accepts NaNs"
+        assert dtype in [np.float32, np.float64, np.int64], "has a fill value"
 
         return self.f.create_dataset(
             name, dtype=dtype,
-            shape=(0,                *shape),
+            shape=(self.n_rows or 0, *shape),
             chunks=(self.chunk_size, *shape),
             maxshape=(None,          *shape),
-            fletcher32=True, fillvalue=np.nan)
+            compression=self.compression, shuffle=self.shuffle,
+            fletcher32=True, fillvalue=_fill_value(dtype))
 
-    def flush(self):
-        self.f.flush()
+    def flush(self, every_s=0):
+        "flush every `every_s` seconds"
+        now = time.time()
+        if every_s > 0 and now - self.last_flush <= every_s:
+            return
+        self.last_flush = now
+        if len(self._pending) > 0:
+            # Write them, but keep them until their chunk is complete
+            self._submit(self._assign_dict_current, self._pending_dict())
+        self._submit(self.f.flush)
+
+    def _truncate(self):
+        "Remove the rows of pre-sized datasets that were not written"
+        for dset in self._datasets().values():
+            if len(dset) > self.__i:
+                dset.resize(self.__i, axis=0)
+
+    def resume_(self, step) -> int:
+        """Append to a file written by an earlier run, opened with mode "a".
+        The rows after `step` are deleted, because the run continues from
+        `step`. Returns the number of rows kept."""
+        self.wait()
+        if "steps" not in self.f:
+            return 0  # Nothing was written
+        n = _written_rows(self.f)
+        n = int(np.searchsorted(self.f["steps"][:n], step, side="right"))
+        self._seek_(n)
+        return n
+
+    def _seek_(self, i):
+        "Truncate all the datasets to `i` rows, and write the next rows after them"
+        for dset in self._datasets().values():
+            dset.resize(i, axis=0)
+        self.__i = i
+        self.__init_dsets = False
+        self.f.swmr_mode = True
+
+    def _datasets(self) -> Dict[str, h5py.Dataset]:
+        "All the datasets in the file, by their full name"
+        dsets = {}
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                dsets[name] = obj
+        self.f.visititems(visit)
+        return dsets
 
     def load_samples(self, idx=slice(None), keep_steps=True):
         try:
-            self.f.flush()
+            self.flush()
         except:
             pass
+        self.wait()
         return load_samples(self.path, idx=idx, keep_steps=keep_steps)
 
+    def lazy_samples(self, idx=slice(None), keep_steps=True, owner=None):
+        "Like `load_samples`, but the samples are only read when they are indexed"
+        try:
+            self.flush()
+        except:
+            pass
+        self.wait()
+        return LazySamples(self.path, idx=idx, keep_steps=keep_steps, owner=owner)
+
+
+class LazySamples(Mapping):
+    """The samples in an HDF5 file written by `HDF5ModelSaver`, read from disk
+    only when they are indexed, so memory use does not grow with their number.
+
+    Maps the name of each entry of the state dict to a `LazySampleColumn`.
+    Indexing a column with an integer reads one sample, and indexing it with
+    a slice, integer array or boolean mask gives a column of fewer samples;
+    `load()` reads all of them. `blocks` reads a few samples of every entry
+    at a time, which `sample_iter` uses. Entries can be left out with `del`
+    or `pop`, which does not change the file.
+
+    Args:
+        path (str or Path): the HDF5 file
+        idx (slice, integer array or boolean mask): which of the samples to
+            keep, for example `np.s_[skip_first::thin]`
+        keep_steps (bool): whether to keep "steps", "timestamps" and "chains"
+        owner: object to keep alive as long as the samples, for example the
+            temporary directory of the file
+        cache_bytes (int): size of the HDF5 chunk cache of each dataset. It
+            should fit a chunk, so reading each sample of a chunk does not
+            decompress it again.
+    """
+    def __init__(self, path, idx=slice(None), keep_steps=True, owner=None,
+                 cache_bytes=2**28):
+        self.path = path
+        self._owner = owner
+        self.cache_bytes = cache_bytes
+        self._f = None
+        f = self._file()
+        self._names = [k for k, v in f.items() if isinstance(v, h5py.Dataset)
+                       and (keep_steps or k not in ["steps", "timestamps", "chains"])]
+        self._rows = _select_rows(range(_written_rows(f)), idx)
+
+    def _file(self):
+        if self._f is None:
+            self._f = h5py.File(self.path, "r", swmr=True, rdcc_nbytes=self.cache_bytes)
+        return self._f
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return LazySampleColumn(self, name, self._rows)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __delitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        self._names.remove(name)
+
+    def pop(self, name, *default):
+        if name not in self._names and len(default) > 0:
+            return default[0]
+        column = self[name]
+        del self[name]
+        return column
+
+    def blocks(self, block_size=4):
+        "The samples, `block_size` at a time, as dicts of tensors with one row per sample"
+        for start in range(0, len(self._rows), block_size):
+            rows = self._rows[start:start+block_size]
+            yield {name: self._read(name, rows) for name in self._names}
+
+    def reject_(self, rejected: Dict[int, bool]):
+        """Replace every sample whose step is rejected by the sample before it,
+        without reading any other entry than "steps". The first sample stays."""
+        steps = self._read("steps", self._rows).numpy()
+        rows = np.array(self._rows)
+        for i in range(1, len(rows)):
+            if rejected[int(steps[i])]:
+                rows[i] = rows[i-1]
+        self._rows = rows
+
+    def _read(self, name, rows) -> t.Tensor:
+        "The samples `rows` (a range or an integer array) of `name`, in that order"
+        dset = self._file()[name]
+        if len(rows) == 0:
+            return t.from_numpy(np.asarray(dset[0:0]))
+        if not isinstance(rows, range):
+            # h5py only reads increasing, unique indices
+            unique, inverse = np.unique(rows, return_inverse=True)
+            return t.from_numpy(np.asarray(dset[unique])[inverse])
+        if rows.step > 0:
+            return t.from_numpy(np.asarray(dset[rows.start:rows.stop:rows.step]))
+        return t.from_numpy(np.ascontiguousarray(np.asarray(dset[rows[::-1].start:rows.start+1:-rows.step])[::-1]))
+
+    def __getstate__(self):
+        # The open file cannot be sent to another process
+        return dict(self.__dict__, _f=None)
+
+
+def _select_rows(rows, idx):
+    "`rows[idx]` for a range or integer array of rows, and a slice, integer array or boolean mask `idx`"
+    if isinstance(idx, slice):
+        return rows[idx]
+    idx = np.asarray(idx)
+    if idx.dtype == bool:
+        assert len(idx) == len(rows), "the mask needs one entry per sample"
+        idx = np.flatnonzero(idx)
+    return np.asarray(rows)[idx]
+
+
+class LazySampleColumn:
+    "The samples `rows` of the entry `name` of `LazySamples`"
+    def __init__(self, samples: LazySamples, name: str, rows):
+        self.samples = samples
+        self.name = name
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            i = self.rows[idx]
+            return self.samples._read(self.name, range(i, i+1))[0]
+        return LazySampleColumn(self.samples, self.name, _select_rows(self.rows, idx))
+
+    def load(self) -> t.Tensor:
+        "All the samples of the column, in memory"
+        return self.samples._read(self.name, self.rows)
+
 
 class HDF5Metrics(HDF5ModelSaver):
-    def __init__(self, path, mode, chunk_size=8*1024):
-        super().__init__(path, mode)
-        self.chunk_size = chunk_size
+    def __init__(self, path, mode, chunk_size=8*1024, queue_size=0):
+        super().__init__(path, mode, queue_size=queue_size, chunk_size=chunk_size)
         self._step = -2**63
         self._cache = {}
         self._chunk_i = -1
-        self.last_flush = time.time()
 
     def add_scalar(self, name, value, step, dtype=None):
+        self._advance_step(step)
+        self._append(name, value, type(value))
+
+    def add_scalars(self, names, values: np.ndarray, step):
+        "Adds `values[i]` with name `names[i]` for every `i`, at the same `step`"
+        assert len(names) == len(values), "lengths unequal"
+        self._advance_step(step)
+        dtype = values.dtype.type
+        for name, value in zip(names, values):
+            self._append(name, value, dtype)
+
+    def _advance_step(self, step):
         if step > self._step:
             self._chunk_i += 1
             if self._chunk_i >= self.chunk_size:
-                self._extend_dict(self._cache)
+                # Copy, the cache is reused while the writer thread works
+                self._extend_dict({k: v.copy() for k, v in self._cache.items()})
                 self._chunk_i = 0
                 self._scrub_cache()
 
@@ -509,20 +885,38 @@ class HDF5Metrics(HDF5ModelSaver):
 
         elif step < self._step:
             raise ValueError(f"step went backwards ({self._step} -> {step})")
-        self._append(name, value, type(value))
 
     def _scrub_cache(self):
         for v in self._cache.values():
-            v[:] = np.nan
+            v[:] = _fill_value(v.dtype)
 
     def _append(self, name, value, dtype):
         try:
             arr = self._cache[name]
         except KeyError:
-            arr = self._cache[name] = np.empty(self.chunk_size, dtype=dtype)
-            arr[:] = np.nan
+            arr = self._new_cache_entry(name, dtype)
         arr[self._chunk_i] = value
 
+    def _new_cache_entry(self, name, dtype) -> np.ndarray:
+        arr = self._cache[name] = np.empty(self.chunk_size, dtype=dtype)
+        arr[:] = _fill_value(dtype)
+        return arr
+
+    def resume_(self, step) -> int:
+        """Append to a file written by an earlier run, opened with mode "a".
+        The rows after `step` are deleted. The last row that is kept goes back
+        into the cache, so metrics can still be added to its step."""
+        n = super().resume_(step)
+        if n == 0:
+            return n
+        for name, dset in self._datasets().items():
+            self._new_cache_entry(name, dset.dtype.type)[0] = dset[n-1]
+        self._chunk_i = 0
+        self._step = int(self._cache["steps"][0])
+        self._seek_(n-1)
+        self.flush()
+        return n
+
     def flush(self, every_s=0):
         "flush every `every_s` seconds"
         if self._chunk_i < 0:
@@ -531,21 +925,99 @@ class HDF5Metrics(HDF5ModelSaver):
         now = time.time()
         if every_s <= 0 or now - self.last_flush > every_s:
             self.last_flush = now
-            trimmed_cache = {k: v[:self._chunk_i+1] for k, v in self._cache.items()}
-            self._assign_dict_current(trimmed_cache)
-            self.f.flush()
+            trimmed_cache = {k: v[:self._chunk_i+1].copy() for k, v in self._cache.items()}
+            self._submit(self._assign_dict_current, trimmed_cache)
+            self._submit(self.f.flush)
+
+
+def _copy_to_host(obj):
+    "A copy of `obj` with every tensor in CPU memory"
+    if isinstance(obj, t.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _copy_to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_host(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointer:
+    """Writes checkpoints to `path` in a background thread, so the run does
+    not wait for them to be serialized.
+
+    `save` copies the state to host memory before it returns, so the caller
+    can keep changing its tensors. Each checkpoint goes to a temporary file,
+    which then replaces `path` atomically: after a crash, `path` holds either
+    the previous checkpoint or the new one, never a partial one. At most one
+    checkpoint is written at a time.
+
+    Args:
+        path (str or Path): file of the checkpoint
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._thread = None
+        self._error = None
+
+    def save(self, state):
+        "Start writing `state`, after the previous checkpoint is on disk"
+        self.wait()
+        state = _copy_to_host(state)
+        self._thread = threading.Thread(target=self._write, args=(state,))
+        self._thread.start()
+
+    def _write(self, state):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                t.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException as e:
+            self._error = e
+
+    def wait(self):
+        "Wait until the last checkpoint is on disk. Raises if writing it failed."
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def load(self):
+        "The checkpoint at `path`, in CPU memory"
+        self.wait()
+        try:
+            return t.load(self.path, map_location="cpu", weights_only=False)
+        except TypeError:  # older versions of torch load any object
+            return t.load(self.path, map_location="cpu")
+
+
+def open_samples(path, idx=slice(None), keep_steps=True):
+    "Like `load_samples`, but the samples of an HDF5 file are `LazySamples`"
+    try:
+        return LazySamples(path, idx=idx, keep_steps=keep_steps)
+    except OSError:
+        return load_samples(path, idx=idx, keep_steps=keep_steps)
 
 
 def load_samples(path, idx=slice(None), keep_steps=True):
     try:
         with h5py.File(path, "r", swmr=True) as f:
+            if "steps" in f:
+                # Leave out the rows of a pre-sized file that were not written
+                idx = range(_written_rows(f))[idx]
+                if isinstance(idx, range):
+                    idx = slice(idx.start, idx.stop, idx.step)
             if keep_steps:
                 return {k: t.from_numpy(np.asarray(v[idx]))
                         for k, v in f.items()}
             else:
                 return {k: t.from_numpy(np.asarray(v[idx]))
                         for k, v in f.items()
-                        if k not in ["steps", "timestamps"]}
+                        if k not in ["steps", "timestamps", "chains"]}
     except OSError:
         samples = t.load(path)
         return {k: v[idx] for k, v in samples.items()}
@@ -563,16 +1035,23 @@ def sneaky_artifact(_run, name):
 
 
 def reject_samples_(samples, metrics_file):
+    """Replace the samples that the M-H test rejected by the sample before
+    them, in place. `samples` are a dict of tensors with "steps", or
+    `LazySamples`, of which only the steps are read."""
     try:
-        rejected_arr = metrics_file["acceptance/rejected"][is_sample]
+        rejected_arr = metrics_file["acceptance/rejected"][:]
     except KeyError:
         return samples
     is_sample = (metrics_file["acceptance/is_sample"][:] == 1)
+    rejected_arr = rejected_arr[is_sample]
     assert np.all((rejected_arr == 0) | (rejected_arr == 1))
-    metrics_steps = metrics_file["steps"][is_sample]
+    metrics_steps = metrics_file["steps"][:][is_sample]
     rejected = {int(s): bool(r) for (s, r) in zip(metrics_steps, rejected_arr)}
 
-    for i in range(_n_samples_dict(samples)):
+    if isinstance(samples, LazySamples):
+        samples.reject_(rejected)
+        return samples
+    for i in range(1, _n_samples_dict(samples)):
         sample_step = samples["steps"][i].item()
         if rejected[sample_step]:
             for k in samples.keys():
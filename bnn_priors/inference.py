@@ -1,9 +1,65 @@
 from tqdm import tqdm
+import contextlib
+import logging
+import numpy as np
 import torch
 from .utils import get_cosine_schedule
 from . import mcmc
 import math
-from .exp_utils import evaluate_model
+import time
+import tempfile
+from pathlib import Path
+from . import exp_utils
+from .exp_utils import evaluate_model, AsyncCheckpointer
+from .models import MultiChainModel
+
+
+class _CompiledFunction:
+    """`fn` compiled with `torch.compile`. If this version of torch cannot
+    compile, or compiling `fn` fails, logs a warning and runs `fn` as it is
+    from then on. Compiling can fail at any call, because new inputs make it
+    compile again; any error that is not from compiling is raised.
+    `compile_seconds` is the time of the first call, which includes
+    compiling."""
+    def __init__(self, fn, **compile_kwargs):
+        self.fn = fn
+        self.compile_seconds = None
+        self._compiled = None
+        if hasattr(torch, "compile"):
+            self._compiled = torch.compile(fn, **compile_kwargs)
+        else:
+            logging.getLogger(__name__).warning(
+                "this version of torch has no `torch.compile`, running eagerly")
+
+    def __call__(self, *args):
+        if self._compiled is None:
+            return self.fn(*args)
+        start = time.perf_counter()
+        try:
+            result = self._compiled(*args)
+        except Exception as e:
+            if not self._is_compile_error(e):
+                raise
+            # A graph fails to compile before it runs, so `fn` can run again
+            logging.getLogger(__name__).warning(
+                f"`torch.compile` failed, running eagerly: {e!r}")
+            self._compiled = None
+            return self.fn(*args)
+        if self.compile_seconds is None:
+            self.compile_seconds = time.perf_counter() - start
+            logging.getLogger(__name__).info(
+                f"compiled {getattr(self.fn, '__name__', self.fn)} in {self.compile_seconds:.1f}s")
+        return result
+
+    @staticmethod
+    def _is_compile_error(e) -> bool:
+        """Whether `e` comes from compiling: from Dynamo, or from the backend
+        (`BackendCompilerFailed`). Not an error of `fn` itself that Dynamo
+        found while tracing it (`TorchRuntimeError`)."""
+        dynamo_exc = getattr(getattr(torch, "_dynamo", None), "exc", None)
+        if dynamo_exc is None or not isinstance(e, dynamo_exc.TorchDynamoException):
+            return False
+        return not isinstance(e, getattr(dynamo_exc, "TorchRuntimeError", ()))
 
 
 class SGLDRunner:
@@ -11,7 +67,14 @@ class SGLDRunner:
                  sample_epochs, learning_rate=1e-2, skip=1, metrics_skip=1,
                  temperature=1., data_mult=1., momentum=0., sampling_decay=True,
                  grad_max=1e6, cycles=1, precond_update=None,
-                 metrics_saver=None, model_saver=None, reject_samples=False):
+                 metrics_saver=None, model_saver=None, reject_samples=False,
+                 fused=False, flat=False, precond_type="scalar",
+                 adapt_lr=False, target_accept=0.8, autocast_dtype=None,
+                 mh_test="exact", mh_test_error=0.05, mh_test_batch_size=None,
+                 control_variate=False, anchor_update=None,
+                 thermostat=None, thermostat_rate=None, splitting="OBABO",
+                 seed=None, checkpoint_path=None, checkpoint_every=10,
+                 compile_step=False):
         """Stochastic Gradient Langevin Dynamics for posterior sampling.
 
         On calling `run`, this class runs SGLD for `cycles` sampling cycles. In
@@ -32,7 +95,9 @@ class SGLDRunner:
         regardless of the phase in the cycle.
 
         Args:
-            model (torch.Module, PriorMixin): BNN model to sample from
+            model (torch.Module, PriorMixin): BNN model to sample from. If it is a
+                `MultiChainModel`, run all its chains at once: the metrics get one
+                entry per chain (and their mean), and each chain's samples are saved.
             num_data (int): Number of datapoints in training sest
             warmup_epochs (int): Number of epochs per cycle for warming up the Markov chain, at the beginning.
             sample_epochs (int): Number of epochs per cycle where the samples are kept, at the end.
@@ -48,6 +113,25 @@ class SGLDRunner:
             cycles (int): Number of warmup and sampling cycles to perform
             precond_update (int): Number of steps after which the preconditioner should be updated. None disables the preconditioner.
             metrics_saver : HDF5Metrics to log metric with a certain name and value
+            model_saver : HDF5ModelSaver to store the samples. None streams them to an HDF5 file next to the checkpoint, or in a temporary directory, so they are never all in memory.
+            fused (bool): Update all parameters at once with multi-tensor operations, instead of looping over them.
+            flat (bool): Keep parameters, gradients and sampler state in one contiguous buffer per parameter group.
+            precond_type (str): "scalar" for one preconditioner value per parameter tensor, "elementwise" for one per element.
+            adapt_lr (bool): During the warmup epochs, adapt the learning rate with dual averaging so the M-H acceptance probability approaches `target_accept`, then keep it fixed for sampling. Only for the Reject runners.
+            target_accept (float): Target acceptance probability for `adapt_lr`.
+            autocast_dtype (str): "bfloat16" or "float16" to run the forward and backward passes in reduced precision with `torch.autocast`. The parameters, sampler state and energies stay in the parameters' dtype. None for full precision.
+            mh_test (str): "exact" does the `final_step` and M-H test of the Reject runners with the whole training set. "sequential" uses a minibatch gradient, and decides from a growing random subset of the data with a t-test (`mcmc.SequentialMHTest`). The potential it reports is a minibatch estimate.
+            mh_test_error (float): Probability of error of each t-test of the "sequential" M-H test.
+            mh_test_batch_size (int): Number of data points the "sequential" M-H test adds at a time. Defaults to the batch size of `dataloader`.
+            control_variate (bool): Reduce the variance of the minibatch gradients with a control variate (SGLD-CV, Baker et al. 2019). The gradient at an anchor point θ̂ is computed with the whole training set, and each minibatch gradient at θ becomes g_batch(θ) - g_batch(θ̂) + g_full(θ̂). This costs one more gradient evaluation per step.
+            anchor_update (int): With `control_variate`, move the anchor to the current parameters every `anchor_update` epochs, starting at the end of the descent epochs. None sets it only once per cycle, at the end of the descent epochs.
+            thermostat (str): Sample with a stochastic gradient Nosé-Hoover thermostat (`mcmc.SGNHT`), which adapts the friction of the momentum so that the kinetic temperature stays at `temperature` despite the noise of the minibatch gradients. "group" for one thermostat per parameter group, "element" for one per parameter element. None for plain SGLD. Needs 0 < `momentum` < 1, and does not work with `fused`, `flat` or `reject_samples`.
+            thermostat_rate (float): How fast the thermostat adapts. None for the default of `mcmc.SGNHT`.
+            splitting (str): Splitting integrator of the VerletSGLD runners, "OBABO" or "BAOAB". See `mcmc.VerletSGLD`.
+            seed (int): Draw the sampler noise, the M-H tests and the order of the training data from independent generators seeded by hashing (seed, key) (`mcmc.RNGStreams`), so the run does not depend on the global torch generator or on how the work is ordered. None uses the global generator.
+            checkpoint_path (str): File to write checkpoints of the whole state of the run to: parameters, sampler state, learning rate schedule, random number generators, energy accumulators and the cycle, epoch and step. They are written atomically, in a background thread. `run(resume=True)` continues from the last one. None disables checkpoints.
+            checkpoint_every (int): Number of epochs between checkpoints. Each checkpoint waits until the metrics and samples before it are on disk, which stalls sampling for as long as their writer threads are behind, so keep it coarse.
+            compile_step (bool): Compile the forward pass, potential and backward pass of each step with `torch.compile`, which removes most of the Python overhead of small models. With `flat`, also compile the sampler update `optimizer.step`, once with and once without metrics, with the step sizes in tensors so the learning rate schedule does not make it compile again (see `mcmc.SGLD.tensor_step_sizes`). The first steps take longer, to compile. If compiling fails, the step runs eagerly.
         """
         self.model = model
         self.dataloader = dataloader
@@ -77,37 +161,103 @@ class SGLDRunner:
         self.precond_update = precond_update
         self.metrics_saver = metrics_saver
         self.model_saver = model_saver
-        if model_saver is None:
-            self._samples = {
-                name: torch.zeros(torch.Size([self.num_samples*cycles])+p_or_b.shape, dtype=p_or_b.dtype)
-                for name, p_or_b in model.state_dict().items()}
-            self._samples["steps"] = torch.zeros(torch.Size([self.num_samples*cycles]), dtype=torch.int64)
+        # Without a `model_saver`, `run` streams the samples to a file of its own
+        self._owns_model_saver = (model_saver is None)
+        self._sample_dir = None
 
         self.param_names, self._params = zip(*model.named_parameters())
         self.reject_samples = reject_samples
+        self.fused = fused
+        self.flat = flat
+        self.precond_type = precond_type
+        self.num_chains = (model.num_chains if isinstance(model, MultiChainModel) else None)
+        self.adapt_lr = adapt_lr
+        self.target_accept = target_accept
+        assert autocast_dtype in [None, "bfloat16", "float16"]
+        assert all(p.dtype in [torch.float32, torch.float64] for p in self._params), \
+            "the parameters hold the sampler state, keep them in full precision"
+        self.autocast_dtype = autocast_dtype
+        assert mh_test in ["exact", "sequential"]
+        self.mh_test = mh_test
+        self.mh_test_error = mh_test_error
+        self.mh_test_batch_size = mh_test_batch_size
+        assert not (control_variate and self.num_chains is not None), \
+            "`control_variate` only works with one chain"
+        self.control_variate = control_variate
+        self.anchor_update = anchor_update
+        assert thermostat in [None, "group", "element"]
+        self.thermostat = thermostat
+        self.thermostat_rate = thermostat_rate
+        self.splitting = splitting
+        self.rng = (None if seed is None else mcmc.RNGStreams(seed))
+        self.checkpoint_every = checkpoint_every
+        self._checkpointer = (None if checkpoint_path is None else AsyncCheckpointer(checkpoint_path))
+        # Whether this run continues from a checkpoint
+        self._resumed = False
+        self.compile_step = compile_step
+        self._forward_backward_fn = (
+            _CompiledFunction(self._forward_backward) if compile_step else self._forward_backward)
+        # `optimizer.step`, compiled for each value of `calc_metrics`
+        self._compiled_updates = (
+            {c: _CompiledFunction(self._update_fn(c)) for c in [False, True]}
+            if compile_step else None)
+        # List of (parameter, full-data gradient) at the anchor point
+        self._anchor = None
+        # Scale the potential before `backward` so float16 gradients do not underflow
+        self._loss_scale = (2.**10 if autocast_dtype == "float16" else 1.)
 
     def _make_optimizer(self, params):
         assert self.reject_samples is False, "SGLD cannot reject samples"
+        if self.thermostat is not None:
+            return self._make_thermostat_optimizer(params)
         return mcmc.SGLD(
             params=params,
             lr=self.learning_rate, num_data=self.eff_num_data,
-            momentum=self.momentum, temperature=self.temperature)
+            momentum=self.momentum, temperature=self.temperature,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            num_chains=self.num_chains, rng=self.rng)
+
+    def _make_thermostat_optimizer(self, params):
+        assert not (self.fused or self.flat), "SGNHT only has the per-parameter step"
+        return mcmc.SGNHT(
+            params=params,
+            lr=self.learning_rate, num_data=self.eff_num_data,
+            momentum=self.momentum, temperature=self.temperature,
+            thermostat=self.thermostat, thermostat_rate=self.thermostat_rate,
+            precond_type=self.precond_type, num_chains=self.num_chains, rng=self.rng)
+
+    def _uniform(self, purpose) -> float:
+        "A number from U(0, 1), from the stream `purpose` if there is a `seed`"
+        if self.rng is None:
+            return torch.rand(()).item()
+        return self.rng.uniform(purpose)
+
+    def _random_sampler(self):
+        "The sampler that shuffles the training data, or None"
+        sampler = self.dataloader.batch_sampler
+        while sampler is not None and not hasattr(sampler, "generator"):
+            sampler = getattr(sampler, "sampler", getattr(sampler, "batch_sampler", None))
+        return sampler
+
+    def _steps_per_epoch(self):
+        "Number of `scheduler.step`s in each epoch"
+        return len(self.dataloader)
 
     def _make_scheduler(self, optimizer):
         if self.sampling_decay is True or self.sampling_decay == "cosine":
             schedule = get_cosine_schedule(
-                len(self.dataloader) * self.epochs_per_cycle)
+                self._steps_per_epoch() * self.epochs_per_cycle)
             return torch.optim.lr_scheduler.LambdaLR(
                 optimizer=optimizer, lr_lambda=schedule)
         elif self.sampling_decay is False or self.sampling_decay == "stairs":
             return torch.optim.lr_scheduler.StepLR(
-                optimizer, 150*len(self.dataloader), gamma=0.1)
+                optimizer, 150*self._steps_per_epoch(), gamma=0.1)
         elif self.sampling_decay == "flat":
             # No-op scheduler
             return torch.optim.lr_scheduler.StepLR(optimizer, 2**30, gamma=1.0)
         raise ValueError(f"self.sampling_decay={self.sampling_decay}")
 
-    def run(self, progressbar=False):
+    def run(self, progressbar=False, resume=False):
         """
         Runs the sampling on the model.
 
@@ -115,13 +265,18 @@ class SGLDRunner:
             x (torch.tensor): Training input data
             y (torch.tensor): Training labels
             progressbar (bool): Flag that controls whether a progressbar is printed
+            resume (bool): Continue from the checkpoint at `checkpoint_path`, written by a run with the same arguments. The metrics and samples after the checkpoint are removed from `metrics_saver` and `model_saver`, which have to be open in mode "a".
         """
+        assert not self.adapt_lr, "`adapt_lr` needs the M-H tests of the Reject runners"
+        checkpoint = self._start_run(resume)
         self.optimizer = self._make_optimizer(self._params)
         self.optimizer.sample_momentum()
         self.scheduler = self._make_scheduler(self.optimizer)
+        if self.rng is not None and self._random_sampler() is not None:
+            self._random_sampler().generator = self.rng.generator("data")
 
-        self.metrics_saver.add_scalar("test/log_prob", math.nan, step=-1)
-        self.metrics_saver.add_scalar("test/acc", math.nan, step=-1)
+        self._add_initial_scalar("test/log_prob", math.nan)
+        self._add_initial_scalar("test/acc", math.nan)
 
         def _is_sampling_epoch(_epoch):
             _epoch = _epoch % self.epochs_per_cycle
@@ -129,17 +284,20 @@ class SGLDRunner:
             return (0 <= sampling_epoch) and (sampling_epoch % self.skip == 0)
 
         step = -1  # used for `self.metrics_saver.add_scalar`, must start at 0 and never reset
+        start_cycle, start_epoch = 0, 0
+        if checkpoint is not None:
+            step, start_cycle, start_epoch = self._load_checkpoint(checkpoint)
         postfix = {}
-        for cycle in range(self.cycles):
+        for cycle in range(start_cycle, self.cycles):
+            epochs = range(start_epoch if cycle == start_cycle else 0, self.epochs_per_cycle)
             if progressbar:
-                epochs = tqdm(range(self.epochs_per_cycle), position=0,
-                              leave=True, desc=f"Cycle {cycle}, Sampling", mininterval=2.0)
-            else:
-                epochs = range(self.epochs_per_cycle)
+                epochs = tqdm(epochs, position=0, leave=True,
+                              desc=f"Cycle {cycle}, Sampling", mininterval=2.0)
 
             for epoch in epochs:
                 for g in self.optimizer.param_groups:
                     g['temperature'] = 0. if epoch < self.descent_epochs else self.temperature
+                self._maybe_update_anchor(epoch)
 
                 for i, (x, y) in enumerate(self.dataloader):
                     step += 1
@@ -158,8 +316,8 @@ class SGLDRunner:
                         initial_step=initial_step)
 
                     if progressbar and store_metrics:
-                        postfix["train/loss"] = loss.item()
-                        postfix["train/acc"] = acc.item()
+                        postfix["train/loss"] = loss.mean().item()
+                        postfix["train/acc"] = acc.mean().item()
                         if delta_energy is not None:
                             postfix["Δₑ"] = delta_energy
                         epochs.set_postfix(postfix, refresh=False)
@@ -178,6 +336,7 @@ class SGLDRunner:
                 # Important to put here because no new metrics are added
                 # Write metrics to disk every 30 seconds
                 self.metrics_saver.flush(every_s=10)
+                self._maybe_checkpoint(cycle, epoch, step)
 
         # Save metrics for the last sample
         (x, y) = next(iter(self.dataloader))
@@ -185,42 +344,248 @@ class SGLDRunner:
                   x.to(self._params[0].device),
                   y.to(self._params[0].device),
                   store_metrics=True, initial_step=_is_sampling_epoch(-1))
+        self._finish_run()
+
+    # Attributes of the runner that change during `run`, and go in the checkpoints
+    _checkpoint_attrs = ["_anchor", "_initial_potential", "_total_energy",
+                         "_lr_adapter", "_cycle_random_state"]
+
+    def _add_initial_scalar(self, name, value):
+        "Log `value` before the first step. A resumed run has logged it already."
+        if not self._resumed:
+            self.metrics_saver.add_scalar(name, value, step=-1)
+
+    def _start_run(self, resume):
+        """Open the sample store. If `resume`, read the checkpoint, and remove
+        the metrics and samples written after it. Returns the checkpoint, or
+        None."""
+        self._resumed = resume
+        self._open_sample_store(resume)
+        if not resume:
+            return None
+        assert self._checkpointer is not None, "`resume` needs a `checkpoint_path`"
+        checkpoint = self._checkpointer.load()
+        self.metrics_saver.resume_(checkpoint["step"])
+        self.model_saver.resume_(checkpoint["step"])
+        return checkpoint
+
+    def _finish_run(self):
+        if self._checkpointer is not None:
+            self._checkpointer.wait()
+        if self._owns_model_saver:
+            self.model_saver.__exit__(None, None, None)
+
+    def _open_sample_store(self, resume):
+        """Without a `model_saver`, stream the samples to an HDF5 file instead
+        of keeping them in memory. The file is next to the checkpoint, so a
+        resumed run continues it, or in a temporary directory."""
+        if not self._owns_model_saver:
+            return
+        if self._checkpointer is not None:
+            path = self._checkpointer.path
+            path = path.with_name(path.name + ".samples.h5")
+        else:
+            self._sample_dir = tempfile.TemporaryDirectory(prefix="bnn_samples_")
+            path = Path(self._sample_dir.name)/"samples.h5"
+        # Write in the background; at most a few samples wait in memory
+        n_rows = self.num_samples * self.cycles * (self.num_chains or 1)
+        self.model_saver = exp_utils.HDF5ModelSaver(
+            path, ("a" if resume else "w"), queue_size=4, n_rows=n_rows).__enter__()
+
+    def _maybe_checkpoint(self, cycle, epoch, step):
+        "Write a checkpoint at the end of `epoch`, every `checkpoint_every` epochs"
+        if self._checkpointer is None:
+            return
+        if (cycle*self.epochs_per_cycle + epoch + 1) % self.checkpoint_every != 0:
+            return
+        # The metrics and samples on disk must not be behind the checkpoint
+        self.metrics_saver.flush()
+        self.model_saver.flush()
+        self.metrics_saver.wait()
+        self.model_saver.wait()
+        self._checkpointer.save(self._checkpoint_state(cycle, epoch, step))
+
+    def _checkpoint_state(self, cycle, epoch, step):
+        "Everything needed to continue the run after `epoch` of `cycle`, which ended at `step`"
+        return {
+            "cycle": cycle, "epoch": epoch, "step": step,
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "runner": {k: getattr(self, k) for k in self._checkpoint_attrs if hasattr(self, k)},
+            "rng": (None if self.rng is None else self.rng.state_dict()),
+            "torch_rng": torch.get_rng_state(),
+            "cuda_rng": (torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None),
+            "numpy_rng": np.random.get_state(),
+        }
+
+    def _load_checkpoint(self, checkpoint):
+        """Restore the state of `_checkpoint_state`, after the optimizer and
+        scheduler are created. Returns the step of the checkpoint, and the
+        cycle and epoch to continue from."""
+        device = self._params[0].device
+        self.model.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.scheduler.load_state_dict(checkpoint["scheduler"])
+        for k, v in checkpoint["runner"].items():
+            setattr(self, k, v)
+        if self._anchor is not None:
+            self._anchor = [(p.to(device), g.to(device)) for p, g in self._anchor]
+        if self.rng is not None:
+            self.rng.load_state_dict(checkpoint["rng"])
+        torch.set_rng_state(checkpoint["torch_rng"])
+        if checkpoint["cuda_rng"] is not None:
+            torch.cuda.set_rng_state_all(checkpoint["cuda_rng"])
+        np.random.set_state(checkpoint["numpy_rng"])
+
+        cycle, epoch = checkpoint["cycle"], checkpoint["epoch"] + 1
+        if epoch == self.epochs_per_cycle:
+            cycle, epoch = cycle + 1, 0
+        return checkpoint["step"], cycle, epoch
 
     def _save_sample(self, state_dict, cycle, epoch, step):
-        # TODO: refactor this into two `model_saver` classes
-        sampling_epoch = epoch - (self.descent_epochs + self.warmup_epochs)
-        if self.model_saver is None:
-            for name, param in state_dict.items():
-                self._samples[name][(self.num_samples*cycle)+(sampling_epoch//self.skip)] = param
-        else:
+        if self.num_chains is None:
             self.model_saver.add_state_dict(state_dict, step)
-            self.model_saver.flush()
+        else:
+            for chain in range(self.num_chains):
+                self.model_saver.add_state_dict(
+                    {k: v[chain] for k, v in state_dict.items()}, step, chain=chain)
+        self.model_saver.flush(every_s=10)
 
     def _evaluate_model(self, state_dict, step):
         if len(self.dataloader_test) == 0:
             return {}
         self.model.eval()
-        state_dict = {k: v.unsqueeze(0) for k, v in state_dict.items()}
+        if self.num_chains is None:
+            model, which = self.model, "last"
+            state_dict = {k: v.unsqueeze(0) for k, v in state_dict.items()}
+        else:
+            # The current state of each chain is one member of the ensemble
+            model, which = self.model.model, "ensemble"
         results = evaluate_model(
-            self.model, self.dataloader_test, state_dict,
+            model, self.dataloader_test, state_dict,
             likelihood_eval=True, accuracy_eval=True, calibration_eval=False)
         self.model.train()
 
-        results = {"test/loss": -results["lp_last"],
-                   "test/acc": results["acc_last"]}
+        results = {"test/loss": -results[f"lp_{which}"],
+                   "test/acc": results[f"acc_{which}"]}
         for k, v in results.items():
             self.metrics_saver.add_scalar(k, v, step)
         return results
 
+    def _exact_model_potential_and_grad(self, dataloader):
+        self.optimizer.zero_grad()
+        log_prior = self.model.log_prior()
+        log_norm_prior = log_prior / -self.eff_num_data
+        self._backward(log_norm_prior)
+
+        loss = 0.
+        for x, y in dataloader:
+            with self._autocast():
+                this_loss = self.model.log_likelihood(x.to(self._params[0].device),
+                                                      y.to(self._params[0].device),
+                                                      -x.size(0)/self.eff_num_data)
+            self._backward(this_loss)
+            loss = loss + this_loss
+        self._unscale_grads()
+
+        potential = loss + log_norm_prior
+        return loss, log_prior, potential
+
+    def _maybe_update_anchor(self, epoch):
+        """With `control_variate`, move the anchor to the current parameters if
+        `epoch` (of the current cycle) is one of the epochs in `anchor_update`.
+        Overwrites the gradients."""
+        if not self.control_variate:
+            return
+        if epoch == 0:
+            self._anchor = None
+        anchor_epoch = epoch - self.descent_epochs
+        if anchor_epoch < 0 or anchor_epoch % (self.anchor_update or self.epochs_per_cycle) != 0:
+            return
+        self._exact_model_potential_and_grad(self.dataloader)
+        self._anchor = [(p.detach().clone(), p.grad.detach().clone()) for p in self._params]
+
+    def _apply_control_variate(self, x, y):
+        "Subtract the gradient of the batch `x, y` at the anchor, add the full one"
+        anchor_params = [a.detach().requires_grad_() for a, _ in self._anchor]
+        with self.model.using_params(dict(zip(self.param_names, anchor_params))), self._autocast():
+            _, _, potential, _, _ = self.model.split_potential_and_acc(x, y, self.eff_num_data)
+        anchor_grads = torch.autograd.grad(potential * self._loss_scale, anchor_params)
+        with torch.no_grad():
+            for p, (_, full_grad), batch_grad in zip(self._params, self._anchor, anchor_grads):
+                p.grad.add_(full_grad).sub_(batch_grad, alpha=1/self._loss_scale)
+
+    def _autocast(self):
+        "Context for computing the potential, in `autocast_dtype` if it is set"
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self._params[0].device.type,
+                              dtype=getattr(torch, self.autocast_dtype))
+
+    def _backward(self, value):
+        "`value.backward()`, multiplied by the loss scale"
+        if self._loss_scale == 1.:
+            value.backward()
+        else:
+            (value * self._loss_scale).backward()
+
+    def _unscale_grads(self):
+        "Undo the loss scale of `_backward` in the accumulated gradients"
+        if self._loss_scale != 1.:
+            for p in self.optimizer.param_groups[0]["params"]:
+                p.grad.div_(self._loss_scale)
+
+    def _forward_backward(self, x, y):
+        "The potential of the batch `x, y`, with its gradient added to `.grad`"
+        with self._autocast():
+            loss, log_prior, potential, accs_batch, _ = self.model.split_potential_and_acc(x, y, self.eff_num_data)
+        # The chains are independent, so the gradient of the sum is each chain's gradient
+        self._backward(potential.sum())
+        return loss, log_prior, potential, accs_batch
+
     def _model_potential_and_grad(self, x, y):
         self.optimizer.zero_grad()
-        loss, log_prior, potential, accs_batch, _ = self.model.split_potential_and_acc(x, y, self.eff_num_data)
-        potential.backward()
-        for p in self.optimizer.param_groups[0]["params"]:
-            p.grad.clamp_(min=-self.grad_max, max=self.grad_max)
-        if torch.isnan(potential).item():
+        loss, log_prior, potential, accs_batch = self._forward_backward_fn(x, y)
+        self._unscale_grads()
+        if self._anchor is not None:
+            self._apply_control_variate(x, y)
+        self._clamp_grads()
+        if torch.isnan(potential).any().item():
             raise ValueError("Potential is NaN")
-        return loss, log_prior, potential, accs_batch.mean()
+        return loss, log_prior, potential, accs_batch.mean(-1)
+
+    def _update_fn(self, calc_metrics):
+        "The sampler update with `calc_metrics`, as a function of no arguments"
+        def sampler_update():
+            return self.optimizer.step(calc_metrics=calc_metrics)
+        return sampler_update
+
+    def _optimizer_step(self, calc_metrics):
+        """`optimizer.step(calc_metrics=calc_metrics)`, compiled if
+        `compile_step` and the optimizer is `flat`"""
+        if self._compiled_updates is None or not getattr(self.optimizer, "flat", False):
+            return self.optimizer.step(calc_metrics=calc_metrics)
+        with self.optimizer.tensor_step_sizes():
+            return self._compiled_updates[calc_metrics]()
+
+    def _clamp_grads(self):
+        "Clamp every element of the gradients to [-grad_max, grad_max]"
+        grads = [p.grad for p in self.optimizer.param_groups[0]["params"]]
+        if hasattr(torch, "_foreach_clamp_max_"):
+            torch._foreach_clamp_min_(grads, -self.grad_max)
+            torch._foreach_clamp_max_(grads, self.grad_max)
+        else:
+            for g in grads:
+                g.clamp_(min=-self.grad_max, max=self.grad_max)
+
+    def _to_host(self, *tensors):
+        """Copy the scalars `tensors` to the host in one transfer. With several
+        chains, each becomes an array with one value per chain."""
+        values = torch.stack([t.detach().to(torch.float64) for t in tensors]).cpu().numpy()
+        if self.num_chains is None:
+            return [v.item() for v in values]
+        return list(values)
 
     def step(self, i, x, y, store_metrics, lr_decay=True, initial_step=False):
         """
@@ -235,7 +600,7 @@ class SGLDRunner:
             loss (float): The current loss of the model for x and y
         """
         loss, log_prior, potential, acc = self._model_potential_and_grad(x, y)
-        self.optimizer.step(calc_metrics=store_metrics)
+        self._optimizer_step(store_metrics)
 
         lr = self.optimizer.param_groups[0]["lr"]
         if lr_decay:
@@ -243,8 +608,9 @@ class SGLDRunner:
 
         if store_metrics:
             # The metrics are valid for the previous step.
-            self.store_metrics(i=i-1, loss=loss.item(), log_prior=log_prior.item(),
-                               potential=potential.item(), acc=acc.item(), lr=lr,
+            loss_, log_prior_, potential_, acc_ = self._to_host(loss, log_prior, potential, acc)
+            self.store_metrics(i=i-1, loss=loss_, log_prior=log_prior_,
+                               potential=potential_, acc=acc_, lr=lr,
                                corresponds_to_sample=initial_step)
         return loss, acc, None
 
@@ -253,53 +619,70 @@ class SGLDRunner:
         Returns the acquired SGLD samples from the last run.
 
         Returns:
-            samples (dict): Dictionary of torch.tensors with num_samples*cycles samples for each parameter of the model
+            samples (exp_utils.LazySamples): mapping from each entry of the state dict to its num_samples*cycles samples, read from disk when they are indexed. The samples of all chains are one after the other.
         """
-        if self.model_saver is None:
-            return {k: v for (k, v) in self._samples.items() if k != "steps"}
-        return self.model_saver.load_samples(keep_steps=False)
+        return self.model_saver.lazy_samples(keep_steps=False, owner=self._sample_dir)
 
     def store_metrics(self, i, loss, log_prior, potential, acc, lr,
                       corresponds_to_sample: bool,
                       delta_energy=None, total_energy=None, rejected=None):
-        est_temperature_all = 0.
-        est_config_temp_all = 0.
-        all_numel = 0
-        add_scalar = self.metrics_saver.add_scalar
-        for n, p in zip(self.param_names, self.optimizer.param_groups[0]["params"]):
-            state = self.optimizer.state[p]
-            add_scalar("preconditioner/"+n, state["preconditioner"], i)
-            add_scalar("est_temperature/"+n, state["est_temperature"], i)
-            add_scalar("est_config_temp/"+n, state["est_config_temp"], i)
-
-            est_temperature_all += state["est_temperature"] * p.numel()
-            est_config_temp_all += state["est_config_temp"] * p.numel()
-            all_numel += p.numel()
-        add_scalar("est_temperature/all", est_temperature_all / all_numel, i)
-        add_scalar("est_config_temp/all", est_config_temp_all / all_numel, i)
+        add_scalar = self._add_chain_scalar
+        # Copy all the per-parameter diagnostics to the host at once
+        diagnostics = self.optimizer.diagnostics()
+        for key in ["preconditioner", "est_temperature", "est_config_temp"]:
+            if self.num_chains is None:
+                names = [f"{key}/{n}" for n in self.param_names]
+            else:
+                names = [f"{key}/{n}/chain{c}" for n in self.param_names
+                         for c in range(self.num_chains)]
+            self.metrics_saver.add_scalars(names, diagnostics[key].reshape(-1), i)
+
+        numel = np.array([p.numel() for p in self._params], dtype=np.float64)
+        add_scalar("est_temperature/all",
+                   numel @ diagnostics["est_temperature"] / numel.sum(), i)
+        add_scalar("est_config_temp/all",
+                   numel @ diagnostics["est_config_temp"] / numel.sum(), i)
 
         temperature = self.optimizer.param_groups[0]["temperature"]
-        add_scalar("temperature", temperature, i)
+        self.metrics_saver.add_scalar("temperature", temperature, i)
         add_scalar("loss", loss, i)
         add_scalar("acc", acc, i)
         add_scalar("log_prior", log_prior, i)
         add_scalar("potential", potential, i)
-        add_scalar("lr", lr, i)
-        add_scalar("acceptance/is_sample", int(corresponds_to_sample), i)
+        self.metrics_saver.add_scalar("lr", lr, i)
+        self.metrics_saver.add_scalar("acceptance/is_sample", int(corresponds_to_sample), i)
 
         if delta_energy is not None:
             add_scalar("delta_energy", delta_energy, i)
             add_scalar("total_energy", total_energy, i)
         if rejected is not None:
-            add_scalar("acceptance/rejected", int(rejected), i)
+            if self.num_chains is None:
+                rejected = int(rejected)
+            add_scalar("acceptance/rejected", rejected, i)
+
+    def _add_chain_scalar(self, name, value, i):
+        """`metrics_saver.add_scalar`. With several chains, `value` has one entry
+        per chain: store each of them, and their mean as `name`."""
+        if self.num_chains is None:
+            return self.metrics_saver.add_scalar(name, value, i)
+        value = np.broadcast_to(np.asarray(value, dtype=np.float64), (self.num_chains,))
+        self.metrics_saver.add_scalar(name, float(value.mean()), i)
+        self.metrics_saver.add_scalars(
+            [f"{name}/chain{c}" for c in range(self.num_chains)], value, i)
 
 
 class VerletSGLDRunner(SGLDRunner):
     def _make_optimizer(self, params):
+        if self.thermostat is not None:
+            # SGNHT has no energy error, so `delta_energy` is infinite
+            assert self.reject_samples is False, "SGNHT cannot reject samples"
+            return self._make_thermostat_optimizer(params)
         return mcmc.VerletSGLD(
             params=params,
             lr=self.learning_rate, num_data=self.eff_num_data,
-            momentum=self.momentum, temperature=self.temperature)
+            momentum=self.momentum, temperature=self.temperature,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            num_chains=self.num_chains, splitting=self.splitting, rng=self.rng)
 
     def step(self, i, x, y, store_metrics, lr_decay=True, initial_step=False):
         loss, log_prior, potential, acc = self._model_potential_and_grad(x, y)
@@ -333,18 +716,18 @@ class VerletSGLDRunner(SGLDRunner):
                 calc_metrics=False, save_state=self.reject_samples)
         else:
             # Any intermediate step
-            self.optimizer.step(calc_metrics=store_metrics)
+            self._optimizer_step(store_metrics)
 
         if i == 0:
             # Very first step
             store_metrics = True
             total_energy = delta_energy = self.optimizer.delta_energy(0., 0.)
-            self._initial_potential = potential.item()
+            self._initial_potential, = self._to_host(potential)
             self._total_energy = 0.
         elif initial_step:
             # First step of an epoch
             store_metrics = True
-            self._initial_potential = potential.item()
+            self._initial_potential, = self._to_host(potential)
             self._total_energy += delta_energy
             total_energy = self._total_energy
         else:
@@ -355,8 +738,9 @@ class VerletSGLDRunner(SGLDRunner):
 
         if store_metrics:
             # The metrics are valid for the previous step.
-            self.store_metrics(i=i-1, loss=loss.item(), log_prior=log_prior.item(),
-                               potential=potential.item(), acc=acc.item(), lr=lr,
+            loss_, log_prior_, potential_, acc_ = self._to_host(loss, log_prior, potential, acc)
+            self.store_metrics(i=i-1, loss=loss_, log_prior=log_prior_,
+                               potential=potential_, acc=acc_, lr=lr,
                                delta_energy=delta_energy,
                                total_energy=total_energy, rejected=rejected,
                                corresponds_to_sample=initial_step)
@@ -371,4 +755,201 @@ class HMCRunner(VerletSGLDRunner):
         assert self.descent_epochs == 0, "HMC not implemented for descent epochs with temp=0."
         return mcmc.HMC(
             params=params,
-            lr=self.learning_rate, num_data=self.eff_num_data)
+            lr=self.learning_rate, num_data=self.eff_num_data,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            num_chains=self.num_chains, rng=self.rng)
+
+
+class _IndexRecorder:
+    "Batch sampler that remembers the indices of the last batch it yielded"
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.indices = None
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            self.indices = indices
+            yield indices
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class SAGALDRunner(SGLDRunner):
+    """SGLD with the SAGA variance-reduced gradient (`mcmc.SAGALD`), for small
+    data sets. The gradient of every data point is computed with vectorized
+    per-example gradients, and kept in a table of `len(dataloader.dataset)`
+    rows. The table is filled with a pass over the data at the start of `run`.
+
+    Args:
+        max_table_bytes (int): refuse to run if the gradient table would take
+            more memory than this. The size of the table is logged.
+        All other arguments are as in `SGLDRunner`.
+    """
+    def __init__(self, model, dataloader, *args, max_table_bytes=2**30, **kwargs):
+        assert dataloader.num_workers == 0, \
+            "the indices of each batch are only known when loading in this process"
+        # Load the same batches, and remember their indices
+        dataloader = torch.utils.data.DataLoader(
+            dataloader.dataset, batch_sampler=_IndexRecorder(dataloader.batch_sampler),
+            collate_fn=dataloader.collate_fn)
+        super().__init__(model, dataloader, *args, **kwargs)
+        assert self.num_chains is None, "SAGA-LD samples one chain"
+        assert not self.control_variate, "SAGA-LD already reduces the variance"
+        assert self.autocast_dtype is None, "SAGA-LD computes the gradients in full precision"
+        assert not self.compile_step, "SAGA-LD computes the gradients with `vmap`"
+        self.max_table_bytes = max_table_bytes
+
+    def _make_optimizer(self, params):
+        table_size = len(self.dataloader.dataset)
+        table_bytes = mcmc.SAGALD.required_table_bytes(params, table_size)
+        logging.getLogger(__name__).info(
+            f"SAGA-LD gradient table: {table_size} rows, {table_bytes/2**20:.1f} MiB")
+        self._add_initial_scalar("saga/table_bytes", table_bytes)
+        optimizer = mcmc.SAGALD(
+            params=params,
+            lr=self.learning_rate, num_data=self.eff_num_data, table_size=table_size,
+            momentum=self.momentum, temperature=self.temperature,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            max_table_bytes=self.max_table_bytes, rng=self.rng)
+
+        # Fill the table
+        device = self._params[0].device
+        for indices in self.dataloader.batch_sampler.batch_sampler:
+            x, y = self.dataloader.collate_fn([self.dataloader.dataset[i] for i in indices])
+            optimizer.set_table_(torch.as_tensor(indices, device=device),
+                                 self._example_grads(x.to(device), y.to(device)))
+        return optimizer
+
+    def _example_grads(self, x, y):
+        "Gradient of -log p(y_i | x_i, params) for each data point, for every parameter"
+        params = tuple(p.detach() for p in self._params)
+
+        def example_potential(params, x_i, y_i):
+            with self.model.using_params(dict(zip(self.param_names, params))):
+                return -self.model(x_i.unsqueeze(0)).log_prob(y_i.unsqueeze(0)).sum()
+
+        if hasattr(torch, "func"):
+            # Validating the arguments of `torch.distributions` branches on the
+            # values, which `vmap` cannot do
+            validate_args = torch.distributions.Distribution._validate_args
+            torch.distributions.Distribution.set_default_validate_args(False)
+            try:
+                return torch.func.vmap(torch.func.grad(example_potential),
+                                       in_dims=(None, 0, 0))(params, x, y)
+            finally:
+                torch.distributions.Distribution.set_default_validate_args(validate_args)
+
+        params = tuple(p.requires_grad_() for p in params)
+        grads = [torch.autograd.grad(example_potential(params, x_i, y_i), params)
+                 for x_i, y_i in zip(x, y)]
+        return [torch.stack(g) for g in zip(*grads)]
+
+    def _model_potential_and_grad(self, x, y):
+        self.optimizer.zero_grad()
+        loss, log_prior, potential, accs_batch, _ = self.model.split_potential_and_acc(x, y, self.eff_num_data)
+        # Only the gradient of the prior comes from `backward`; the
+        # likelihood's is the SAGA drift
+        (log_prior / -self.eff_num_data).backward()
+        indices = torch.as_tensor(self.dataloader.batch_sampler.indices, device=x.device)
+        self.optimizer.saga_grad_(indices, self._example_grads(x, y))
+        self._clamp_grads()
+        if torch.isnan(potential).any().item():
+            raise ValueError("Potential is NaN")
+        return loss, log_prior, potential, accs_batch.mean(-1)
+
+
+class ParallelTemperingRunner(SGLDRunner):
+    """Replica exchange: SGLD on several chains at different temperatures, in
+    one `MultiChainModel`, with swaps of the parameters of neighbouring chains.
+
+    Every `swap_every` steps, the runner proposes to swap the parameters of
+    chains k and k+1, for every other pair (alternating between the even and
+    the odd pairs). A swap is accepted with probability
+        min(1, exp((1/T_k - 1/T_{k+1}) (E_k - E_{k+1}))),
+    where E is the potential of the minibatch that the step computed anyway,
+    scaled to the whole data set. All chains see the same minibatch, which
+    keeps the noise of the difference small, but the test is still
+    approximate. The gradients are swapped with the parameters, so no extra
+    evaluation is needed. Chain k always samples at temperature
+    `temperatures[k]`, so the samples of each chain are from one temperature.
+
+    Args:
+        model (MultiChainModel): with one chain per temperature.
+        temperatures (sequence of float): the temperature of each chain, usually
+            increasing from 1.
+        swap_every (int): number of steps between swap proposals.
+        All other arguments are as in `SGLDRunner`. `temperature` must be 1; the
+        descent epochs still run at temperature 0, without swaps.
+    """
+    def __init__(self, model, *args, temperatures=(1.,), swap_every=10, **kwargs):
+        super().__init__(model, *args, **kwargs)
+        assert self.num_chains == len(temperatures), \
+            "the model needs one chain (`MultiChainModel`) per temperature"
+        assert self.temperature == 1., "set the temperatures with `temperatures`"
+        assert not self.reject_samples, "swaps between trajectories are not implemented"
+        assert swap_every >= 1
+        self.temperatures = list(temperatures)
+        self.swap_every = swap_every
+        self._n_swap_attempts = 0
+        self._step_index = 0
+
+    _checkpoint_attrs = SGLDRunner._checkpoint_attrs + ["_n_swap_attempts"]
+
+    def _swap_metric_names(self, k):
+        return [f"swap/accept_prob/chain{k}-{k+1}", f"swap/accepted/chain{k}-{k+1}"]
+
+    def _make_optimizer(self, params):
+        # `HDF5Metrics` cannot add names after its first flush, so add them now
+        if not self._resumed:
+            names = [n for k in range(self.num_chains - 1) for n in self._swap_metric_names(k)]
+            self.metrics_saver.add_scalars(names, np.full(len(names), np.nan), step=-1)
+        return mcmc.SGLD(
+            params=params,
+            lr=self.learning_rate, num_data=self.eff_num_data,
+            momentum=self.momentum, temperature=self.temperature,
+            precond_type=self.precond_type, num_chains=self.num_chains,
+            chain_temperatures=self.temperatures, rng=self.rng)
+
+    def step(self, i, x, y, store_metrics, lr_decay=True, initial_step=False):
+        self._step_index = i
+        return super().step(i, x, y, store_metrics, lr_decay=lr_decay,
+                            initial_step=initial_step)
+
+    def _model_potential_and_grad(self, x, y):
+        results = super()._model_potential_and_grad(x, y)
+        base_temperature = self.optimizer.param_groups[0]["temperature"]
+        if base_temperature == 0 or self._step_index % self.swap_every != 0:
+            return results
+        perm = self._propose_swaps(results[2], base_temperature)
+        if perm is None:
+            return results
+        with torch.no_grad():
+            for p in self._params:
+                p.copy_(p[perm])
+                p.grad.copy_(p.grad[perm])
+        # The returned values follow their parameters
+        return tuple(v[perm] for v in results)
+
+    def _propose_swaps(self, potential, base_temperature):
+        """Decide which neighbouring chains to swap, log the acceptance
+        probabilities. Returns the permutation of the chains, or None."""
+        first = self._n_swap_attempts % 2
+        self._n_swap_attempts += 1
+        energy = potential.detach().to(torch.float64).cpu().numpy() * self.eff_num_data
+        beta = 1 / (base_temperature * np.asarray(self.temperatures))
+        perm = np.arange(self.num_chains)
+        names, values = [], []
+        for k in range(first, self.num_chains - 1, 2):
+            log_accept_prob = (beta[k] - beta[k+1]) * (energy[k] - energy[k+1])
+            accept = math.log(self._uniform("swap")) < log_accept_prob
+            if accept:
+                perm[k], perm[k+1] = k+1, k
+            names += self._swap_metric_names(k)
+            values += [min(1., math.exp(min(log_accept_prob, 0.))), int(accept)]
+        # The potentials are those of the metrics of the previous step
+        self.metrics_saver.add_scalars(names, np.array(values, dtype=np.float64),
+                                       self._step_index - 1)
+        if (perm == np.arange(self.num_chains)).all():
+            return None
+        return torch.from_numpy(perm).to(self._params[0].device)
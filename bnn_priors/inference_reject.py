@@ -13,28 +13,26 @@ class VerletSGLDRunnerReject(SGLDRunner):
         return mcmc.VerletSGLD(
             params=params,
             lr=self.learning_rate, num_data=self.eff_num_data,
-            momentum=self.momentum, temperature=self.temperature)
-
-    def _exact_model_potential_and_grad(self, dataloader):
-        self.optimizer.zero_grad()
-        log_prior = self.model.log_prior()
-        log_norm_prior = log_prior / -self.eff_num_data
-        log_norm_prior.backward()
-
-        loss = 0.
-        for x, y in dataloader:
-            this_loss = self.model.log_likelihood(x.to(self._params[0].device),
-                                                  y.to(self._params[0].device),
-                                                  -x.size(0)/self.eff_num_data)
-            this_loss.backward()
-            loss = loss + this_loss
-
-        potential = loss + log_norm_prior
-        return loss, log_prior, potential
-
-    def run(self, progressbar=False):
+            momentum=self.momentum, temperature=self.temperature,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            num_chains=self.num_chains, splitting=self.splitting, rng=self.rng)
+
+    def run(self, progressbar=False, resume=False):
+        assert self.num_chains is None, "the Reject runners only sample one chain"
+        checkpoint = self._start_run(resume)
         self.optimizer = self._make_optimizer(self._params)
         self.scheduler = self._make_scheduler(self.optimizer)
+        if self.mh_test == "sequential":
+            assert isinstance(self.optimizer, mcmc.VerletSGLD), \
+                "the sequential M-H test needs an optimizer with an energy error"
+        # The sequential M-H test compares with the saved parameters, even if
+        # it does not reject
+        save_state = self.reject_samples or self.mh_test == "sequential"
+        if self.adapt_lr:
+            assert isinstance(self.optimizer, mcmc.VerletSGLD), \
+                "`adapt_lr` needs an optimizer with an energy error"
+            self._lr_adapter = mcmc.DualAveragingStepSize(
+                self.learning_rate, target_accept=self.target_accept)
 
         if progressbar:
             progressbar = tqdm.tqdm(total=self.cycles*self.epochs_per_cycle, mininterval=2.0)
@@ -53,25 +51,52 @@ class VerletSGLDRunnerReject(SGLDRunner):
             sampling_epoch = _epoch - (self.descent_epochs + self.warmup_epochs)
             return (0 <= sampling_epoch) and (sampling_epoch % self.skip == 0)
 
-        # Use an exact gradient for the initial step and loss
-        loss, log_prior, potential = self._exact_model_potential_and_grad(self.dataloader)
-        self.optimizer.sample_momentum()
-        self.optimizer.initial_step(calc_metrics=True, save_state=self.reject_samples)
-        step = 0
-        self.store_metrics(i=step, loss=loss.item(), log_prior=log_prior.item(),
-                           potential=potential.item(), acc=0.,
-                           lr=self.optimizer.param_groups[0]["lr"], corresponds_to_sample=True,
-                           delta_energy=0., total_energy=0., rejected=False)
-        self._initial_potential = potential.item()
-        self._total_energy = 0.
+        def _is_adapting_epoch(_epoch):
+            "Are we adapting the learning rate with an M-H test at the end of this epoch?"
+            warmup_epoch = _epoch % self.epochs_per_cycle - self.descent_epochs
+            return self.adapt_lr and 0 <= warmup_epoch < self.warmup_epochs
+
+        if self.mh_test == "sequential":
+            # Random subsets of the data for the M-H test, without replacement
+            self._mh_dataloader = torch.utils.data.DataLoader(
+                self.dataloader.dataset, shuffle=True,
+                batch_size=(self.mh_test_batch_size or self.dataloader.batch_size),
+                generator=(None if self.rng is None else self.rng.generator("mh_data")))
+
+        if checkpoint is None:
+            if self.mh_test == "sequential":
+                x, y = next(iter(self._mh_dataloader))
+                loss, log_prior, potential, _ = self._model_potential_and_grad(
+                    x.to(self._params[0].device), y.to(self._params[0].device))
+            else:
+                # Use an exact gradient for the initial step and loss
+                loss, log_prior, potential = self._exact_model_potential_and_grad(self.dataloader)
+            self.optimizer.sample_momentum()
+            self.optimizer.initial_step(calc_metrics=True, save_state=save_state)
+            step = 0
+            self.store_metrics(i=step, loss=loss.item(), log_prior=log_prior.item(),
+                               potential=potential.item(), acc=0.,
+                               lr=self.optimizer.param_groups[0]["lr"], corresponds_to_sample=True,
+                               delta_energy=0., total_energy=0., rejected=False)
+            self._initial_potential = potential.item()
+            self._total_energy = 0.
+            start_cycle, start_epoch = 0, 0
 
         assert self.dataloader.sampler.generator is None
-        generator = self.dataloader.sampler.generator = torch.Generator()
+        generator = self.dataloader.sampler.generator = (
+            torch.Generator() if self.rng is None else self.rng.generator("data"))
+        if checkpoint is not None:
+            step, start_cycle, start_epoch = self._load_checkpoint(checkpoint)
+            if progressbar:
+                progressbar.update(start_cycle*self.epochs_per_cycle + start_epoch)
         postfix = {}
-        for cycle in range(self.cycles):
-            generator.seed()
-            cycle_random_state = generator.get_state()
-            for epoch in range(self.epochs_per_cycle):
+        for cycle in range(start_cycle, self.cycles):
+            first_epoch = (start_epoch if cycle == start_cycle else 0)
+            if first_epoch == 0:
+                if self.rng is None:
+                    generator.seed()
+                self._cycle_random_state = generator.get_state()
+            for epoch in range(first_epoch, self.epochs_per_cycle):
                 if epoch < self.descent_epochs:
                     _enter_epoch(f"Cycle {cycle}, epoch {epoch}, Descent", 0.)
                 elif epoch - self.descent_epochs < self.warmup_epochs:
@@ -79,9 +104,11 @@ class VerletSGLDRunnerReject(SGLDRunner):
                 else:
                     _enter_epoch(f"Cycle {cycle}, epoch {epoch}, Sampling", self.temperature)
 
+                self._maybe_update_anchor(epoch)
+
                 # Run one epoch of potentially-stochastic gradient descent
                 # make sure the epochs' data points are always in the same order for this cycle.
-                generator.set_state(cycle_random_state)
+                generator.set_state(self._cycle_random_state)
 
                 for i, (x, y) in enumerate(self.dataloader):
                     step += 1
@@ -113,18 +140,25 @@ class VerletSGLDRunnerReject(SGLDRunner):
                         self.scheduler.step()
 
 
-                if _is_sampling_epoch(epoch):
+                is_sample = _is_sampling_epoch(epoch)
+                adapting = _is_adapting_epoch(epoch)
+                if is_sample or adapting:
                     step += 1
-                    # Do the sample's `final_step` using an exact gradient
-                    loss, log_prior, potential = self._exact_model_potential_and_grad(self.dataloader)
-                    self.optimizer.final_step(calc_metrics=True)
-                    delta_energy = self.optimizer.delta_energy(self._initial_potential, potential)
+                    # Do the `final_step` of the sample, or of the M-H test for
+                    # adapting the learning rate, using an exact gradient (or a
+                    # minibatch one, for the sequential test)
+                    if self.mh_test == "sequential":
+                        loss, log_prior, potential, delta_energy, rejected = (
+                            self._sequential_mh_test(step))
+                    else:
+                        loss, log_prior, potential = self._exact_model_potential_and_grad(self.dataloader)
+                        self.optimizer.final_step(calc_metrics=True)
+                        delta_energy = self.optimizer.delta_energy(self._initial_potential, potential)
+                        rejected = False
+                        if self.reject_samples:
+                            rejected, _ = self.optimizer.maybe_reject(delta_energy)
                     self._total_energy += delta_energy
                     self._initial_potential = potential.item()
-
-                    rejected = False
-                    if self.reject_samples:
-                        rejected, _ = self.optimizer.maybe_reject(delta_energy)
                     self.store_metrics(i=step,
                                        loss=loss.item(),
                                        log_prior=log_prior.item(),
@@ -132,16 +166,21 @@ class VerletSGLDRunnerReject(SGLDRunner):
                                        # TODO: do not use stale `acc`, calculate for full training set
                                        acc=acc.item(),
                                        lr=self.optimizer.param_groups[0]["lr"],
-                                       corresponds_to_sample=True,
+                                       corresponds_to_sample=is_sample,
                                        delta_energy=delta_energy,
                                        total_energy=self._total_energy,
                                        rejected=rejected)
+                    if adapting:
+                        last_warmup_epoch = (epoch+1) % self.epochs_per_cycle == (
+                            self.descent_epochs + self.warmup_epochs)
+                        self._adapt_lr(delta_energy, step, freeze=last_warmup_epoch)
 
                     # Evaluate test accuracy and save to disk the current sample
                     # (correctly rolled back to the previous if rejected)
                     state_dict = self.model.state_dict()
                     eval_results = self._evaluate_model(state_dict, step)
-                    self._save_sample(state_dict, cycle, epoch, step)
+                    if is_sample:
+                        self._save_sample(state_dict, cycle, epoch, step)
                     if progressbar:
                         postfix.update(eval_results)
                         postfix["train/loss"] = loss.item()
@@ -154,9 +193,9 @@ class VerletSGLDRunnerReject(SGLDRunner):
                     if isinstance(self.optimizer, mcmc.HMC):
                         self.optimizer.sample_momentum()
                     self.optimizer.initial_step(
-                        calc_metrics=False, save_state=self.reject_samples)
+                        calc_metrics=False, save_state=save_state)
 
-                else:  # Not an epoch that stores a sample at the end
+                else:  # Not an epoch that ends with an M-H test
                     # Evaluate test accuracy every epoch
                     eval_results = self._evaluate_model(self.model.state_dict(), step)
                     if progressbar:
@@ -171,12 +210,82 @@ class VerletSGLDRunnerReject(SGLDRunner):
                 # Important to put here because no new metrics are added
                 # Write metrics to disk every 30 seconds
                 self.metrics_saver.flush(every_s=30)
+                self._maybe_checkpoint(cycle, epoch, step)
 
                 if progressbar:
                     progressbar.update(1)
         # Close the progressbar at the end of the training procedure
         if progressbar:
             progressbar.close()
+        self._finish_run()
+
+    def _log_likelihoods(self, x, y):
+        "log p(y_i | x_i, params) for every data point in the batch"
+        with self._autocast():
+            log_prob = self.model(x).log_prob(y)
+        return log_prob.reshape(log_prob.size(0), -1).sum(1)
+
+    def _sequential_mh_test(self, step):
+        """The `final_step` and M-H test with a minibatch gradient, deciding
+        from as many random batches of data as `mcmc.SequentialMHTest` needs.
+        Returns the loss, log-prior and potential of the first batch, the
+        estimated energy difference, and whether the proposal was rejected."""
+        device = self._params[0].device
+        batches = ((x.to(device), y.to(device)) for x, y in self._mh_dataloader)
+        x, y = next(batches)
+        loss, log_prior, potential, _ = self._model_potential_and_grad(x, y)
+        self.optimizer.final_step(calc_metrics=True)
+        # Energy difference of the integrator, without the potential
+        energy_terms = self.optimizer.delta_energy(0., 0.)
+
+        # Accept if the mean difference of log-likelihood is larger than `mu0`
+        temperature = self.optimizer.param_groups[0]["temperature"]
+        prev_params = dict(zip(self.param_names, (
+            p.to(device) for p in self.optimizer.saved_parameters())))
+        with torch.no_grad():
+            with self.model.using_params(prev_params):
+                prev_log_prior = self.model.log_prior().item()
+            delta_log_prior = log_prior.item() - prev_log_prior
+            if temperature == 0.:
+                mu0 = -math.inf  # Never reject
+            else:
+                log_u = math.log(self._uniform("mh_test"))
+                mu0 = (temperature*log_u - delta_log_prior + energy_terms) / self.eff_num_data
+            test = mcmc.SequentialMHTest(mu0, len(self._mh_dataloader.dataset),
+                                         error=self.mh_test_error)
+            accept = None
+            while accept is None:
+                diffs = self._log_likelihoods(x, y)
+                with self.model.using_params(prev_params):
+                    diffs -= self._log_likelihoods(x, y)
+                accept = test.add(diffs.to(device="cpu", dtype=torch.float64).numpy())
+                if accept is None:
+                    x, y = next(batches)
+
+        delta_energy = energy_terms - delta_log_prior - self.eff_num_data * test.mean
+        rejected = self.reject_samples and not accept
+        if rejected:
+            self.optimizer.reject()
+        self.metrics_saver.add_scalar("acceptance/mh_test_data", test.n, step)
+        return loss, log_prior, potential, delta_energy, rejected
+
+    def _adapt_lr(self, delta_energy, step, freeze):
+        """Update the learning rate with the acceptance probability of the last
+        M-H test. If `freeze`, set it to the final average of the adaptation."""
+        temperature = self.optimizer.param_groups[0]["temperature"]
+        log_accept_prob = 0. if temperature == 0. else -delta_energy / temperature
+        accept_prob = math.exp(min(0., log_accept_prob))
+        lr = self._lr_adapter.update(accept_prob)
+        if freeze:
+            lr = self._lr_adapter.final_step_size()
+
+        # The scheduler multiplies `base_lrs` by the schedule
+        for g, base_lr in zip(self.optimizer.param_groups, self.scheduler.base_lrs):
+            g['lr'] *= lr / base_lr
+        self.scheduler.base_lrs = [lr for _ in self.scheduler.base_lrs]
+
+        self.metrics_saver.add_scalar("acceptance/accept_prob", accept_prob, step)
+        self.metrics_saver.add_scalar("adapted_lr", lr, step)
 
 
 class HMCRunnerReject(VerletSGLDRunnerReject):
@@ -186,7 +295,9 @@ class HMCRunnerReject(VerletSGLDRunnerReject):
         assert self.descent_epochs == 0, "HMC not implemented for descent epochs with temp=0."
         return mcmc.HMC(
             params=params,
-            lr=self.learning_rate, num_data=self.eff_num_data)
+            lr=self.learning_rate, num_data=self.eff_num_data,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            num_chains=self.num_chains, rng=self.rng)
 
 class SGLDRunnerReject(VerletSGLDRunnerReject):
     def _make_optimizer(self, params):
@@ -195,4 +306,124 @@ class SGLDRunnerReject(VerletSGLDRunnerReject):
         return mcmc.SGLD(
             params=params,
             lr=self.learning_rate, num_data=self.eff_num_data,
-            momentum=self.momentum, temperature=self.temperature)
+            momentum=self.momentum, temperature=self.temperature,
+            fused=self.fused, flat=self.flat, precond_type=self.precond_type,
+            num_chains=self.num_chains, rng=self.rng)
+
+
+class FullBatchHMCRunner(HMCRunnerReject):
+    """HMC with the gradient of the whole training set, and `n_leapfrog`
+    leapfrog steps per proposal. The proposal is followed by an M-H test,
+    which rejects it if `reject_samples`.
+
+    Here an epoch is one HMC trajectory. Every epoch starts by resampling the
+    momentum, and the samples are stored at the end of sampling epochs. The
+    learning rate schedule advances once per trajectory; `sampling_decay="flat"`
+    gives the usual constant step size. With `adapt_lr`, the step size is
+    adapted during the warmup epochs.
+
+    The batches of `dataloader` are copied to the device once, and the
+    gradient at the end of a trajectory is the initial gradient of the next
+    one (or the saved one, if the proposal is rejected). So each trajectory
+    costs `n_leapfrog` full-batch gradients. The sampler state is flat by
+    default.
+
+    Args:
+        n_leapfrog (int): number of leapfrog steps in each trajectory. The
+            trajectory length is `n_leapfrog` times the step size.
+        All other arguments are as in `SGLDRunner`.
+    """
+    def __init__(self, *args, n_leapfrog=32, flat=True, **kwargs):
+        super().__init__(*args, flat=flat, **kwargs)
+        assert n_leapfrog >= 1
+        self.n_leapfrog = n_leapfrog
+
+    def _steps_per_epoch(self):
+        return 1
+
+    def run(self, progressbar=False, resume=False):
+        assert self.num_chains is None, "the full-batch HMC runner samples one chain"
+        assert self.mh_test == "exact", "the full-batch HMC runner does an exact M-H test"
+        assert not self.control_variate, "the full-batch gradient needs no control variate"
+        checkpoint = self._start_run(resume)
+        self.optimizer = self._make_optimizer(self._params)
+        self.scheduler = self._make_scheduler(self.optimizer)
+        if self.adapt_lr:
+            self._lr_adapter = mcmc.DualAveragingStepSize(
+                self.learning_rate, target_accept=self.target_accept)
+
+        device = self._params[0].device
+        full_batch = [(x.to(device), y.to(device)) for x, y in self.dataloader]
+
+        if progressbar:
+            progressbar = tqdm.tqdm(total=self.cycles*self.epochs_per_cycle, mininterval=2.0)
+
+        def _is_sampling_epoch(_epoch):
+            sampling_epoch = _epoch - (self.descent_epochs + self.warmup_epochs)
+            return (0 <= sampling_epoch) and (sampling_epoch % self.skip == 0)
+
+        step = -1
+        start_cycle, start_epoch = 0, 0
+        self._total_energy = 0.
+        if checkpoint is not None:
+            step, start_cycle, start_epoch = self._load_checkpoint(checkpoint)
+            if progressbar:
+                progressbar.update(start_cycle*self.epochs_per_cycle + start_epoch)
+        loss, log_prior, potential = self._exact_model_potential_and_grad(full_batch)
+        postfix = {}
+        for cycle in range(start_cycle, self.cycles):
+            for epoch in range(start_epoch if cycle == start_cycle else 0, self.epochs_per_cycle):
+                step += 1
+                prev_loss, prev_log_prior, prev_potential = loss, log_prior, potential
+
+                # One trajectory of `n_leapfrog` steps
+                self.optimizer.sample_momentum()
+                self.optimizer.initial_step(calc_metrics=True, save_state=self.reject_samples)
+                for _ in range(self.n_leapfrog - 1):
+                    self._exact_model_potential_and_grad(full_batch)
+                    self.optimizer.step(calc_metrics=False)
+                loss, log_prior, potential = self._exact_model_potential_and_grad(full_batch)
+                self.optimizer.final_step(calc_metrics=True)
+
+                delta_energy = self.optimizer.delta_energy(prev_potential, potential)
+                self._total_energy += delta_energy
+                rejected = False
+                if self.reject_samples:
+                    rejected, _ = self.optimizer.maybe_reject(delta_energy)
+                    if rejected:
+                        # `maybe_reject` restored the parameters and gradient
+                        loss, log_prior, potential = prev_loss, prev_log_prior, prev_potential
+
+                is_sample = _is_sampling_epoch(epoch)
+                loss_, log_prior_, potential_ = self._to_host(loss, log_prior, potential)
+                self.store_metrics(i=step, loss=loss_, log_prior=log_prior_,
+                                   potential=potential_, acc=math.nan,
+                                   lr=self.optimizer.param_groups[0]["lr"],
+                                   corresponds_to_sample=is_sample,
+                                   delta_energy=delta_energy,
+                                   total_energy=self._total_energy,
+                                   rejected=rejected)
+                if self.adapt_lr and epoch < self.warmup_epochs:
+                    self._adapt_lr(delta_energy, step,
+                                   freeze=(epoch == self.warmup_epochs - 1))
+
+                state_dict = self.model.state_dict()
+                eval_results = self._evaluate_model(state_dict, step)
+                if is_sample:
+                    self._save_sample(state_dict, cycle, epoch, step)
+                self.scheduler.step()
+
+                if self.precond_update is not None and (epoch+1) % self.precond_update == 0:
+                    self.optimizer.update_preconditioner()
+                self.metrics_saver.flush(every_s=30)
+                self._maybe_checkpoint(cycle, epoch, step)
+
+                if progressbar:
+                    postfix.update(eval_results)
+                    postfix["train/loss"] = loss_
+                    postfix["Δₑ"] = delta_energy
+                    progressbar.set_postfix(postfix, refresh=False)
+                    progressbar.update(1)
+        if progressbar:
+            progressbar.close()
+        self._finish_run()
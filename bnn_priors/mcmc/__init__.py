@@ -1,3 +1,10 @@
+from .flat import FlatArena
 from .hmc import HMC
 from .sgld import SGLD
 from .verlet_sgld import VerletSGLD
+from .dual_averaging import DualAveragingStepSize
+from .snapshot import StateSnapshot
+from .sequential_test import SequentialMHTest
+from .saga import SAGALD
+from .sgnht import SGNHT
+from .rng import RNGStreams
@@ -0,0 +1,49 @@
+import math
+
+
+class DualAveragingStepSize:
+    """Nesterov dual averaging of the log step size towards a target acceptance
+    probability, as in Algorithm 5 of Hoffman & Gelman (2014), "The No-U-Turn
+    Sampler".
+
+    Call `update` after every M-H test with its acceptance probability, and
+    use the returned step size for the next proposal. After adaptation, use
+    `final_step_size`, the weighted average of the iterates.
+
+    Args:
+        initial_step_size (float): the step size to start from
+        target_accept (float): the acceptance probability to aim for
+        gamma (float): how much the iterates can move away from `mu`
+        t0 (float): makes the first iterations less important
+        kappa (float): decay of the weight of the iterates in the average
+        mu (float): log step size the iterates are pulled towards. Defaults
+            to log(10 * initial_step_size).
+    """
+    def __init__(self, initial_step_size: float, target_accept: float=0.8,
+                 gamma: float=0.05, t0: float=10., kappa: float=0.75, mu: float=None):
+        assert initial_step_size > 0 and 0 < target_accept < 1
+        self.target_accept = target_accept
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+        self.mu = math.log(10 * initial_step_size) if mu is None else mu
+        self.t = 0
+        self.h_bar = 0.
+        self.log_step_size = math.log(initial_step_size)
+        self.log_step_size_avg = 0.
+
+    def update(self, accept_prob: float) -> float:
+        "Updates the estimate with the result of one M-H test, returns the new step size"
+        self.t += 1
+        eta = 1 / (self.t + self.t0)
+        self.h_bar = (1 - eta) * self.h_bar + eta * (self.target_accept - accept_prob)
+        self.log_step_size = self.mu - math.sqrt(self.t) / self.gamma * self.h_bar
+        eta = self.t ** -self.kappa
+        self.log_step_size_avg = eta * self.log_step_size + (1 - eta) * self.log_step_size_avg
+        return math.exp(self.log_step_size)
+
+    def final_step_size(self) -> float:
+        "The step size to use after adaptation"
+        if self.t == 0:
+            return math.exp(self.log_step_size)
+        return math.exp(self.log_step_size_avg)
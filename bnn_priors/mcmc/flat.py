@@ -0,0 +1,117 @@
+import torch
+from typing import Sequence, Dict, List, Optional
+
+
+class FlatArena:
+    """Contiguous storage for a group of parameters, their gradients, and the
+    per-parameter buffers of an optimizer.
+
+    The `.data` and `.grad` of every parameter become views into one flat
+    tensor each, so an update of the whole group is a single operation. This
+    also holds for parameters of `Prior` modules: their `.p` is still the same
+    `nn.Parameter`, but its data now lives in the arena.
+
+    Something that assigns a new tensor to `.data` or `.grad` (for example
+    `Prior.sample` or `Module.zero_grad(set_to_none=True)`) breaks the link to
+    the arena. `sync_` copies the new values in and restores the views.
+
+    Args:
+        params (sequence of torch.Tensor): parameters, all with the same dtype
+            and device.
+    """
+    def __init__(self, params: Sequence[torch.Tensor]):
+        self.params = list(params)
+        assert len(self.params) > 0, "cannot make an arena with no parameters"
+        p0 = self.params[0]
+        assert all(p.dtype == p0.dtype and p.device == p0.device for p in self.params),\
+            "all parameters in an arena must have the same dtype and device"
+        self.shapes = [p.shape for p in self.params]
+        self.numels = [p.numel() for p in self.params]
+
+        with torch.no_grad():
+            self.param = torch.cat([p.detach().reshape(-1) for p in self.params])
+        self.grad = torch.zeros_like(self.param)
+        self.buffers: Dict[str, torch.Tensor] = {}
+        # Accumulators of the optimizer for the whole group, e.g. energy terms
+        self.group_state: Dict[str, torch.Tensor] = {}
+        # Per-parameter values that the `preconditioner` buffer was filled with
+        self.preconditioner_values: Optional[List[float]] = None
+        self.numel_tensor = torch.tensor(self.numels, dtype=self.param.dtype,
+                                         device=self.param.device)
+        self._lengths = torch.tensor(self.numels, dtype=torch.int64,
+                                     device=self.param.device)
+        self._param_views = self.views(self.param)
+        self._grad_views = self.views(self.grad)
+        self.link_()
+
+    def __len__(self):
+        return self.param.numel()
+
+    def views(self, flat: torch.Tensor) -> List[torch.Tensor]:
+        "Split `flat` into views with the shape of each parameter"
+        return [v.view(shape) for v, shape in zip(flat.split(self.numels), self.shapes)]
+
+    def segment_sum(self, flat: torch.Tensor) -> torch.Tensor:
+        "Sum of `flat` over the elements of each parameter, in one tensor"
+        segment_reduce = getattr(torch, "segment_reduce", None)
+        if segment_reduce is None:
+            return torch.stack([v.sum() for v in flat.split(self.numels)])
+        return segment_reduce(flat, "sum", lengths=self._lengths)
+
+    def buffer(self, name: str, fill: Optional[float]=None,
+               device: Optional[torch.device]=None) -> torch.Tensor:
+        """Returns the flat buffer `name`, creating it if it does not exist.
+        New buffers are filled with `fill`, or left uninitialized if it is
+        None."""
+        try:
+            return self.buffers[name]
+        except KeyError:
+            buf = torch.empty(len(self), dtype=self.param.dtype,
+                              device=(self.param.device if device is None else device))
+            if fill is not None:
+                buf.fill_(fill)
+            self.buffers[name] = buf
+            return buf
+
+    @torch.no_grad()
+    def link_(self):
+        "Make `.data` and `.grad` of every parameter views into the arena"
+        for p, v, g in zip(self.params, self._param_views, self._grad_views):
+            p.data = v
+            p.grad = g
+
+    @torch.no_grad()
+    def set_storage_(self, param: torch.Tensor, grad: torch.Tensor):
+        """Use the flat tensors `param` and `grad` as the storage of the arena,
+        without copying. The parameters become views into them."""
+        if param is self.param and grad is self.grad:
+            return
+        self.param, self.grad = param, grad
+        self._param_views = self.views(self.param)
+        self._grad_views = self.views(self.grad)
+        self.link_()
+
+    @torch.no_grad()
+    def sync_(self, raise_on_no_grad: bool=True):
+        """Copy any `.data` or `.grad` that is no longer a view into the arena,
+        and restore the view. Missing gradients are zero, unless
+        `raise_on_no_grad`."""
+        for p, v, g in zip(self.params, self._param_views, self._grad_views):
+            if p.data.data_ptr() != v.data_ptr():
+                v.copy_(p.data)
+                p.data = v
+            if p.grad is None:
+                if raise_on_no_grad:
+                    raise RuntimeError(
+                        f"No gradient for parameter with shape {p.shape}")
+                g.zero_()
+                p.grad = g
+            elif p.grad.data_ptr() != g.data_ptr():
+                g.copy_(p.grad)
+                p.grad = g
+
+    @torch.no_grad()
+    def zero_grad_(self):
+        self.grad.zero_()
+        for p, g in zip(self.params, self._grad_views):
+            p.grad = g
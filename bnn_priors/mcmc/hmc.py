@@ -3,8 +3,9 @@ import math
 from typing import Sequence, Optional, Callable, Tuple, Dict, Union
 import typing
 
-from .sgld import dot
+from .sgld import dot_tensor, precond_add_, scaled_addcmul_
 from .verlet_sgld import VerletSGLD
+from .rng import RNGStreams
 
 
 class HMC(VerletSGLD):
@@ -21,16 +22,36 @@ class HMC(VerletSGLD):
         raise_on_no_grad (bool): whether to complain if a parameter does not
                                  have a gradient
         raise_on_nan: whether to complain if a gradient is not all finite.
+        fused (bool): update all the parameters of a group at once, using
+                      multi-tensor `torch._foreach_*` operations.
+        flat (bool): store the parameters, gradients and sampler state of each
+                     group in a contiguous `FlatArena`.
+        precond_type (str): "scalar" or "elementwise", see `SGLD`.
+        num_chains (int): number of chains along the leading dimension of the
+                     parameters, see `SGLD`.
+        snapshot_placement (str): where to keep the state saved for rejection,
+                     see `VerletSGLD`.
+        rng (RNGStreams): draw the momenta and M-H tests from these streams,
+                     see `SGLD`.
     """
     def __init__(self, params: Sequence[Union[torch.nn.Parameter, Dict]],
                  lr: float, num_data: int,
-                 raise_on_no_grad: bool=True, raise_on_nan: bool=True):
+                 raise_on_no_grad: bool=True, raise_on_nan: bool=True,
+                 fused: bool=False, flat: bool=False, precond_type: str="scalar",
+                 num_chains: Optional[int]=None, snapshot_placement: str="auto",
+                 rng: Optional[RNGStreams]=None):
         super().__init__(params, lr, num_data, 1., 1.,
                          raise_on_no_grad=raise_on_no_grad,
-                         raise_on_nan=raise_on_nan)
+                         raise_on_nan=raise_on_nan, fused=fused, flat=flat,
+                         precond_type=precond_type, num_chains=num_chains,
+                         snapshot_placement=snapshot_placement, rng=rng)
 
-    def _point_energy(self, group, p, state):
-        return .5 * dot(state['momentum_buffer'], state['momentum_buffer'])
+    def _point_energy(self, group, p, state) -> torch.Tensor:
+        return .5 * self._dot(state['momentum_buffer'], state['momentum_buffer'])
+
+    def _flat_point_energy(self, group, arena) -> torch.Tensor:
+        momentum = arena.buffers['momentum_buffer']
+        return .5 * dot_tensor(momentum, momentum)
 
     def _update_group_fn(self, g):
         # Ensure momentum and temperature are correct at every step
@@ -38,6 +59,9 @@ class HMC(VerletSGLD):
         super()._update_group_fn(g)
         assert g['momentum'] == 1. and g['temperature'] == 1.
 
+    def _draws_step_noise(self, group) -> bool:
+        return False
+
     def _step_fn(self, group, p, state, is_initial=False, is_final=False,
                  save_state=False, calc_metrics=True):
         if save_state:
@@ -46,34 +70,110 @@ class HMC(VerletSGLD):
         M_rsqrt = self._preconditioner_default(state, p)
         momentum = state['momentum_buffer']
 
+        d = self._numel(p)
         if is_initial:
-            mom_dot = dot(momentum, momentum)
+            mom_dot = self._dot(momentum, momentum)
             # Subtract initial kinetic energy from delta_energy
             state['delta_energy'] = -.5 * mom_dot
             if calc_metrics:
-                state['est_temperature'] = mom_dot / p.numel()
+                state['est_temperature'] = mom_dot / d
 
         if calc_metrics:
             # Temperature diagnostics
-            d = p.numel()
             if not is_final and not is_initial:
-                state['est_temperature'] = dot(momentum, momentum) / d
+                state['est_temperature'] = self._dot(momentum, momentum) / d
             # NOTE: p and p.grad are from the same time step
-            state['est_config_temp'] = dot(p, p.grad) * (group['num_data']/d)
+            state['est_config_temp'] = self._dot(p, p.grad) * (group['num_data']/d)
 
         # Gradient step on the momentum
-        grad_lr = -.5 * group['grad_v'] * group['bhn'] * M_rsqrt
-        momentum.add_(p.grad, alpha=grad_lr)
+        precond_add_(momentum, M_rsqrt, p.grad, -.5 * group['grad_v'] * group['bhn'])
 
         if is_final:
             if calc_metrics:
                 # If it is the final step, p and p.grad correspond to the same time
                 # step as the updated momentum
-                state['est_temperature'] = dot(momentum, momentum) / p.numel()
+                state['est_temperature'] = self._dot(momentum, momentum) / d
         else:
             # Update the parameters:
-            p.add_(momentum, alpha=group['bh']*M_rsqrt)
+            precond_add_(p, M_rsqrt, momentum, group['bh'])
 
             # RMSProp moving average
             alpha = group['rmsprop_alpha']
             state['square_avg'].mul_(alpha).addcmul_(p.grad, p.grad, value=1 - alpha)
+
+    def _fused_step_fn(self, group, params, states, is_initial=False,
+                       is_final=False, save_state=False, calc_metrics=True):
+        "Same as `_step_fn`, but for all the parameters in `group` at once."
+        if len(params) == 0:
+            return
+        if save_state:
+            for p, state in zip(params, states):
+                self._save_state(group, p, state)
+
+        M_rsqrt = [self._preconditioner_default(s, p) for p, s in zip(params, states)]
+        grads = [p.grad for p in params]
+        momenta = [s['momentum_buffer'] for s in states]
+
+        for p, state, momentum in zip(params, states, momenta):
+            d = p.numel()
+            if is_initial:
+                mom_dot = dot_tensor(momentum, momentum)
+                # Subtract initial kinetic energy from delta_energy
+                state['delta_energy'] = -.5 * mom_dot
+                if calc_metrics:
+                    state['est_temperature'] = mom_dot / d
+            if calc_metrics:
+                if not is_final and not is_initial:
+                    state['est_temperature'] = dot_tensor(momentum, momentum) / d
+                # NOTE: p and p.grad are from the same time step
+                state['est_config_temp'] = dot_tensor(p, p.grad) * (group['num_data']/d)
+
+        # Gradient step on the momentum
+        torch._foreach_add_(momenta, torch._foreach_mul(grads, M_rsqrt),
+                            alpha=-.5 * group['grad_v'] * group['bhn'])
+
+        if is_final:
+            if calc_metrics:
+                for p, state, momentum in zip(params, states, momenta):
+                    state['est_temperature'] = dot_tensor(momentum, momentum) / p.numel()
+        else:
+            # Update the parameters:
+            torch._foreach_add_(params, torch._foreach_mul(momenta, M_rsqrt),
+                                alpha=group['bh'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            square_avgs = [s['square_avg'] for s in states]
+            torch._foreach_mul_(square_avgs, alpha)
+            torch._foreach_addcmul_(square_avgs, grads, grads, value=1 - alpha)
+
+    def _flat_step_fn(self, group, arena, states, is_initial=False,
+                      is_final=False, save_state=False, calc_metrics=True):
+        "Same as `_step_fn`, but with a few operations on the whole `arena`."
+        if save_state:
+            self._save_flat_state(group, arena)
+        M_rsqrt, _ = self._flat_preconditioner(arena, states)
+        momentum = arena.buffers['momentum_buffer']
+
+        if is_initial:
+            # Subtract initial kinetic energy from delta_energy
+            arena.group_state['delta_energy'] = -self._flat_point_energy(group, arena)
+
+        if calc_metrics and not is_final:
+            self._flat_temperature_metrics(group, arena, states, momentum)
+
+        # Gradient step on the momentum
+        scaled_addcmul_(momentum, arena.grad, M_rsqrt, -.5 * group['grad_v'] * group['bhn'])
+
+        if is_final:
+            if calc_metrics:
+                # If it is the final step, p and p.grad correspond to the same time
+                # step as the updated momentum
+                self._flat_temperature_metrics(group, arena, states, momentum)
+        else:
+            # Update the parameters:
+            scaled_addcmul_(arena.param, momentum, M_rsqrt, group['bh'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            arena.buffers['square_avg'].mul_(alpha).addcmul_(arena.grad, arena.grad, value=1 - alpha)
@@ -0,0 +1,81 @@
+import hashlib
+import torch
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+
+class RNGStreams:
+    """Independent streams of random numbers, one for each key, e.g. a purpose
+    ("step", "momentum", "reject", "data"), a parameter group and a chain.
+
+    Each stream is an independent `torch.Generator`, seeded from a hash of
+    `seed` and its key. The numbers of a stream depend only on the key and on
+    how many numbers were drawn from it before, not on how the work is ordered
+    or split among other streams. The streams are not counter-based: a stream
+    cannot skip ahead or be split, it has to be drawn from in order. (torch's
+    CUDA generators happen to be Philox, but the CPU ones are Mersenne
+    twisters.)
+
+    Args:
+        seed (int): seed of all the streams
+    """
+    def __init__(self, seed: int):
+        self.seed = seed
+        self._generators: Dict[Tuple[Tuple, str], torch.Generator] = {}
+
+    def _key_seed(self, key: Tuple) -> int:
+        digest = hashlib.sha256(repr((self.seed, key)).encode()).digest()
+        return int.from_bytes(digest[:8], "little") & (2**63 - 1)
+
+    def generator(self, *key: Hashable, device="cpu") -> torch.Generator:
+        "The generator of stream `key` on `device`, created at the first call"
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        k = (key, str(device))
+        try:
+            return self._generators[k]
+        except KeyError:
+            g = self._generators[k] = torch.Generator(device=device)
+            g.manual_seed(self._key_seed(key))
+            return g
+
+    def normal_like(self, tensors: Sequence[torch.Tensor], *key: Hashable,
+                    num_chains: Optional[int]=None) -> List[torch.Tensor]:
+        """Standard normal noise like each of `tensors`, drawn with one call
+        from stream `key`. With `num_chains`, the leading dimension of the
+        tensors is the chain, and chain `c` draws from stream `(*key, c)`: one
+        call per chain, in a Python loop."""
+        t0 = tensors[0]
+        kwargs = dict(dtype=t0.dtype, device=t0.device)
+        if num_chains is None:
+            numels = [t.numel() for t in tensors]
+            flat = torch.randn(sum(numels), generator=self.generator(*key, device=t0.device),
+                               **kwargs)
+            return [v.view(t.shape) for v, t in zip(flat.split(numels), tensors)]
+
+        numels = [t.numel() // num_chains for t in tensors]
+        flat = torch.empty((num_chains, sum(numels)), **kwargs)
+        for c in range(num_chains):
+            torch.randn(sum(numels), generator=self.generator(*key, c, device=t0.device),
+                        out=flat[c], **kwargs)
+        return [v.reshape(t.shape) for v, t in zip(flat.split(numels, dim=1), tensors)]
+
+    def uniform(self, *key: Hashable) -> float:
+        "One number from U(0, 1), drawn on the CPU from stream `key`"
+        return torch.rand((), generator=self.generator(*key), dtype=torch.float64).item()
+
+    def state_dict(self) -> Dict:
+        return {"seed": self.seed,
+                "streams": [(key, device, g.get_state())
+                            for (key, device), g in self._generators.items()]}
+
+    def load_state_dict(self, state_dict: Dict):
+        """Restore the seed and the position of every stream. The generators
+        that were already handed out are restored in place."""
+        self.seed = state_dict["seed"]
+        states = {(tuple(key), device): state for key, device, state in state_dict["streams"]}
+        for (key, device), g in self._generators.items():
+            if (key, device) not in states:
+                g.manual_seed(self._key_seed(key))
+        for (key, device), state in states.items():
+            self.generator(*key, device=device).set_state(state)
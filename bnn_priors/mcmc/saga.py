@@ -0,0 +1,85 @@
+import torch
+from typing import Sequence, Dict, Union, List, Optional
+
+from .sgld import SGLD
+from .rng import RNGStreams
+
+
+class SAGALD(SGLD):
+    """SGLD with the SAGA variance-reduced gradient, from Dubey et al. (2016),
+    "Variance Reduction in Stochastic Gradient Langevin Dynamics".
+
+    The optimizer keeps a table with the last gradient of the potential of
+    every data point, -log p(y_i | x_i, params). Before each step, `saga_grad_`
+    takes the gradients g_i of the data points in the minibatch, adds the drift
+    mean_batch(g_i - table_i) + mean(table) to `p.grad`, and writes the g_i into
+    the table. The rest of the gradient (from the prior) has to be in `p.grad`
+    already.
+
+    Args:
+        params (iterable): iterable of parameters to optimize or dicts defining
+            parameter groups
+        lr (float): learning rate
+        num_data (int): the number of data points in this learning task
+        table_size (int): the number of rows of the table, that is, of data
+            points in the training set
+        max_table_bytes (int): raise `MemoryError` instead of allocating a
+            larger table than this
+        All other arguments, including `rng`, are as in `SGLD`. `num_chains` is
+            not supported.
+    """
+    def __init__(self, params: Sequence[Union[torch.nn.Parameter, Dict]], lr: float,
+                 num_data: int, table_size: int, momentum: float=0, temperature: float=1.,
+                 rmsprop_alpha: float=0.99, rmsprop_eps: float=1e-8,
+                 raise_on_no_grad: bool=True, raise_on_nan: bool=False,
+                 fused: bool=False, flat: bool=False, precond_type: str="scalar",
+                 max_table_bytes: int=2**30, rng: Optional[RNGStreams]=None):
+        super().__init__(params, lr, num_data, momentum, temperature,
+                         rmsprop_alpha=rmsprop_alpha, rmsprop_eps=rmsprop_eps,
+                         raise_on_no_grad=raise_on_no_grad, raise_on_nan=raise_on_nan,
+                         fused=fused, flat=flat, precond_type=precond_type, rng=rng)
+        self.table_size = table_size
+        self.table_bytes = self.required_table_bytes(self._all_params(), table_size)
+        if self.table_bytes > max_table_bytes:
+            raise MemoryError(
+                f"the gradient table needs {self.table_bytes/2**20:.1f} MiB, "
+                f"more than the budget of {max_table_bytes/2**20:.1f} MiB")
+        for p in self._all_params():
+            state = self.state[p]
+            state['grad_table'] = torch.zeros((table_size, *p.shape), dtype=p.dtype, device=p.device)
+            state['grad_table_mean'] = torch.zeros_like(p)
+
+    @staticmethod
+    def required_table_bytes(params: Sequence[torch.Tensor], table_size: int) -> int:
+        "Memory that the gradient table for `params` takes"
+        return table_size * sum(p.numel() * p.element_size() for p in params)
+
+    @torch.no_grad()
+    def set_table_(self, indices: torch.Tensor, example_grads: List[torch.Tensor]):
+        """Write the gradients of the data points `indices` into the table,
+        without changing `p.grad`. `example_grads` has one tensor per parameter,
+        with a leading dimension for the data points."""
+        for p, g in zip(self._all_params(), example_grads):
+            self._update_table(self.state[p], indices, g)
+
+    @torch.no_grad()
+    def saga_grad_(self, indices: torch.Tensor, example_grads: List[torch.Tensor]):
+        """Add the SAGA drift of the data points `indices` to `p.grad`, and
+        write their gradients into the table. `example_grads` is as in
+        `set_table_`."""
+        for p, g in zip(self._all_params(), example_grads):
+            state = self.state[p]
+            drift = self._update_table(state, indices, g)
+            if p.grad is None:
+                p.grad = drift
+            else:
+                p.grad.add_(drift)
+
+    def _update_table(self, state, indices, g) -> torch.Tensor:
+        "Returns the drift with the old table, then updates the table"
+        table, mean = state['grad_table'], state['grad_table_mean']
+        diff = g - table[indices]
+        drift = diff.mean(0).add_(mean)
+        mean.add_(diff.sum(0), alpha=1/self.table_size)
+        table[indices] = g
+        return drift
@@ -0,0 +1,62 @@
+import math
+import numpy as np
+import scipy.stats
+from typing import Optional
+
+
+class SequentialMHTest:
+    """Approximate Metropolis-Hastings test from a growing subset of the data,
+    as in Korattikara et al. (2014), "Austerity in MCMC land: Cutting the
+    Metropolis-Hastings budget".
+
+    The proposal is accepted if the mean over the data set of the differences
+    of log-likelihood d_i = log p(y_i | θ') - log p(y_i | θ) is larger than
+    `mu0`. `add` takes the differences for a new batch of data points, drawn
+    without replacement. After each batch, a t-test decides if the mean of the
+    differences seen so far is far enough from `mu0`. If it is not, the test
+    needs more data. Once it has seen all `num_data` points, the decision is
+    exact.
+
+    Args:
+        mu0 (float): the threshold for the mean difference
+        num_data (int): the number of data points in the data set
+        error (float): probability of error of each t-test, which bounds the
+            error of the decision.
+    """
+    def __init__(self, mu0: float, num_data: int, error: float=0.05):
+        assert 0 < error < 1
+        self.mu0 = mu0
+        self.num_data = num_data
+        self.error = error
+        self.n = 0
+        self._sum = 0.
+        self._sum_sq = 0.
+
+    @property
+    def mean(self) -> float:
+        "Mean of the differences seen so far"
+        return self._sum / self.n
+
+    def add(self, diffs: np.ndarray) -> Optional[bool]:
+        """Add the differences of a new batch of data points. Returns whether
+        to accept the proposal, or None if more data are needed."""
+        diffs = np.asarray(diffs, dtype=np.float64)
+        self.n += diffs.size
+        self._sum += diffs.sum()
+        self._sum_sq += (diffs**2).sum()
+        mean = self.mean
+        if self.n >= self.num_data or math.isinf(self.mu0):
+            return bool(mean > self.mu0)
+        if self.n < 2:
+            return None
+
+        # Standard error of the mean, with the correction for sampling
+        # without replacement from a finite population
+        var = max(self._sum_sq / self.n - mean**2, 0.) * self.n / (self.n - 1)
+        std_err = math.sqrt(var / self.n * (1 - (self.n - 1) / (self.num_data - 1)))
+        if std_err == 0.:
+            return bool(mean > self.mu0)
+        t = (mean - self.mu0) / std_err
+        if scipy.stats.t.sf(abs(t), df=self.n - 1) < self.error:
+            return bool(mean > self.mu0)
+        return None
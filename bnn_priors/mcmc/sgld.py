@@ -1,16 +1,57 @@
 import torch
+import contextlib
 import math
 import numpy as np
 from collections import OrderedDict
 from typing import Sequence, Optional, Callable, Tuple, Dict, Union
 import typing
 
+from .flat import FlatArena
+from .rng import RNGStreams
+
 
 def dot(a, b):
     "return (a*b).sum().item()"
     return (a.view(-1) @ b.view(-1)).item()
 
 
+def dot_tensor(a, b, num_chains: Optional[int]=None) -> torch.Tensor:
+    """return (a*b).sum(), as a tensor on the device, without waiting for it.
+    If `num_chains` is given, sum separately over each entry of the leading
+    chain dimension."""
+    if num_chains is None:
+        return a.view(-1) @ b.view(-1)
+    return torch.einsum("ci,ci->c", a.reshape(num_chains, -1), b.reshape(num_chains, -1))
+
+
+def precond_dot(a, M, b, num_chains: Optional[int]=None) -> torch.Tensor:
+    "return (a*M*b).sum() as a tensor, where `M` is a float or a tensor like `a`"
+    if isinstance(M, torch.Tensor):
+        return dot_tensor(a * M, b, num_chains)
+    return M * dot_tensor(a, b, num_chains)
+
+
+def precond_add_(x, M, y, value):
+    "x += value * M * y, where `M` is a float or a tensor like `x`"
+    if isinstance(M, torch.Tensor):
+        return x.addcmul_(y, M, value=value)
+    return x.add_(y, alpha=value*M)
+
+
+def scaled_add_(x, y, value):
+    "x += value * y, where `value` is a float or a 0-d tensor"
+    if isinstance(value, torch.Tensor):
+        return x.addcmul_(y, value)
+    return x.add_(y, alpha=value)
+
+
+def scaled_addcmul_(x, a, b, value):
+    "x += value * a * b, where `value` is a float or a 0-d tensor"
+    if isinstance(value, torch.Tensor):
+        return x.addcmul_(a, b * value)
+    return x.addcmul_(a, b, value=value)
+
+
 class SGLD(torch.optim.Optimizer):
     """SGLD with momentum, preconditioning and diagnostics from Wenzel et al. 2020.
 
@@ -24,27 +65,103 @@ class SGLD(torch.optim.Optimizer):
                              temperature=0 corresponds to SGD with momentum.
         rmsprop_alpha: decay for the moving average of the squared gradients
         rmsprop_eps: the regularizer parameter for the RMSProp update
+        precond_type (str): "scalar" uses one preconditioner value for each
+            parameter tensor. "elementwise" uses one value for each element of
+            each parameter (like pSGLD), applied to both drift and noise. Both
+            are normalized by the smallest mean over a parameter tensor, so
+            elements with no gradient do not shrink the others.
         raise_on_no_grad (bool): whether to complain if a parameter does not
                                  have a gradient
         raise_on_nan: whether to complain if a gradient is not all finite.
+        fused (bool): update all the parameters of a group at once, using
+                      multi-tensor `torch._foreach_*` operations. If False, use
+                      a Python loop over the parameters.
+        flat (bool): store the parameters, gradients and sampler state of each
+                     group in a contiguous `FlatArena`. The parameters become
+                     views into it, and each step is a few large operations.
+                     Do not move the parameters to another device afterwards.
+        num_chains (int): if given, the leading dimension of every parameter
+                     indexes `num_chains` independent Markov chains. The
+                     diagnostics, preconditioner and energy are then computed
+                     separately for each chain. Only for the per-parameter step.
+        chain_temperatures (sequence of float): with `num_chains`, the
+                     temperature of each chain, as a multiple of `temperature`.
+                     For running several temperatures at once, as in parallel
+                     tempering.
+        rng (RNGStreams): draw the noise from independent generators seeded
+                     by hashing (seed, key), one per purpose, parameter group
+                     and chain, instead of from the global torch generator.
+                     Without `num_chains`, the noise of a whole group is drawn
+                     at once, so the per-parameter, fused and flat steps are
+                     bit-reproducible with each other. With `num_chains`, it is
+                     drawn once per chain.
     """
     def __init__(self, params: Sequence[Union[torch.nn.Parameter, Dict]], lr: float,
                  num_data: int, momentum: float=0, temperature: float=1.,
                  rmsprop_alpha: float=0.99, rmsprop_eps: float=1e-8,  # Wenzel et al. use 1e-7
-                 raise_on_no_grad: bool=True, raise_on_nan: bool=False):
+                 raise_on_no_grad: bool=True, raise_on_nan: bool=False,
+                 fused: bool=False, flat: bool=False, precond_type: str="scalar",
+                 num_chains: Optional[int]=None,
+                 chain_temperatures: Optional[Sequence[float]]=None,
+                 rng: Optional[RNGStreams]=None):
         assert lr >= 0 and num_data >= 0 and momentum >= 0 and temperature >= 0
+        if precond_type not in ["scalar", "elementwise"]:
+            raise ValueError(f"precond_type={precond_type}")
+        if num_chains is not None and (fused or flat):
+            raise ValueError("`num_chains` only works with the per-parameter step, "
+                             "not with `fused` or `flat`")
         defaults = dict(lr=lr, num_data=num_data, momentum=momentum,
                         rmsprop_alpha=rmsprop_alpha, rmsprop_eps=rmsprop_eps,
                         temperature=temperature)
         super(SGLD, self).__init__(params, defaults)
         self.raise_on_no_grad = raise_on_no_grad
         self.raise_on_nan = raise_on_nan
+        if fused and not hasattr(torch, "_foreach_addcmul_"):
+            raise RuntimeError("`fused=True` needs a version of PyTorch with "
+                               "multi-tensor `torch._foreach_*` operations")
+        self.fused = fused
+        self.flat = flat
+        self.precond_type = precond_type
+        self.num_chains = num_chains
+        if num_chains is not None:
+            for g in self.param_groups:
+                for p in g['params']:
+                    assert p.dim() >= 1 and p.size(0) == num_chains, \
+                        "the leading dimension of the parameters has to be the chains"
+        self.chain_temperatures = chain_temperatures
+        if chain_temperatures is not None:
+            assert num_chains is not None and len(chain_temperatures) == num_chains, \
+                "`chain_temperatures` needs one temperature per chain"
+            assert all(t > 0 for t in chain_temperatures)
+            p0 = self.param_groups[0]['params'][0]
+            # Multiplies the noise of each chain
+            self._chain_noise_scale = torch.tensor(
+                chain_temperatures, dtype=p0.dtype, device=p0.device).sqrt_()
+        self.rng = rng
+        # Noise drawn for a whole group, waiting to be used by each parameter
+        self._noise_cache: Dict[str, Dict[torch.Tensor, torch.Tensor]] = {}
+        self._arenas = None
+        # Within `tensor_step_sizes`: the step sizes of each group are 0-d
+        # tensors, and the noise of `step` is drawn in advance, one per group
+        self._tensor_step_sizes = False
+        self._step_size_tensors: typing.List[Dict[str, torch.Tensor]] = []
+        self._flat_step_noise: Dict[int, torch.Tensor] = {}
+        if flat:
+            self._arenas = [FlatArena(g['params']) for g in self.param_groups]
+            for arena in self._arenas:
+                square_avgs = arena.views(arena.buffer('square_avg', fill=1.))
+                for p, square_avg in zip(arena.params, square_avgs):
+                    self.state[p]['square_avg'] = square_avg
+                if precond_type == "elementwise":
+                    preconds = arena.views(arena.buffer('preconditioner', fill=1.))
+                    for p, precond in zip(arena.params, preconds):
+                        self.state[p]['preconditioner'] = precond
         # OK to call this one, but not `sample_momentum`, because
         # `update_preconditioner` uses no random numbers.
         self.update_preconditioner()
         self._step_count = 0  # keep the `torch.optim.scheduler` happy
 
-    def _preconditioner_default(self, state, p) -> float:
+    def _preconditioner_default(self, state, p) -> Union[float, torch.Tensor]:
         try:
             return state['preconditioner']
         except KeyError:
@@ -54,19 +171,124 @@ class SGLD(torch.optim.Optimizer):
     def delta_energy(self, a, b) -> float:
         return math.inf
 
+    def _dot(self, a, b) -> torch.Tensor:
+        "`dot_tensor`, for each chain if there are several"
+        return dot_tensor(a, b, self.num_chains)
+
+    def _precond_dot(self, a, M, b) -> torch.Tensor:
+        return precond_dot(a, M, b, self.num_chains)
+
+    def _numel(self, p) -> int:
+        "Number of elements of `p` in each chain"
+        if self.num_chains is None:
+            return p.numel()
+        return p.numel() // self.num_chains
+
+    def _chain_view(self, x, p):
+        "Reshape the per-chain values `x` to broadcast against `p`"
+        return x.view(self.num_chains, *([1]*(p.dim() - 1)))
+
     @torch.no_grad()
     def sample_momentum(self, keep=0.0):
         "Sample the momenta for all the parameters"
         assert 0 <= keep and keep <= 1.
         if keep == 1.:
             return
+        if self._arenas is not None:
+            return self._sample_flat_momentum(keep)
         for group in self.param_groups:
             std = math.sqrt(group['temperature']*(1-keep))
+            self._noise_cache.clear()
             for p in group['params']:
+                noise = self._noise_like(group, p, "momentum")
                 if keep == 0.0:
-                    self.state[p]['momentum_buffer'] = torch.randn_like(p).mul_(std)
+                    self.state[p]['momentum_buffer'] = noise.mul_(std)
                 else:
-                    self.state[p]['momentum_buffer'].mul_(math.sqrt(keep)).add_(torch.randn_like(p), alpha=std)
+                    self.state[p]['momentum_buffer'].mul_(math.sqrt(keep)).add_(noise, alpha=std)
+
+    def _group_index(self, group) -> int:
+        return next(i for i, g in enumerate(self.param_groups) if g is group)
+
+    def _noise_like(self, group, p, purpose="step") -> torch.Tensor:
+        """Standard normal noise like the parameter `p` of `group`, scaled by the
+        square root of each chain's temperature. With `rng`, the first call for
+        `purpose` draws the noise of every parameter in `group`."""
+        if self.rng is None:
+            noise = torch.randn_like(p)
+        else:
+            cache = self._noise_cache.setdefault(purpose, {})
+            if p not in cache:
+                params = group['params']
+                cache.update(zip(params, self.rng.normal_like(
+                    params, purpose, self._group_index(group), num_chains=self.num_chains)))
+            noise = cache.pop(p)
+        if self.chain_temperatures is not None:
+            noise.mul_(self._chain_view(self._chain_noise_scale, p))
+        return noise
+
+    def _flat_noise(self, group, arena, purpose="step") -> torch.Tensor:
+        "Standard normal noise like `arena.param`, the same as `_noise_like` would give"
+        if self._tensor_step_sizes and purpose == "step":
+            return self._flat_step_noise.pop(self._group_index(group))
+        if self.rng is None:
+            return torch.randn_like(arena.param)
+        noise, = self.rng.normal_like([arena.param], purpose, self._group_index(group))
+        return noise
+
+    def _sample_flat_momentum(self, keep):
+        for group, arena in zip(self.param_groups, self._arenas):
+            std = math.sqrt(group['temperature']*(1-keep))
+            noise = self._flat_noise(group, arena, "momentum")
+            if keep == 0.0 or 'momentum_buffer' not in arena.buffers:
+                momentum = arena.buffer('momentum_buffer')
+                torch.mul(noise, std, out=momentum)
+                for p, m in zip(arena.params, arena.views(momentum)):
+                    self.state[p]['momentum_buffer'] = m
+            else:
+                arena.buffers['momentum_buffer'].mul_(math.sqrt(keep)).add_(noise, alpha=std)
+
+    def zero_grad(self, set_to_none: bool=True):
+        if self._arenas is None:
+            return super().zero_grad(set_to_none=set_to_none)
+        # The gradients have to stay views into the arenas
+        for arena in self._arenas:
+            arena.zero_grad_()
+
+    def state_dict(self) -> Dict:
+        "`torch.optim.Optimizer.state_dict`, and the accumulators of the flat arenas"
+        state_dict = super().state_dict()
+        if self._arenas is not None:
+            state_dict['arenas'] = [dict(arena.group_state) for arena in self._arenas]
+        return state_dict
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict: Dict):
+        """`torch.optim.Optimizer.load_state_dict`, but the state of the
+        parameters in flat arenas is copied into the arenas' buffers, so it
+        stays a view into them. Tensors in the parameter groups are moved to
+        the device of the group."""
+        state_dict = dict(state_dict)
+        arenas = state_dict.pop('arenas', None)
+        views = {}
+        if self._arenas is not None:
+            views = {(p, k): v for p in self._all_params()
+                     for k, v in self.state[p].items() if isinstance(v, torch.Tensor)}
+        super().load_state_dict(state_dict)
+
+        for group in self.param_groups:
+            device = group['params'][0].device
+            for k, v in group.items():
+                if isinstance(v, torch.Tensor):
+                    group[k] = v.to(device)
+        if self._arenas is None:
+            return
+        for (p, k), view in views.items():
+            if isinstance(self.state[p].get(k), torch.Tensor):
+                self.state[p][k] = view.copy_(self.state[p][k])
+        for arena, group_state in zip(self._arenas, arenas):
+            arena.group_state = {k: v.to(arena.param.device) for k, v in group_state.items()}
+            # Fill the `preconditioner` buffer again at the next step
+            arena.preconditioner_values = None
 
     @torch.no_grad()
     def step(self, closure: Optional[Callable[..., torch.Tensor]]=None,
@@ -91,18 +313,25 @@ class SGLD(torch.optim.Optimizer):
             with torch.enable_grad():
                 loss = closure()
         try:
-            for group in self.param_groups:
-                update_group_fn(group)
-                for p in group['params']:
-                    if p.grad is None:
-                        if self.raise_on_no_grad:
-                            raise RuntimeError(
-                                f"No gradient for parameter with shape {p.shape}")
-                        continue
-                    if self.raise_on_nan and not torch.isfinite(p.grad).all():
-                        raise ValueError(
-                            f"Gradient of shape {p.shape} is not finite: {p.grad}")
-                    step_fn(group, p, self.state[p], **step_fn_kwargs)
+            for i, group in enumerate(self.param_groups):
+                if not self._tensor_step_sizes:
+                    update_group_fn(group)
+                self._noise_cache.clear()
+                if self._arenas is not None:
+                    arena = self._arenas[i]
+                    if not self._tensor_step_sizes:
+                        self._sync_arena(arena)
+                    self._flat_step_fn(group, arena, [self.state[p] for p in arena.params],
+                                       **step_fn_kwargs)
+                    continue
+
+                params = self._params_with_grad(group)
+                if self.fused:
+                    self._fused_step_fn(group, params, [self.state[p] for p in params],
+                                        **step_fn_kwargs)
+                else:
+                    for p in params:
+                        step_fn(group, p, self.state[p], **step_fn_kwargs)
 
         except KeyError as e:
             if e.args[0] == "momentum_buffer":
@@ -111,6 +340,67 @@ class SGLD(torch.optim.Optimizer):
             raise e
         return loss
 
+    # The entries of each group that `_update_group_fn` computes from its
+    # `lr` and `temperature`, which `tensor_step_sizes` keeps in tensors
+    _step_size_keys = ("hn", "h", "noise_std")
+
+    @contextlib.contextmanager
+    def tensor_step_sizes(self):
+        """Within this context, `step` reads no Python number that changes
+        during a run, so `torch.compile` compiles it only once. On entering,
+        the step sizes of each group (`_step_size_keys`) are computed into 0-d
+        tensors, and the arenas are synced, checked for NaNs and given their
+        preconditioner and noise. `step` uses them as they are. On exiting, the
+        step sizes are floats again. Only for `flat`, and only for `step`."""
+        assert self._arenas is not None, "`tensor_step_sizes` needs `flat`"
+        floats = []
+        for i, (group, arena) in enumerate(zip(self.param_groups, self._arenas)):
+            self._update_group_fn(group)
+            floats.append({k: group[k] for k in self._step_size_keys})
+            if len(self._step_size_tensors) == i:
+                self._step_size_tensors.append({
+                    k: torch.zeros((), dtype=arena.param.dtype, device=arena.param.device)
+                    for k in self._step_size_keys})
+            for k, t in self._step_size_tensors[i].items():
+                group[k] = t.fill_(group[k])
+            self._sync_arena(arena)
+            self._flat_preconditioner(arena, [self.state[p] for p in arena.params])
+            if self._draws_step_noise(group):
+                self._flat_step_noise[i] = self._flat_noise(group, arena)
+        self._tensor_step_sizes = True
+        try:
+            yield
+        finally:
+            self._tensor_step_sizes = False
+            self._flat_step_noise.clear()
+            for group, values in zip(self.param_groups, floats):
+                group.update(values)
+
+    def _draws_step_noise(self, group) -> bool:
+        "Whether `step` draws noise for `group`"
+        return group['temperature'] > 0
+
+    def _sync_arena(self, arena):
+        "`arena.sync_`, and check its gradient if `raise_on_nan`"
+        arena.sync_(raise_on_no_grad=self.raise_on_no_grad)
+        if self.raise_on_nan and not torch.isfinite(arena.grad).all():
+            raise ValueError("Gradient is not finite")
+
+    def _params_with_grad(self, group) -> typing.List[torch.Tensor]:
+        "The parameters of `group` that have a gradient, checked for NaNs"
+        params = []
+        for p in group['params']:
+            if p.grad is None:
+                if self.raise_on_no_grad:
+                    raise RuntimeError(
+                        f"No gradient for parameter with shape {p.shape}")
+                continue
+            if self.raise_on_nan and not torch.isfinite(p.grad).all():
+                raise ValueError(
+                    f"Gradient of shape {p.shape} is not finite: {p.grad}")
+            params.append(p)
+        return params
+
     def _update_group_fn(self, g):
         g['hn'] = math.sqrt(g['lr'] * g['num_data'])
         g['h'] = math.sqrt(g['lr'] / g['num_data'])
@@ -119,45 +409,186 @@ class SGLD(torch.optim.Optimizer):
     def _step_fn(self, group, p, state, calc_metrics=True, is_final=False):
         """if is_final, do not change parameters or momentum"""
         M_rsqrt = self._preconditioner_default(state, p)
-        d = p.numel()
+        d = self._numel(p)
 
         # Update the momentum with the gradient
         if group['momentum'] > 0:
             momentum = state['momentum_buffer']
             if calc_metrics:
                 # NOTE: the momentum is from the previous time step
-                state['est_temperature'] = dot(momentum, momentum) / d
+                state['est_temperature'] = self._dot(momentum, momentum) / d
             if not is_final:
-                momentum.mul_(group['momentum']).add_(p.grad, alpha=-group['hn']*M_rsqrt)
+                precond_add_(momentum.mul_(group['momentum']), M_rsqrt, p.grad,
+                             -group['hn'])
         else:
             if not is_final:
                 momentum = p.grad.detach().mul(-group['hn']*M_rsqrt)
             if calc_metrics:
                 # TODO: make the momentum be from the previous time step
-                state['est_temperature'] = dot(momentum, momentum) / d
+                state['est_temperature'] = self._dot(momentum, momentum) / d
 
         if not is_final:
             # Add noise to momentum
             if group['temperature'] > 0:
-                momentum.add_(torch.randn_like(momentum), alpha=group['noise_std'])
+                momentum.add_(self._noise_like(group, p), alpha=group['noise_std'])
 
         if calc_metrics:
             # NOTE: p and p.grad are from the same time step
-            state['est_config_temp'] = dot(p, p.grad) * (group['num_data']/d)
+            state['est_config_temp'] = self._dot(p, p.grad) * (group['num_data']/d)
 
         if not is_final:
             # Take the gradient step
-            p.add_(momentum, alpha=group['h']*M_rsqrt)
+            precond_add_(p, M_rsqrt, momentum, group['h'])
 
             # RMSProp moving average
             alpha = group['rmsprop_alpha']
             state['square_avg'].mul_(alpha).addcmul_(p.grad, p.grad, value=1 - alpha)
 
+    def _fused_step_fn(self, group, params, states, calc_metrics=True, is_final=False):
+        """Same as `_step_fn`, but for all the parameters in `group` at once.
+        Random numbers are drawn in the same order as `_step_fn`, so both
+        produce the same trajectory for the same seed."""
+        if len(params) == 0:
+            return
+        M_rsqrt = [self._preconditioner_default(s, p) for p, s in zip(params, states)]
+        grads = [p.grad for p in params]
+
+        # Update the momentum with the gradient
+        if group['momentum'] > 0:
+            momenta = [s['momentum_buffer'] for s in states]
+            if calc_metrics:
+                # NOTE: the momentum is from the previous time step
+                for m, s in zip(momenta, states):
+                    s['est_temperature'] = dot_tensor(m, m) / m.numel()
+            if not is_final:
+                torch._foreach_mul_(momenta, group['momentum'])
+                torch._foreach_add_(momenta, torch._foreach_mul(grads, M_rsqrt),
+                                    alpha=-group['hn'])
+        else:
+            if not is_final:
+                momenta = torch._foreach_mul(grads, M_rsqrt)
+                torch._foreach_mul_(momenta, -group['hn'])
+            if calc_metrics:
+                for m, s in zip(momenta, states):
+                    s['est_temperature'] = dot_tensor(m, m) / m.numel()
+
+        if not is_final:
+            # Add noise to momentum
+            if group['temperature'] > 0:
+                noise = [self._noise_like(group, p) for p in params]
+                torch._foreach_add_(momenta, noise, alpha=group['noise_std'])
+
+        if calc_metrics:
+            # NOTE: p and p.grad are from the same time step
+            for p, s in zip(params, states):
+                s['est_config_temp'] = dot_tensor(p, p.grad) * (group['num_data']/p.numel())
+
+        if not is_final:
+            # Take the gradient step
+            torch._foreach_add_(params, torch._foreach_mul(momenta, M_rsqrt),
+                                alpha=group['h'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            square_avgs = [s['square_avg'] for s in states]
+            torch._foreach_mul_(square_avgs, alpha)
+            torch._foreach_addcmul_(square_avgs, grads, grads, value=1 - alpha)
+
+    def _flat_preconditioner(self, arena, states) -> Tuple[torch.Tensor, Optional[typing.List[float]]]:
+        """The preconditioner of every parameter in `arena`, expanded into a flat
+        tensor, and as a list of one value per parameter (None if elementwise,
+        or within `tensor_step_sizes`, which fills the tensor beforehand)."""
+        if self.precond_type == "elementwise" or self._tensor_step_sizes:
+            return arena.buffers['preconditioner'], None
+        M_rsqrts = [self._preconditioner_default(s, p) for p, s in zip(arena.params, states)]
+        if arena.preconditioner_values != M_rsqrts:
+            flat_M = arena.buffer('preconditioner')
+            for v, M in zip(arena.views(flat_M), M_rsqrts):
+                v.fill_(M)
+            arena.preconditioner_values = M_rsqrts
+        return arena.buffers['preconditioner'], M_rsqrts
+
+    def _flat_step_fn(self, group, arena, states, calc_metrics=True, is_final=False):
+        "Same as `_step_fn`, but with a few operations on the whole `arena`."
+        M_rsqrt, _ = self._flat_preconditioner(arena, states)
+        grad = arena.grad
+
+        # Update the momentum with the gradient
+        if group['momentum'] > 0:
+            momentum = arena.buffers['momentum_buffer']
+            if calc_metrics:
+                # NOTE: the momentum is from the previous time step
+                self._flat_temperature_metrics(group, arena, states, momentum)
+            if not is_final:
+                scaled_addcmul_(momentum.mul_(group['momentum']), grad, M_rsqrt, -group['hn'])
+        else:
+            if not is_final:
+                momentum = grad.mul(M_rsqrt).mul_(-group['hn'])
+            if calc_metrics:
+                self._flat_temperature_metrics(group, arena, states, momentum)
+
+        if not is_final:
+            # Add noise to momentum
+            if group['temperature'] > 0:
+                scaled_add_(momentum, self._flat_noise(group, arena), group['noise_std'])
+
+            # Take the gradient step
+            scaled_addcmul_(arena.param, momentum, M_rsqrt, group['h'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            arena.buffers['square_avg'].mul_(alpha).addcmul_(grad, grad, value=1 - alpha)
+
+    def _flat_temperature_metrics(self, group, arena, states, momentum):
+        """Temperature diagnostics of every parameter in `arena`, using
+        `momentum`, and `p` and `p.grad` (which have to be from the same time
+        step)."""
+        est_temperature = arena.segment_sum(momentum * momentum) / arena.numel_tensor
+        est_config_temp = (arena.segment_sum(arena.param * arena.grad)
+                           * group['num_data'] / arena.numel_tensor)
+        for i, state in enumerate(states):
+            state['est_temperature'] = est_temperature[i]
+            state['est_config_temp'] = est_config_temp[i]
+
+    @torch.no_grad()
+    def diagnostics(self) -> Dict[str, np.ndarray]:
+        """The temperature diagnostics and preconditioner of every parameter,
+        in the order of `self.param_groups`. With `num_chains`, each array
+        has an additional trailing dimension for the chains.
+
+        The diagnostics are kept as tensors on the device by the steps that
+        calculate them. They are stacked and copied to the host here, once.
+        """
+        states = [self.state[p] for g in self.param_groups for p in g['params']]
+        keys = ['est_temperature', 'est_config_temp']
+        rows = [torch.stack([s[k] for s in states]) for k in keys]
+        tensor_precond = (self.precond_type == "elementwise" or self.num_chains is not None)
+        if tensor_precond:
+            # Report the average of each parameter's preconditioner
+            keys.append('preconditioner')
+            if self.num_chains is None:
+                means = [s['preconditioner'].mean() for s in states]
+            else:
+                means = [s['preconditioner'].expand_as(p).reshape(self.num_chains, -1).mean(1)
+                         for p, s in zip(self._all_params(), states)]
+            rows.append(torch.stack(means))
+        stacked = torch.stack(rows).to(device='cpu', dtype=torch.float64).numpy()
+
+        diagnostics = {k: row for k, row in zip(keys, stacked)}
+        if not tensor_precond:
+            diagnostics['preconditioner'] = np.array(
+                [s['preconditioner'] for s in states], dtype=np.float64)
+        return diagnostics
+
     @torch.no_grad()
     def update_preconditioner(self):
         """Updates the preconditioner for each parameter `state['preconditioner']` using
         the estimated `state['square_avg']`.
+
+        The preconditioners are normalized so that the smallest one is 1.
         """
+        if self.precond_type == "elementwise" or self.num_chains is not None:
+            return self._update_tensor_preconditioner()
         precond = OrderedDict()
         min_s = math.inf
 
@@ -177,3 +608,47 @@ class SGLD(torch.optim.Optimizer):
             # ^(1/2) to form the preconditioner,
             # ^(-1/2) because we want the preconditioner's inverse square root.
             self.state[p]['preconditioner'] = (new_M / min_s)**(-1/4)
+
+    def _all_params(self) -> typing.List[torch.Tensor]:
+        return [p for g in self.param_groups for p in g['params']]
+
+    def _update_tensor_preconditioner(self):
+        """Preconditioners that are tensors: one value per element, or one value
+        per chain and parameter. Each chain is normalized separately.
+
+        As in the scalar case, the normalizer is the smallest mean of
+        `square_avg` over a parameter tensor. The smallest element would be
+        about `rmsprop_eps` as soon as one element has no gradient (a dead
+        ReLU, an unused class), which would shrink the step of all the others."""
+        K = self.num_chains
+        precond = OrderedDict()
+        means = []
+        for group in self.param_groups:
+            eps = group['rmsprop_eps']
+            for p in group['params']:
+                state = self.state[p]
+                try:
+                    square_avg = state['square_avg']
+                except KeyError:
+                    square_avg = state['square_avg'] = torch.ones_like(p)
+                mean = (square_avg.mean() if K is None
+                        else square_avg.reshape(K, -1).mean(1)) + eps
+                means.append(mean)
+                if self.precond_type == "elementwise":
+                    precond[p] = square_avg + eps
+                else:
+                    precond[p] = self._chain_view(mean, p).clone()
+
+        # One normalizer, or one per chain
+        min_s = torch.stack(means).min(0).values
+        for p, new_M in precond.items():
+            if K is not None:
+                M_rsqrt = new_M.div_(self._chain_view(min_s, p)).pow_(-1/4)
+            else:
+                M_rsqrt = new_M.div_(min_s).pow_(-1/4)
+            state = self.state[p]
+            if isinstance(state.get('preconditioner'), torch.Tensor):
+                # Keep the views into a flat arena valid
+                state['preconditioner'].copy_(M_rsqrt)
+            else:
+                state['preconditioner'] = M_rsqrt
@@ -0,0 +1,130 @@
+import torch
+from typing import Sequence, Optional, Callable, Dict, Union
+
+from .sgld import SGLD, precond_add_
+from .rng import RNGStreams
+
+
+class SGNHT(SGLD):
+    """Stochastic gradient Nosé-Hoover thermostat, from Ding et al. (2014),
+    "Bayesian Sampling Using Stochastic Gradient Thermostats".
+
+    Like `SGLD` with momentum, but the friction of the momentum is a
+    thermostat variable ξ, which adapts so that the kinetic temperature
+    matches `temperature`:
+        m ← (1 - ξ) m - hn M ∇U + N(0, 2 (1 - momentum) temperature)
+        θ ← θ + h M m
+        ξ ← ξ + thermostat_rate (m² - temperature)
+    The extra noise of minibatch gradients heats up the momentum, so ξ grows
+    to absorb it. ξ starts at `1 - momentum`, so before it adapts the
+    sampler is the same as `SGLD`. The thermostat only adapts while the
+    temperature is above 0.
+
+    Args:
+        params (iterable): iterable of parameters to optimize or dicts defining
+            parameter groups
+        lr (float): learning rate
+        num_data (int): the number of data points in this learning task
+        momentum (float): sets the injected noise, and the initial friction
+            `1 - momentum`. Has to be in (0, 1).
+        temperature (float): Temperature for tempering the posterior.
+        thermostat (str): "group" uses one thermostat per parameter group, which
+            matches the mean of m² over the group. "element" uses one per
+            element of each parameter.
+        thermostat_rate (float): how fast the thermostat adapts. Defaults to
+            `(1 - momentum)**2`.
+        num_chains (int): number of chains along the leading dimension of the
+            parameters, see `SGLD`. Each chain gets its own thermostat.
+        All other arguments, including `rng`, are as in `SGLD`. There is only the per-parameter
+        step, so `fused` and `flat` are not supported.
+    """
+    def __init__(self, params: Sequence[Union[torch.nn.Parameter, Dict]], lr: float,
+                 num_data: int, momentum: float=0.99, temperature: float=1.,
+                 thermostat: str="group", thermostat_rate: Optional[float]=None,
+                 rmsprop_alpha: float=0.99, rmsprop_eps: float=1e-8,
+                 raise_on_no_grad: bool=True, raise_on_nan: bool=False,
+                 precond_type: str="scalar", num_chains: Optional[int]=None,
+                 rng: Optional[RNGStreams]=None):
+        if not 0 < momentum < 1:
+            raise ValueError(f"momentum={momentum} has to be in (0, 1)")
+        if thermostat not in ["group", "element"]:
+            raise ValueError(f"thermostat={thermostat}")
+        super().__init__(params, lr, num_data, momentum, temperature,
+                         rmsprop_alpha=rmsprop_alpha, rmsprop_eps=rmsprop_eps,
+                         raise_on_no_grad=raise_on_no_grad, raise_on_nan=raise_on_nan,
+                         precond_type=precond_type, num_chains=num_chains, rng=rng)
+        self.thermostat = thermostat
+        for group in self.param_groups:
+            group.setdefault('thermostat_rate', (
+                (1 - group['momentum'])**2 if thermostat_rate is None else thermostat_rate))
+            p0 = group['params'][0]
+            if thermostat == "group":
+                shape = (() if num_chains is None else (num_chains,))
+                group['thermostat'] = torch.full(shape, 1 - group['momentum'],
+                                                 dtype=p0.dtype, device=p0.device)
+            else:
+                for p in group['params']:
+                    self.state[p]['thermostat'] = torch.full_like(p, 1 - group['momentum'])
+
+    @torch.no_grad()
+    def step(self, closure: Optional[Callable[..., torch.Tensor]]=None,
+             calc_metrics=True, save_state=False):
+        loss = super().step(closure, calc_metrics=calc_metrics, save_state=save_state)
+        if self.thermostat == "group":
+            self._update_group_thermostats()
+        return loss
+    initial_step = step
+
+    def _friction(self, group, p, state) -> torch.Tensor:
+        if self.thermostat == "element":
+            return state['thermostat']
+        if self.num_chains is None:
+            return group['thermostat']
+        return self._chain_view(group['thermostat'], p)
+
+    def _step_fn(self, group, p, state, calc_metrics=True, is_final=False):
+        """if is_final, do not change parameters or momentum"""
+        M_rsqrt = self._preconditioner_default(state, p)
+        d = self._numel(p)
+        momentum = state['momentum_buffer']
+        if calc_metrics:
+            # NOTE: the momentum is from the previous time step
+            state['est_temperature'] = self._dot(momentum, momentum) / d
+            # NOTE: p and p.grad are from the same time step
+            state['est_config_temp'] = self._dot(p, p.grad) * (group['num_data']/d)
+        if is_final:
+            return
+
+        momentum.sub_(momentum * self._friction(group, p, state))
+        precond_add_(momentum, M_rsqrt, p.grad, -group['hn'])
+        if group['temperature'] > 0:
+            momentum.add_(self._noise_like(group, p), alpha=group['noise_std'])
+
+        # Take the gradient step
+        precond_add_(p, M_rsqrt, momentum, group['h'])
+
+        # Thermostat
+        if group['temperature'] > 0:
+            if self.thermostat == "element":
+                rate = group['thermostat_rate']
+                state['thermostat'].addcmul_(momentum, momentum, value=rate).sub_(
+                    rate * group['temperature'])
+            else:
+                state['kinetic'] = self._dot(momentum, momentum)
+
+        # RMSProp moving average
+        alpha = group['rmsprop_alpha']
+        state['square_avg'].mul_(alpha).addcmul_(p.grad, p.grad, value=1 - alpha)
+
+    def _update_group_thermostats(self):
+        "Move each group's thermostat towards the kinetic temperature of the last step"
+        for group in self.param_groups:
+            if group['temperature'] == 0:
+                continue
+            params = [p for p in group['params'] if 'kinetic' in self.state[p]]
+            if len(params) == 0:
+                continue
+            kinetic = torch.stack([self.state[p].pop('kinetic') for p in params]).sum(0)
+            d = sum(self._numel(p) for p in params)
+            group['thermostat'].add_(kinetic / d - group['temperature'],
+                                     alpha=group['thermostat_rate'])
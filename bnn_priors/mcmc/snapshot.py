@@ -0,0 +1,86 @@
+import torch
+from typing import Dict, Hashable, List, Sequence
+
+
+class StateSnapshot:
+    """A saved copy of some tensors of an optimizer (parameters, gradients,
+    momenta), to go back to them when a Metropolis-Hastings proposal is
+    rejected.
+
+    The copies live in buffers that are allocated at the first `save` and
+    reused afterwards. A copy kept on the same device as the tensor it was
+    saved from is restored by swapping the two: `restore` returns the saved
+    tensor, which the caller puts in place of the current one, and the current
+    tensor becomes the buffer for the next `save`. A copy kept in host memory
+    is copied back instead.
+
+    Args:
+        placement (str): where to keep the copies. "device" keeps them on the
+            device of the saved tensors, "host" in CPU memory. "auto" keeps them
+            on the device, unless allocating a buffer would leave less than
+            `reserve_bytes` of free memory on a CUDA device.
+        reserve_bytes (int): free device memory that "auto" leaves for the
+            forward and backward passes.
+    """
+    def __init__(self, placement: str="auto", reserve_bytes: int=2**30):
+        if placement not in ["auto", "device", "host"]:
+            raise ValueError(f"placement={placement}")
+        self.placement = placement
+        self.reserve_bytes = reserve_bytes
+        self._buffers: Dict[Hashable, Dict[str, torch.Tensor]] = {}
+
+    def _device_for(self, tensor: torch.Tensor) -> torch.device:
+        if self.placement == "host":
+            return torch.device("cpu")
+        if self.placement == "auto" and tensor.is_cuda:
+            free, _ = torch.cuda.mem_get_info(tensor.device)
+            if free - tensor.numel() * tensor.element_size() < self.reserve_bytes:
+                return torch.device("cpu")
+        return tensor.device
+
+    def has(self, key: Hashable, name: str) -> bool:
+        return name in self._buffers.get(key, {})
+
+    def get(self, key: Hashable, name: str) -> torch.Tensor:
+        "The copy of tensor `name` of `key` saved by the last `save`"
+        return self._buffers[key][name]
+
+    @torch.no_grad()
+    def save(self, key: Hashable, name: str, tensor: torch.Tensor):
+        "Copy `tensor` into the buffer `name` of `key`"
+        buffers = self._buffers.setdefault(key, {})
+        try:
+            buf = buffers[name]
+        except KeyError:
+            device = self._device_for(tensor)
+            buf = buffers[name] = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device=device,
+                pin_memory=(device.type == "cpu" and tensor.is_cuda))
+        buf.copy_(tensor)
+
+    @torch.no_grad()
+    def restore(self, key: Hashable, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        """Restore `tensor` to the last `save` of `name`. Returns the tensor that
+        holds the saved values, which has to replace `tensor`: either the saved
+        buffer (and `tensor` becomes the buffer) or `tensor` itself, if the
+        saved values were copied into it."""
+        buffers = self._buffers[key]
+        buf = buffers[name]
+        if buf.device == tensor.device:
+            buffers[name] = tensor.detach()
+            return buf
+        tensor.copy_(buf)
+        return tensor
+
+    def state_dict(self, keys: Sequence[Hashable]) -> List[Dict[str, torch.Tensor]]:
+        "The saved copies of each of `keys`, in the same order"
+        return [dict(self._buffers.get(key, {})) for key in keys]
+
+    def load_state_dict(self, keys: Sequence[Hashable], state_dict: List[Dict[str, torch.Tensor]],
+                        like: Sequence[torch.Tensor]):
+        """Restore the copies of `keys` from `state_dict`. They are placed as if
+        they were saved from the tensors `like`, one for each key."""
+        self._buffers = {}
+        for key, buffers, tensor in zip(keys, state_dict, like):
+            for name, buf in buffers.items():
+                self.save(key, name, buf.to(tensor.device))
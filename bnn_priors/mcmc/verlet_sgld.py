@@ -1,9 +1,12 @@
 import torch
 import math
+import numpy as np
 from typing import Sequence, Optional, Callable, Tuple, Dict, Union
 import typing
 
-from .sgld import SGLD, dot
+from .sgld import SGLD, dot_tensor, precond_dot, precond_add_, scaled_add_, scaled_addcmul_
+from .snapshot import StateSnapshot
+from .rng import RNGStreams
 
 class VerletSGLD(SGLD):
     """SGLD with momentum, preconditioning and diagnostics from Wenzel et al. 2020.
@@ -23,28 +26,89 @@ class VerletSGLD(SGLD):
         raise_on_no_grad (bool): whether to complain if a parameter does not
                                  have a gradient
         raise_on_nan: whether to complain if a gradient is not all finite.
+        fused (bool): update all the parameters of a group at once, using
+                      multi-tensor `torch._foreach_*` operations.
+        flat (bool): store the parameters, gradients and sampler state of each
+                     group in a contiguous `FlatArena`. Saving and restoring
+                     the state for rejection is then one copy per buffer.
+        precond_type (str): "scalar" or "elementwise", see `SGLD`.
+        num_chains (int): number of chains along the leading dimension of the
+                     parameters, see `SGLD`. `delta_energy` and `maybe_reject`
+                     then work on arrays with one entry per chain.
+        snapshot_placement (str): where to keep the state saved for rejection,
+                     "device", "host" or "auto". See `StateSnapshot`.
+        splitting (str): how each step splits the underdamped Langevin
+                     dynamics into a position update A, a gradient kick B and
+                     a momentum refresh O. "OBABO" refreshes the momentum
+                     around the Verlet step BAB. "BAOAB" refreshes it between
+                     two half position updates, which has a much smaller
+                     bias of the configurational temperature at large
+                     learning rates (Leimkuhler and Matthews, 2013). Both
+                     are symmetric, so `delta_energy` (the energy change of
+                     the A and B updates) gives a valid M-H correction.
+        rng (RNGStreams): draw the noise and the M-H tests from these streams,
+                     see `SGLD`.
     """
-    def delta_energy(self, prev_potential: float, potential: float) -> float:
-        "Calculates the difference in energy since the last `initial_step` and now."
+    def __init__(self, params: Sequence[Union[torch.nn.Parameter, Dict]], lr: float,
+                 num_data: int, momentum: float=0, temperature: float=1.,
+                 rmsprop_alpha: float=0.99, rmsprop_eps: float=1e-8,
+                 raise_on_no_grad: bool=True, raise_on_nan: bool=False,
+                 fused: bool=False, flat: bool=False, precond_type: str="scalar",
+                 num_chains: Optional[int]=None, snapshot_placement: str="auto",
+                 splitting: str="OBABO", rng: Optional[RNGStreams]=None):
+        if splitting not in ["OBABO", "BAOAB"]:
+            raise ValueError(f"splitting={splitting}")
+        self.splitting = splitting
+        super().__init__(params, lr, num_data, momentum, temperature,
+                         rmsprop_alpha=rmsprop_alpha, rmsprop_eps=rmsprop_eps,
+                         raise_on_no_grad=raise_on_no_grad, raise_on_nan=raise_on_nan,
+                         fused=fused, flat=flat, precond_type=precond_type,
+                         num_chains=num_chains, rng=rng)
+        self._snapshot = StateSnapshot(snapshot_placement)
+
+    @torch.no_grad()
+    def delta_energy(self, prev_potential, potential):
+        """Calculates the difference in energy since the last `initial_step` and now.
+
+        The energy terms of each step stay on the device; this is the only
+        place where they are summed and copied to the host."""
         num_data = self.param_groups[0]['num_data']
         assert all(g['num_data'] == num_data for g in self.param_groups),\
             "unclear which `num_data` to use"
-        delta_energy = 0.
-        for group in self.param_groups:
+        terms = []
+        for i, group in enumerate(self.param_groups):
+            if self._arenas is not None:
+                arena = self._arenas[i]
+                terms.append(arena.group_state['delta_energy']
+                             + self._flat_point_energy(group, arena))
+                continue
             for p in group['params']:
                 state = self.state[p]
                 point_energy = self._point_energy(group, p, state)
-                delta_energy += state['delta_energy'] + point_energy
+                terms.append(state['delta_energy'] + point_energy)
+        delta_energy = torch.stack(terms).sum(0).to(device='cpu', dtype=torch.float64)
 
         if isinstance(potential, torch.Tensor):
-            potential = potential.item()
-        delta_energy += (potential - prev_potential) * num_data
-        return delta_energy
+            potential = potential.detach().cpu()
+        delta_potential = (torch.as_tensor(potential, dtype=torch.float64)
+                           - torch.as_tensor(prev_potential, dtype=torch.float64))
+        delta_energy += delta_potential * num_data
+        if self.num_chains is None:
+            return delta_energy.item()
+        # one value per chain
+        return delta_energy.numpy()
 
-    def _point_energy(self, group, p, state):
+    def _point_energy(self, group, p, state) -> torch.Tensor:
         M_rsqrt = self._preconditioner_default(state, p)
-        curv = M_rsqrt**2 * group['num_data']**2 * group['b^2h^2'] / 8
-        return curv * dot(p.grad, p.grad)
+        curv = group['num_data']**2 * group['b^2h^2'] / 8
+        return curv * self._precond_dot(p.grad, M_rsqrt**2, p.grad)
+
+    def _flat_point_energy(self, group, arena) -> torch.Tensor:
+        "`_point_energy` of all the parameters in `arena`"
+        M_rsqrt, _ = self._flat_preconditioner(arena, [self.state[p] for p in arena.params])
+        curv = group['num_data']**2 * group['b^2h^2'] / 8
+        precond_grad = arena.grad * M_rsqrt
+        return curv * dot_tensor(precond_grad, precond_grad)
 
     @torch.no_grad()
     def maybe_reject(self, delta_energy: float) -> (bool, float):
@@ -56,31 +120,117 @@ class VerletSGLD(SGLD):
         if temperature == 0.0:
             return False, 0.  # Never reject
 
+        if self.num_chains is not None:
+            return self._maybe_reject_chains(delta_energy, temperature)
+
         # rand() > min(1., exp(-delta_energy / temperature))
         log_accept_prob = -delta_energy / temperature
-        reject = (math.log(torch.rand(()).item()) > log_accept_prob)
+        reject = (math.log(self._uniform()) > log_accept_prob)
         if reject:
+            self.reject()
+        return reject, log_accept_prob
+
+    @torch.no_grad()
+    def reject(self):
+        "Go back to the state saved by the last `initial_step`"
+        if self._arenas is not None:
+            for arena in self._arenas:
+                self._restore_flat_state(arena)
+        else:
+            for p, state in self.state.items():
+                self._restore_state(p, state)
+
+    def saved_parameters(self) -> typing.List[torch.Tensor]:
+        """The parameters saved by the last `initial_step`, in the order of
+        `self.param_groups`. They may be in host memory."""
+        if self._arenas is not None:
+            return [v for arena in self._arenas
+                    for v in arena.views(self._snapshot.get(arena, 'parameter'))]
+        return [self._snapshot.get(p, 'parameter') for p in self._all_params()]
+
+    def _snapshot_keys(self) -> Tuple[typing.List, typing.List[torch.Tensor]]:
+        "The keys of `_snapshot`, and tensors like the ones saved for each of them"
+        if self._arenas is not None:
+            return self._arenas, [arena.param for arena in self._arenas]
+        params = self._all_params()
+        return params, params
+
+    def state_dict(self) -> Dict:
+        "`SGLD.state_dict`, and the state saved for rejecting the next proposal"
+        state_dict = super().state_dict()
+        keys, _ = self._snapshot_keys()
+        state_dict['snapshot'] = self._snapshot.state_dict(keys)
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict):
+        state_dict = dict(state_dict)
+        snapshot = state_dict.pop('snapshot', None)
+        super().load_state_dict(state_dict)
+        if snapshot is not None:
+            keys, like = self._snapshot_keys()
+            self._snapshot.load_state_dict(keys, snapshot, like)
+
+    def _uniform(self, num_chains=None):
+        "Uniform numbers for the M-H test, one per chain if `num_chains`"
+        if self.rng is None:
+            if num_chains is None:
+                return torch.rand(()).item()
+            return torch.rand(num_chains, dtype=torch.float64).numpy()
+        if num_chains is None:
+            return self.rng.uniform("reject")
+        return np.array([self.rng.uniform("reject", c) for c in range(num_chains)])
+
+    def _maybe_reject_chains(self, delta_energy, temperature):
+        "`maybe_reject`, with an independent decision for each chain"
+        log_accept_prob = -np.asarray(delta_energy) / temperature
+        reject = np.log(self._uniform(self.num_chains)) > log_accept_prob
+        if reject.any():
+            reject_t = torch.from_numpy(reject)
+            # Only some chains go back, so this is a copy rather than a swap
+            snapshot = self._snapshot
             for p, state in self.state.items():
-                p.data.copy_(state['prev_parameter'])
-                p.grad.copy_(state['prev_grad'])
-                try:
-                    state['momentum_buffer'].copy_(state['prev_momentum_buffer'])
-                except KeyError:
-                    pass
+                mask = self._chain_view(reject_t.to(p.device), p)
+                p.data.copy_(torch.where(mask, snapshot.get(p, 'parameter').to(p), p))
+                p.grad.copy_(torch.where(mask, snapshot.get(p, 'grad').to(p), p.grad))
+                if snapshot.has(p, 'momentum_buffer'):
+                    m = state['momentum_buffer']
+                    m.copy_(torch.where(mask, snapshot.get(p, 'momentum_buffer').to(m), m))
         return reject, log_accept_prob
 
     def _save_state(self, group, p, state):
-        try:
-            state['prev_parameter'].copy_(p)
-            state['prev_grad'].copy_(p.grad)
-            if group['momentum'] > 0:
-                state['prev_momentum_buffer'].copy_(state['momentum_buffer'])
-        except KeyError:
-            state['prev_parameter'] = p.detach().to(device='cpu', copy=True)
-            state['prev_grad'] = p.grad.detach().to(device='cpu', copy=True)
-            if group['momentum'] > 0:
-                state['prev_momentum_buffer'] = state['momentum_buffer'].to(
-                    device='cpu', copy=True)
+        self._snapshot.save(p, 'parameter', p.detach())
+        self._snapshot.save(p, 'grad', p.grad)
+        # BAOAB moves the parameters with the saved momentum before refreshing it
+        if group['momentum'] > 0 or self.splitting == "BAOAB":
+            self._snapshot.save(p, 'momentum_buffer', state['momentum_buffer'])
+
+    def _restore_state(self, p, state):
+        "Go back to the last `_save_state`, swapping tensors if possible"
+        snapshot = self._snapshot
+        p.data = snapshot.restore(p, 'parameter', p.data)
+        p.grad = snapshot.restore(p, 'grad', p.grad)
+        if snapshot.has(p, 'momentum_buffer'):
+            state['momentum_buffer'] = snapshot.restore(
+                p, 'momentum_buffer', state['momentum_buffer'])
+
+    def _save_flat_state(self, group, arena):
+        self._snapshot.save(arena, 'parameter', arena.param)
+        self._snapshot.save(arena, 'grad', arena.grad)
+        # BAOAB moves the parameters with the saved momentum before refreshing it
+        if group['momentum'] > 0 or self.splitting == "BAOAB":
+            self._snapshot.save(arena, 'momentum_buffer', arena.buffers['momentum_buffer'])
+
+    def _restore_flat_state(self, arena):
+        "Go back to the last `_save_flat_state`, swapping buffers if possible"
+        snapshot = self._snapshot
+        arena.set_storage_(snapshot.restore(arena, 'parameter', arena.param),
+                           snapshot.restore(arena, 'grad', arena.grad))
+        if snapshot.has(arena, 'momentum_buffer'):
+            momentum = snapshot.restore(arena, 'momentum_buffer', arena.buffers['momentum_buffer'])
+            if momentum is not arena.buffers['momentum_buffer']:
+                arena.buffers['momentum_buffer'] = momentum
+                for p, m in zip(arena.params, arena.views(momentum)):
+                    self.state[p]['momentum_buffer'] = m
 
     @torch.no_grad()
     def initial_step(self, closure: Optional[Callable[..., torch.Tensor]]=None,
@@ -95,10 +245,11 @@ class VerletSGLD(SGLD):
         self._step_count = getattr(self, '_step_count', 0) + 1
         def update_group_fn(g):
             self._update_group_fn(g)
-            a = g['momentum']
-            g['mom_decay'] = math.sqrt(a)
             g['grad_v'] = 1.
-            g['noise_std'] = math.sqrt((1 - a) * g['temperature'])
+            if self.splitting == "OBABO":
+                a = g['momentum']
+                g['mom_decay'] = math.sqrt(a)
+                g['noise_std'] = math.sqrt((1 - a) * g['temperature'])
         return self._step_internal(update_group_fn, self._step_fn, closure,
                                    is_initial=True, save_state=save_state,
                                    calc_metrics=calc_metrics)
@@ -128,10 +279,12 @@ class VerletSGLD(SGLD):
         self._step_count = getattr(self, '_step_count', 0) + 1
         def update_group_fn(g):
             self._update_group_fn(g)
-            a = g['momentum']
-            g['mom_decay'] = math.sqrt(a)
-            g['grad_v'] = g['mom_decay']
-            g['noise_std'] = math.sqrt((1 - a) * g['temperature'])
+            g['grad_v'] = 1.
+            if self.splitting == "OBABO":
+                a = g['momentum']
+                g['mom_decay'] = math.sqrt(a)
+                g['grad_v'] = g['mom_decay']
+                g['noise_std'] = math.sqrt((1 - a) * g['temperature'])
         return self._step_internal(update_group_fn, self._step_fn, closure,
                                    is_final=True, calc_metrics=calc_metrics)
 
@@ -142,9 +295,14 @@ class VerletSGLD(SGLD):
 
         a = g['momentum']
         g['mom_decay'] = a
-        g['grad_v'] = 1 + a
+        # Size of the gradient kick, in half steps
+        g['grad_v'] = (1 + a if self.splitting == "OBABO" else 2.)
         g['noise_std'] = math.sqrt((1 - a**2) * g['temperature'])
 
+    _step_size_keys = ("b^2h^2", "bh", "bhn", "noise_std")
+
+    def _draws_step_noise(self, group) -> bool:
+        return True
 
     def _step_fn(self, group, p, state, is_initial=False, is_final=False,
                  save_state=False, calc_metrics=True):
@@ -154,44 +312,223 @@ class VerletSGLD(SGLD):
         u(n) is not the momentum, rather, it is
         u(n) = sqrt(b)*m(n) + dependent gaussian noise
         """
+        if self.splitting == "BAOAB":
+            return self._baoab_step_fn(group, p, state, is_initial=is_initial,
+                                       is_final=is_final, save_state=save_state,
+                                       calc_metrics=calc_metrics)
         if save_state:
             self._save_state(group, p, state)
         M_rsqrt = self._preconditioner_default(state, p)
 
         # Gradient step on the new_momentum
         old_momentum = state['momentum_buffer']
-        new_momentum = torch.randn_like(p).mul_(group['noise_std'])
-        grad_lr = -.5 * group['grad_v'] * group['bhn'] * M_rsqrt
-        new_momentum.add_(p.grad, alpha=grad_lr)
+        new_momentum = self._noise_like(group, p).mul_(group['noise_std'])
+        precond_add_(new_momentum, M_rsqrt, p.grad, -.5 * group['grad_v'] * group['bhn'])
         if group['mom_decay'] > 0:
             new_momentum.add_(old_momentum, alpha=group['mom_decay'])
 
-        # Calculate this steps's contribution to the energy difference
-        c_gm = -.5 * group['bhn'] * M_rsqrt
+        self._accumulate_energy(group, p, state, old_momentum, new_momentum,
+                                M_rsqrt, is_initial=is_initial)
+        if calc_metrics:
+            self._temperature_metrics(group, p, state, old_momentum,
+                                      new_momentum, is_final=is_final)
+
+        state['momentum_buffer'] = new_momentum
+        if not is_final:
+            precond_add_(p, M_rsqrt, new_momentum, group['bh'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            state['square_avg'].mul_(alpha).addcmul_(p.grad, p.grad, value=1 - alpha)
+
+    def _fused_step_fn(self, group, params, states, is_initial=False,
+                       is_final=False, save_state=False, calc_metrics=True):
+        "Same as `_step_fn`, but for all the parameters in `group` at once."
+        if len(params) == 0:
+            return
+        if self.splitting == "BAOAB":
+            # Not worth fusing: loop, with the same random numbers as `_step_fn`
+            for p, state in zip(params, states):
+                self._baoab_step_fn(group, p, state, is_initial=is_initial,
+                                    is_final=is_final, save_state=save_state,
+                                    calc_metrics=calc_metrics)
+            return
+        if save_state:
+            for p, state in zip(params, states):
+                self._save_state(group, p, state)
+        M_rsqrt = [self._preconditioner_default(s, p) for p, s in zip(params, states)]
+        grads = [p.grad for p in params]
+
+        # Gradient step on the new_momentum
+        old_momenta = [s['momentum_buffer'] for s in states]
+        new_momenta = [self._noise_like(group, p) for p in params]
+        torch._foreach_mul_(new_momenta, group['noise_std'])
+        torch._foreach_add_(new_momenta, torch._foreach_mul(grads, M_rsqrt),
+                            alpha=-.5 * group['grad_v'] * group['bhn'])
+        if group['mom_decay'] > 0:
+            torch._foreach_add_(new_momenta, old_momenta, alpha=group['mom_decay'])
+
+        for p, s, old, new, M in zip(params, states, old_momenta, new_momenta, M_rsqrt):
+            self._accumulate_energy(group, p, s, old, new, M, is_initial=is_initial)
+            if calc_metrics:
+                self._temperature_metrics(group, p, s, old, new, is_final=is_final)
+            s['momentum_buffer'] = new
+
+        if not is_final:
+            torch._foreach_add_(params, torch._foreach_mul(new_momenta, M_rsqrt),
+                                alpha=group['bh'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            square_avgs = [s['square_avg'] for s in states]
+            torch._foreach_mul_(square_avgs, alpha)
+            torch._foreach_addcmul_(square_avgs, grads, grads, value=1 - alpha)
+
+    def _flat_step_fn(self, group, arena, states, is_initial=False,
+                      is_final=False, save_state=False, calc_metrics=True):
+        "Same as `_step_fn`, but with a few operations on the whole `arena`."
+        if self.splitting == "BAOAB":
+            return self._flat_baoab_step_fn(group, arena, states, is_initial=is_initial,
+                                            is_final=is_final, save_state=save_state,
+                                            calc_metrics=calc_metrics)
+        if save_state:
+            self._save_flat_state(group, arena)
+        M_rsqrt, _ = self._flat_preconditioner(arena, states)
+        grad = arena.grad
+
+        # Gradient step on the new_momentum
+        momentum = arena.buffers['momentum_buffer']
+        new_momentum = self._flat_noise(group, arena).mul_(group['noise_std'])
+        scaled_addcmul_(new_momentum, grad, M_rsqrt, -.5 * group['grad_v'] * group['bhn'])
+        if group['mom_decay'] > 0:
+            new_momentum.add_(momentum, alpha=group['mom_decay'])
+
+        # Calculate this steps's contribution to the energy difference, for
+        # the whole group at once
+        group_state = arena.group_state
+        c_gm = -.5 * group['bhn']
+        precond_grad = grad * M_rsqrt
         if is_initial:
-            state['delta_energy'] = -self._point_energy(group, p, state)
+            group_state['delta_energy'] = -self._flat_point_energy(group, arena)
         else:
-            state['delta_energy'] += state['prev_new_momentum_delta']
-            state['delta_energy'] += c_gm * dot(p.grad, old_momentum)
-        state['prev_new_momentum_delta'] = c_gm * dot(p.grad, new_momentum)
+            group_state['delta_energy'] += group_state['prev_new_momentum_delta']
+            group_state['delta_energy'] += c_gm * dot_tensor(precond_grad, momentum)
+        group_state['prev_new_momentum_delta'] = c_gm * dot_tensor(precond_grad, new_momentum)
 
         if calc_metrics:
-            # Temperature diagnostics
-            d = p.numel()
-            if is_final:
-                # If it is the final step, p and p.grad correspond to the same
-                # time step as `new_momentum`
-                state['est_temperature'] = dot(new_momentum, new_momentum) / d
-            else:
-                # the momentum is from the previous time step
-                state['est_temperature'] = dot(old_momentum, old_momentum) / d
-            # NOTE: p and p.grad are (and have to be) from the same time step
-            state['est_config_temp'] = dot(p, p.grad) * (group['num_data']/d)
+            # If it is the final step, p and p.grad correspond to the same
+            # time step as `new_momentum`. Otherwise use the momentum from the
+            # previous time step.
+            self._flat_temperature_metrics(
+                group, arena, states, (new_momentum if is_final else momentum))
 
-        state['momentum_buffer'] = new_momentum
+        # Keep the states' `momentum_buffer` views valid
+        momentum.copy_(new_momentum)
         if not is_final:
-            p.add_(new_momentum, alpha=group['bh']*M_rsqrt)
+            scaled_addcmul_(arena.param, momentum, M_rsqrt, group['bh'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            arena.buffers['square_avg'].mul_(alpha).addcmul_(grad, grad, value=1 - alpha)
+
+    def _baoab_step_fn(self, group, p, state, is_initial=False, is_final=False,
+                       save_state=False, calc_metrics=True):
+        """A transition of the BAOAB splitting, θ(n), m(n) -> θ(n+1), m(n+1).
+
+        m(n) is the momentum after the second A of the previous step, before
+        its final half B. That half B and the first half B of this step use
+        the same gradient, so they become one kick of `grad_v` half steps.
+        """
+        if save_state:
+            self._save_state(group, p, state)
+        M_rsqrt = self._preconditioner_default(state, p)
+
+        # B: kick the momentum with the gradient
+        old_momentum = state['momentum_buffer']
+        new_momentum = old_momentum.clone()
+        precond_add_(new_momentum, M_rsqrt, p.grad, -.5 * group['grad_v'] * group['bhn'])
+
+        # Change of kinetic energy of the kick. `delta_energy` adds the
+        # last step's point energy.
+        v = group['grad_v']
+        delta_energy = -.5 * group['bhn'] * v * self._precond_dot(p.grad, M_rsqrt, old_momentum)
+        if not is_final:
+            delta_energy = delta_energy + v**2 * self._point_energy(group, p, state)
+        if is_initial:
+            state['delta_energy'] = delta_energy
+        else:
+            state['delta_energy'] += delta_energy
+
+        if calc_metrics:
+            self._temperature_metrics(group, p, state, old_momentum,
+                                      new_momentum, is_final=is_final)
+        if not is_final:
+            # A, O, A
+            precond_add_(p, M_rsqrt, new_momentum, .5 * group['bh'])
+            new_momentum.mul_(group['mom_decay']).add_(
+                self._noise_like(group, p), alpha=group['noise_std'])
+            precond_add_(p, M_rsqrt, new_momentum, .5 * group['bh'])
 
             # RMSProp moving average
             alpha = group['rmsprop_alpha']
             state['square_avg'].mul_(alpha).addcmul_(p.grad, p.grad, value=1 - alpha)
+        state['momentum_buffer'] = new_momentum
+
+    def _flat_baoab_step_fn(self, group, arena, states, is_initial=False,
+                            is_final=False, save_state=False, calc_metrics=True):
+        "Same as `_baoab_step_fn`, but with a few operations on the whole `arena`."
+        if save_state:
+            self._save_flat_state(group, arena)
+        M_rsqrt, _ = self._flat_preconditioner(arena, states)
+        grad = arena.grad
+        momentum = arena.buffers['momentum_buffer']
+
+        v = group['grad_v']
+        delta_energy = -.5 * group['bhn'] * v * dot_tensor(grad * M_rsqrt, momentum)
+        if not is_final:
+            delta_energy += v**2 * self._flat_point_energy(group, arena)
+        if is_initial:
+            arena.group_state['delta_energy'] = delta_energy
+        else:
+            arena.group_state['delta_energy'] += delta_energy
+
+        if calc_metrics and not is_final:
+            # the momentum is from the previous time step
+            self._flat_temperature_metrics(group, arena, states, momentum)
+        scaled_addcmul_(momentum, grad, M_rsqrt, -.5 * v * group['bhn'])
+        if calc_metrics and is_final:
+            self._flat_temperature_metrics(group, arena, states, momentum)
+
+        if not is_final:
+            scaled_addcmul_(arena.param, momentum, M_rsqrt, .5 * group['bh'])
+            scaled_add_(momentum.mul_(group['mom_decay']),
+                        self._flat_noise(group, arena), group['noise_std'])
+            scaled_addcmul_(arena.param, momentum, M_rsqrt, .5 * group['bh'])
+
+            # RMSProp moving average
+            alpha = group['rmsprop_alpha']
+            arena.buffers['square_avg'].mul_(alpha).addcmul_(grad, grad, value=1 - alpha)
+
+    def _accumulate_energy(self, group, p, state, old_momentum, new_momentum,
+                           M_rsqrt, is_initial):
+        "Accumulates this step's contribution to the energy difference"
+        c_gm = -.5 * group['bhn']
+        if is_initial:
+            state['delta_energy'] = -self._point_energy(group, p, state)
+        else:
+            state['delta_energy'] += state['prev_new_momentum_delta']
+            state['delta_energy'] += c_gm * self._precond_dot(p.grad, M_rsqrt, old_momentum)
+        state['prev_new_momentum_delta'] = c_gm * self._precond_dot(p.grad, M_rsqrt, new_momentum)
+
+    def _temperature_metrics(self, group, p, state, old_momentum, new_momentum,
+                             is_final):
+        d = self._numel(p)
+        if is_final:
+            # If it is the final step, p and p.grad correspond to the same
+            # time step as `new_momentum`
+            state['est_temperature'] = self._dot(new_momentum, new_momentum) / d
+        else:
+            # the momentum is from the previous time step
+            state['est_temperature'] = self._dot(old_momentum, old_momentum) / d
+        # NOTE: p and p.grad are (and have to be) from the same time step
+        state['est_config_temp'] = self._dot(p, p.grad) * (group['num_data']/d)
@@ -6,3 +6,4 @@ from .google_resnet import *
 from .prior_only import *
 from .data_driven_conv_nets import *
 from .mvt_resnets import *
+from .chains import *
@@ -37,6 +37,10 @@ class AbstractModel(nn.Module, abc.ABC):
     def forward(self, x: torch.Tensor):
         "representation of p(y | x, params)"
         f = self.net(x)
+        if f.dtype in [torch.float16, torch.bfloat16]:
+            # The net ran under `torch.autocast`. Compute the likelihood in
+            # float32, so the potential does not lose precision.
+            f = f.float()
         return self.likelihood_dist(f)
 
     def log_likelihood(self, x: torch.Tensor, y: torch.Tensor, eff_num_data):
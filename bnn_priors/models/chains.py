@@ -0,0 +1,117 @@
+from .base import AbstractModel
+from torch import nn
+import torch
+from typing import Callable, Dict, Optional
+from collections import OrderedDict
+import itertools
+
+__all__ = ('MultiChainModel',)
+
+
+class MultiChainModel(nn.Module):
+    """`num_chains` independent copies of `model`, for running several Markov
+    chains in one process. The parameters and buffers of the copies are stacked
+    along a new leading dimension, and all the chains share the same batch of
+    data.
+
+    `named_parameters` and `state_dict` have the same names as `model`, with
+    the stacked tensors. `model` itself is only the definition of the network:
+    its own parameters are not used.
+
+    Arguments:
+       model: the model to copy
+       num_chains: the number of chains
+       init_fn: initializes the parameters of `model` for each chain after the
+                first. The first chain starts from the current parameters.
+                By default, sample them from the prior.
+       vectorize: evaluate all the chains with a single call, using
+                  `torch.func.vmap`. Otherwise, loop over the chains. By default,
+                  vectorize if `torch.func` exists and `model` has no batch
+                  normalization, which updates its buffers in place.
+    """
+    def __init__(self, model: AbstractModel, num_chains: int,
+                 init_fn: Optional[Callable[[AbstractModel], None]]=None,
+                 vectorize: Optional[bool]=None):
+        super().__init__()
+        assert num_chains >= 1
+        self.model = model
+        self.num_chains = num_chains
+        if init_fn is None:
+            init_fn = AbstractModel.sample_all_priors
+        if vectorize is None:
+            vectorize = hasattr(torch, "func") and not any(
+                isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules())
+        self.vectorize = vectorize
+
+        self._param_names = [n for n, _ in model.named_parameters()]
+        self._buffer_names = [n for n, _ in model.named_buffers()]
+        self._state_dict_names = list(model.state_dict().keys())
+
+        def snapshot():
+            return [v.detach().clone() for _, v in itertools.chain(
+                model.named_parameters(), model.named_buffers())]
+        first = snapshot()
+        chains = [first]
+        for _ in range(1, num_chains):
+            init_fn(model)
+            chains.append(snapshot())
+        with torch.no_grad():  # Restore the parameters of the first chain
+            for (_, v), v0 in zip(itertools.chain(model.named_parameters(),
+                                                  model.named_buffers()), first):
+                v.copy_(v0)
+
+        stacked = [torch.stack(vs) for vs in zip(*chains)]
+        n_params = len(self._param_names)
+        self.chain_params = nn.ParameterList(
+            [nn.Parameter(v) for v in stacked[:n_params]])
+        for i, v in enumerate(stacked[n_params:]):
+            self.register_buffer(f"_chain_buffer_{i}", v)
+
+    def named_parameters(self, prefix: str='', recurse: bool=True, **kwargs):
+        "The stacked parameters, with the names of the parameters of `model`"
+        return zip((prefix + n for n in self._param_names), self.chain_params)
+
+    def chain_tensors(self) -> Dict[str, torch.Tensor]:
+        "Stacked parameters and buffers, by the name they have in `model`"
+        buffers = (getattr(self, f"_chain_buffer_{i}") for i in range(len(self._buffer_names)))
+        return OrderedDict(zip(self._param_names + self._buffer_names,
+                               itertools.chain(self.chain_params, buffers)))
+
+    def state_dict(self, *args, **kwargs):
+        "The stacked `state_dict` of `model`, with a leading chain dimension"
+        tensors = self.chain_tensors()
+        return OrderedDict((k, tensors[k].detach()) for k in self._state_dict_names)
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict, strict: bool=True):
+        tensors = self.chain_tensors()
+        if strict:
+            assert set(state_dict.keys()) == set(self._state_dict_names), "keys do not match"
+        for k, v in state_dict.items():
+            tensors[k].copy_(v)
+
+    def split_potential_and_acc(self, x, y, eff_num_data):
+        """Like `AbstractModel.split_potential_and_acc`, but every output has a
+        leading chain dimension. The predictive distribution is not returned."""
+        def split(tensors):
+            with self.model.using_params(tensors):
+                loss, log_prior, potential_avg, acc, _ = (
+                    self.model.split_potential_and_acc(x, y, eff_num_data))
+            return loss, log_prior, potential_avg, acc
+
+        if self.vectorize:
+            # Validating the arguments of `torch.distributions` branches on the
+            # values, which `vmap` cannot do
+            validate_args = torch.distributions.Distribution._validate_args
+            torch.distributions.Distribution.set_default_validate_args(False)
+            try:
+                outputs = torch.func.vmap(split, randomness="different")(self.chain_tensors())
+            finally:
+                torch.distributions.Distribution.set_default_validate_args(validate_args)
+        else:
+            tensors = self.chain_tensors()
+            per_chain = [split({k: v[i] for k, v in tensors.items()})
+                         for i in range(self.num_chains)]
+            outputs = [torch.stack(o) for o in zip(*per_chain)]
+        loss, log_prior, potential_avg, acc = outputs
+        return loss, log_prior, potential_avg, acc, None
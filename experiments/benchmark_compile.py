@@ -0,0 +1,118 @@
+"""
+Compare the time per step of `SGLDRunner` with and without `compile_step`,
+for small models on which the step is dominated by Python overhead. Reports
+the startup cost (the first step), how long compiling the forward and
+backward pass and each variant of the sampler update took, and the
+steady-state time of the following steps. Every `metrics_skip` steps store
+metrics, so both variants of the update run.
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import torch
+
+from bnn_priors import exp_utils
+from bnn_priors.inference import SGLDRunner
+from bnn_priors.models import DenseNet, ClassificationConvNet
+
+parser = argparse.ArgumentParser(description='Benchmark the compiled SGLD step')
+parser.add_argument('--models', default="densenet,convnet", type=str, help='comma-separated models: densenet, convnet')
+parser.add_argument('--batch_size', default=32, type=int, help='number of data points in each batch')
+parser.add_argument('--n_steps', default=200, type=int, help='number of steps after the first one')
+parser.add_argument('--metrics_skip', default=10, type=int, help='number of steps between steps that store metrics')
+parser.add_argument('--flat', default=1, type=int, help='whether to keep the sampler state in flat buffers')
+parser.add_argument('--device', default="cpu", type=str, help='device to run on')
+parser.add_argument('--seed', default=1, type=int, help='random seed')
+parser.add_argument('--output', default=None, type=str, help='JSON file to write the results to')
+args = parser.parse_args()
+
+
+def make_model_data(name):
+    "Returns the model and a data set of `4*batch_size` points"
+    n = 4 * args.batch_size
+    if name == "densenet":
+        x = torch.randn(n, 1)
+        y = x.sin() + 0.1*torch.randn_like(x)
+        return DenseNet(x.size(-1), y.size(-1), 50, noise_std=0.1), x, y
+    if name == "convnet":
+        x = torch.randn(n, 1, 28, 28)
+        y = torch.randint(10, (n,))
+        return ClassificationConvNet(1, 28, 10, 32, depth=3), x, y
+    raise ValueError(f"model={name}")
+
+
+def compile_seconds(compiled):
+    "The compile time of a `_CompiledFunction`, or None if it did not compile"
+    return None if compiled is None else compiled.compile_seconds
+
+
+def run(model_name, compile_step, metrics_saver):
+    torch.manual_seed(args.seed)
+    model, x, y = make_model_data(model_name)
+    device = torch.device(args.device)
+    model = model.to(device)
+    dataloader = torch.utils.data.DataLoader(
+        torch.utils.data.TensorDataset(x.to(device), y.to(device)), batch_size=args.batch_size)
+    runner = SGLDRunner(model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                        sample_epochs=1, momentum=0.9, flat=bool(args.flat),
+                        metrics_saver=metrics_saver, compile_step=compile_step)
+    runner.optimizer = runner._make_optimizer(runner._params)
+    runner.optimizer.sample_momentum()
+    runner.scheduler = runner._make_scheduler(runner.optimizer)
+    batches = list(dataloader)
+
+    def step(i):
+        x_b, y_b = batches[i % len(batches)]
+        runner.step(i, x_b, y_b, store_metrics=(i % args.metrics_skip == 0))
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    start = time.perf_counter()
+    step(0)
+    first_step_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(1, args.n_steps + 1):
+        step(i)
+    seconds_per_step = (time.perf_counter() - start) / args.n_steps
+
+    updates = runner._compiled_updates or {}
+    return dict(first_step_seconds=first_step_seconds, seconds_per_step=seconds_per_step,
+                compile_seconds_forward_backward=compile_seconds(
+                    runner._forward_backward_fn if compile_step else None),
+                compile_seconds_update=compile_seconds(updates.get(False)),
+                compile_seconds_update_metrics=compile_seconds(updates.get(True)))
+
+
+def fmt_seconds(seconds):
+    return f"{'-':>8}" if seconds is None else f"{seconds:8.2f}"
+
+
+if __name__ == '__main__':
+    results = []
+    # Compile times (s) of the forward and backward pass, and of the sampler
+    # update without and with metrics. "-" if it was not compiled.
+    print(f"{'model':>10} {'compiled':>8} {'first step (s)':>15} {'fwd/bwd':>8} "
+          f"{'update':>8} {'+metrics':>8} {'ms/step':>8} {'speedup':>8}")
+    for model_name in args.models.split(","):
+        eager_seconds = None
+        for compile_step in [False, True]:
+            with TemporaryDirectory() as tmpdir, \
+                    exp_utils.HDF5Metrics(Path(tmpdir)/"metrics.h5", "w") as metrics_saver:
+                r = run(model_name, compile_step, metrics_saver)
+            if eager_seconds is None:
+                eager_seconds = r["seconds_per_step"]
+            r.update(model=model_name, compile_step=compile_step,
+                     speedup=eager_seconds / r["seconds_per_step"])
+            results.append(r)
+            print(f"{model_name:>10} {str(compile_step):>8} {r['first_step_seconds']:15.3f} "
+                  f"{fmt_seconds(r['compile_seconds_forward_backward'])} "
+                  f"{fmt_seconds(r['compile_seconds_update'])} "
+                  f"{fmt_seconds(r['compile_seconds_update_metrics'])} "
+                  f"{1000*r['seconds_per_step']:8.3f} {r['speedup']:8.2f}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,90 @@
+"""
+Compare the layouts of the samples file of `HDF5ModelSaver` for ResNets: how
+fast the samples are written, how fast they are read back for evaluation,
+all at once (`load_samples`) and one sample at a time (`LazySamples`), and
+how large the file is.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+from bnn_priors import exp_utils
+from bnn_priors.models import PreActResNet18, ThinPreActResNet18, ResNet
+
+parser = argparse.ArgumentParser(description='Benchmark the layouts of the HDF5 samples file')
+parser.add_argument('--models', default="resnet20,thin_resnet18,resnet18", type=str, help='comma-separated models: resnet20, thin_resnet18, resnet18')
+parser.add_argument('--n_samples', default=100, type=int, help='number of samples to write and read')
+parser.add_argument('--layouts', default="1,8,8:lzf,8:gzip", type=str, help='comma-separated layouts: chunk size, optionally followed by ":" and a compression')
+parser.add_argument('--queue_size', default=0, type=int, help='number of writes that can wait for the background thread')
+parser.add_argument('--seed', default=1, type=int, help='random seed')
+parser.add_argument('--output', default=None, type=str, help='JSON file to write the results to')
+args = parser.parse_args()
+
+
+def make_model(name):
+    if name == "resnet20":
+        return ResNet(depth=20)
+    if name == "thin_resnet18":
+        return ThinPreActResNet18()
+    if name == "resnet18":
+        return PreActResNet18()
+    raise ValueError(f"model={name}")
+
+
+def run(model_name, chunk_size, compression):
+    torch.manual_seed(args.seed)
+    model = make_model(model_name)
+    state_dict = model.state_dict()
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)/"samples.h5"
+
+        start = time.perf_counter()
+        with exp_utils.HDF5ModelSaver(path, "w", queue_size=args.queue_size,
+                                      chunk_size=chunk_size, n_rows=args.n_samples,
+                                      compression=compression,
+                                      shuffle=(compression is not None)) as saver:
+            for step in range(args.n_samples):
+                # Like a sampler, change the parameters between samples
+                for p in model.parameters():
+                    p.data.add_(torch.randn_like(p), alpha=0.01)
+                saver.add_state_dict(state_dict, step)
+        write_seconds = time.perf_counter() - start
+        file_bytes = os.path.getsize(path)
+
+        start = time.perf_counter()
+        exp_utils.load_samples(path, keep_steps=False)
+        read_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        samples = exp_utils.LazySamples(path, keep_steps=False)
+        for sample in exp_utils.sample_iter(samples):
+            pass
+        lazy_read_seconds = time.perf_counter() - start
+    return dict(write_samples_per_s=args.n_samples / write_seconds,
+                read_samples_per_s=args.n_samples / read_seconds,
+                lazy_read_samples_per_s=args.n_samples / lazy_read_seconds,
+                file_megabytes=file_bytes / 2**20)
+
+
+if __name__ == '__main__':
+    results = []
+    print(f"{'model':>14} {'chunk':>6} {'compression':>12} {'write/s':>8} {'read/s':>8} "
+          f"{'lazy/s':>8} {'MB':>8}")
+    for model_name in args.models.split(","):
+        for layout in args.layouts.split(","):
+            chunk_size, _, compression = layout.partition(":")
+            chunk_size, compression = int(chunk_size), (compression or None)
+            r = run(model_name, chunk_size, compression)
+            r.update(model=model_name, chunk_size=chunk_size, compression=compression)
+            results.append(r)
+            print(f"{model_name:>14} {chunk_size:6d} {str(compression):>12} "
+                  f"{r['write_samples_per_s']:8.1f} {r['read_samples_per_s']:8.1f} "
+                  f"{r['lazy_read_samples_per_s']:8.1f} {r['file_megabytes']:8.1f}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,100 @@
+"""
+Compare the bias of the configurational temperature of the SGLD integrators,
+as a function of the learning rate. Uses full-batch gradients, so the bias
+comes only from the discretization, and a model with known temperature 1.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from bnn_priors import mcmc
+from bnn_priors.models import GaussianModel, DenseNet
+
+parser = argparse.ArgumentParser(description='Benchmark the configurational temperature bias of SGLD integrators')
+parser.add_argument('--models', default="gaussian,densenet", type=str, help='comma-separated models: gaussian, densenet')
+parser.add_argument('--integrators', default="SGLD,OBABO,BAOAB", type=str, help='comma-separated integrators: SGLD, OBABO, BAOAB')
+parser.add_argument('--lrs', default="1e-3,3e-3,1e-2,3e-2,1e-1", type=str, help='comma-separated learning rates')
+parser.add_argument('--momentum', default=0.9, type=float, help='momentum of the samplers')
+parser.add_argument('--n_steps', default=2000, type=int, help='number of steps; the first half is burn-in')
+parser.add_argument('--n_data', default=100, type=int, help='number of data points for the DenseNet')
+parser.add_argument('--seed', default=1, type=int, help='random seed')
+parser.add_argument('--output', default=None, type=str, help='JSON file to write the results to')
+args = parser.parse_args()
+
+
+def make_model(name):
+    "Returns the model, its closure for the average potential, and num_data"
+    if name == "gaussian":
+        model = GaussianModel(N=10, D=100, mean=1., std=2.)
+        return model, model.potential_avg_closure, 1
+    if name == "densenet":
+        x = torch.randn(args.n_data, 1)
+        y = x.sin() + 0.1*torch.randn_like(x)
+        model = DenseNet(x.size(-1), y.size(-1), 50, noise_std=0.1)
+        def closure():
+            model.zero_grad()
+            v = model.potential_avg(x, y, eff_num_data=args.n_data)
+            v.backward()
+            return v
+        return model, closure, args.n_data
+    raise ValueError(f"model={name}")
+
+
+def make_optimizer(integrator, params, lr, num_data):
+    if integrator == "SGLD":
+        return mcmc.SGLD(params, lr=lr, num_data=num_data, momentum=args.momentum)
+    return mcmc.VerletSGLD(params, lr=lr, num_data=num_data, momentum=args.momentum,
+                           splitting=integrator)
+
+
+def config_temperature(optimizer):
+    "Mean of the configurational temperature over all the elements"
+    numels = np.array([p.numel() for p in optimizer._all_params()])
+    temps = optimizer.diagnostics()['est_config_temp']
+    return float((temps * numels).sum() / numels.sum())
+
+
+def run(model_name, integrator, lr):
+    torch.manual_seed(args.seed)
+    model, closure, num_data = make_model(model_name)
+    model.sample_all_priors()
+    optimizer = make_optimizer(integrator, model.parameters(), lr, num_data)
+    optimizer.sample_momentum()
+
+    temps = []
+    start = time.perf_counter()
+    for i in range(args.n_steps):
+        if i == 0:
+            optimizer.initial_step(closure)
+        else:
+            optimizer.step(closure)
+        if i >= args.n_steps // 2:
+            temps.append(config_temperature(optimizer))
+    seconds_per_step = (time.perf_counter() - start) / args.n_steps
+
+    temps = np.array(temps)
+    if not np.isfinite(temps).all():
+        return dict(config_temp=float("nan"), bias=float("nan"),
+                    seconds_per_step=seconds_per_step)
+    return dict(config_temp=float(temps.mean()),
+                bias=float(temps.mean() - 1.),
+                seconds_per_step=seconds_per_step)
+
+
+if __name__ == '__main__':
+    results = []
+    print(f"{'model':>10} {'integrator':>10} {'lr':>8} {'config_temp':>12} {'bias':>9} {'ms/step':>8}")
+    for model_name in args.models.split(","):
+        for integrator in args.integrators.split(","):
+            for lr in map(float, args.lrs.split(",")):
+                r = run(model_name, integrator, lr)
+                r.update(model=model_name, integrator=integrator, lr=lr)
+                results.append(r)
+                print(f"{model_name:>10} {integrator:>10} {lr:8.1e} {r['config_temp']:12.4f} "
+                      f"{r['bias']:+9.4f} {1000*r['seconds_per_step']:8.3f}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -84,12 +84,15 @@ def main(config_file, batch_size, run_dir, eval_data, data, skip_first, model,
     with open(run_dir/"run.json") as infile:
         run_data = json.load(infile)
 
-    samples = exp_utils.load_samples(run_dir/"samples.pt",
+    # The samples are read from the file as they are evaluated
+    samples = exp_utils.open_samples(run_dir/"samples.pt",
                                      idx=np.s_[skip_first:])
     with h5py.File(run_dir/"metrics.h5", "r") as metrics_file:
         exp_utils.reject_samples_(samples, metrics_file)
     del samples["steps"]
     del samples["timestamps"]
+    # Samples of several chains are evaluated together
+    samples.pop("chains", None)
     for s in samples.items ():
         assert len(s)>0, f"we have less than {skip_first} samples"
 
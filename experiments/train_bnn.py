@@ -6,6 +6,8 @@ import os
 import math
 import uuid
 import json
+import inspect
+import logging
 import contextlib
 
 import numpy as np
@@ -18,7 +20,7 @@ from sacred.utils import apply_backspaces_and_linefeeds
 from sacred.observers import FileStorageObserver
 
 from bnn_priors.data import UCI, CIFAR10, Synthetic
-from bnn_priors.models import RaoBDenseNet, DenseNet, PreActResNet18, PreActResNet34
+from bnn_priors.models import RaoBDenseNet, DenseNet, PreActResNet18, PreActResNet34, MultiChainModel
 from bnn_priors.prior import LogNormal
 from bnn_priors import prior
 import bnn_priors.inference
@@ -39,7 +41,8 @@ ex.captured_out_filter = apply_backspaces_and_linefeeds
 def config():
     # the dataset to be trained on, e.g., "mnist", "cifar10", "UCI_boston"
     data = "mnist"
-    # the inference method to be used, defaults to GGMC from https://arxiv.org/abs/2102.01691
+    # the inference method to be used, defaults to GGMC from https://arxiv.org/abs/2102.01691.
+    # "HMC" is Pyro's HMC, "FullBatchHMC" is `inference_reject.FullBatchHMCRunner`
     inference = "VerletSGLDReject"
     # model to be used, e.g., "classificationdensenet", "classificationconvnet", "googleresnet"
     model = "classificationconvnet"
@@ -99,12 +102,73 @@ def config():
     batch_size = 128
     # whether to use Metropolis-Hastings rejection steps (works only with some integrators)
     reject_samples = False
+    # whether to update all parameters at once with multi-tensor operations
+    fused = False
+    # whether to store parameters and sampler state in one contiguous buffer
+    flat = (inference == "FullBatchHMC")
+    # "scalar": one preconditioner value per parameter, "elementwise": one per element
+    precond_type = "scalar"
+    # "bfloat16" or "float16" to compute the potential and gradient in reduced
+    # precision; the parameters and sampler state stay in float32. None for float32
+    autocast_dtype = None
+    # adapt the learning rate during warmup to reach `target_accept` (Reject runners only)
+    adapt_lr = False
+    # target M-H acceptance probability for `adapt_lr`
+    target_accept = 0.8
+    # number of leapfrog steps in each trajectory of "FullBatchHMC"
+    n_leapfrog = 32
+    # "exact": M-H test with the whole training set. "sequential": decide from a
+    # growing random subset of it, with error `mh_test_error` per t-test (Reject runners only)
+    mh_test = "exact"
+    mh_test_error = 0.05
+    # reduce the variance of the minibatch gradients with a control variate
+    # at an anchor point, moved every `anchor_update` epochs (None: once per cycle)
+    control_variate = False
+    anchor_update = None
+    # "group" or "element": adapt the friction with a Nosé-Hoover thermostat
+    # (SGNHT), at speed `thermostat_rate` (None: the default). Only for SGLD and VerletSGLD
+    thermostat = None
+    thermostat_rate = None
+    # splitting integrator of VerletSGLD: "OBABO" or "BAOAB"
+    splitting = "OBABO"
+    # temperature ladder of "ParallelTempering", one chain per temperature, and
+    # the number of steps between swaps of neighbouring chains
+    pt_temperatures = [1., 1.5, 2.25, 3.375]
+    swap_every = 10
+    # seed of the independent generators, seeded by hashing (seed, key), for the
+    # sampler noise, M-H tests and data order, instead of the global generator.
+    # None uses the global one
+    rng_seed = None
+    # number of epochs between checkpoints of the whole state of the sampler,
+    # written in the background. Each one waits for the samples and metrics to
+    # be written. None disables them
+    checkpoint_every = None
+    # directory of an earlier run to continue from its last checkpoint. The
+    # chain continues exactly, and its samples and metrics files are appended to
+    resume = None
+    # compile the forward and backward pass of each step with `torch.compile`
+    compile_step = False
+    # number of writes of samples and metrics that can wait for a background
+    # thread, so the sampler does not wait for the disk. 0 writes them in the loop
+    io_queue_size = 4
+    # largest per-example gradient table that SAGA-LD may allocate
+    saga_max_table_bytes = 2**30
+    # number of chains to run at once, stacked in one model. None for one chain
+    num_chains = None
+    # number of independent chains to run in separate worker processes, which
+    # share the data set in memory. None runs one chain in this process
+    parallel_chains = None
     # whether to use batch normalization
     batchnorm = True
     # device to use, "cpu", "cuda:0", "try_cuda"
     device = "try_cuda"
     # whether the samples should be saved
     save_samples = True
+    # number of samples in each HDF5 chunk of the samples file. Larger chunks
+    # are faster to read back and compress better
+    samples_chunk_size = 1
+    # lossless compression of the samples file: None, "gzip" or "lzf"
+    samples_compression = None
     # whether a progressbar should be plotted to stdout during the training
     progressbar = True
     # a random unique ID for the run
@@ -152,74 +216,85 @@ def evaluate_model(model, dataloader_test, samples):
         calibration_eval=False)
 
 
-@ex.automain
-def main(inference, model, width, n_samples, warmup, init_method, burnin, skip,
-         metrics_skip, cycles, temperature, momentum, precond_update, lr,
-         batch_size, load_samples, save_samples, reject_samples, run_id,
-         log_dir, sampling_decay, progressbar, skip_first, _run, _log):
-    assert inference in ["SGLD", "HMC", "VerletSGLD", "OurHMC", "HMCReject", "VerletSGLDReject", "SGLDReject"]
-    assert width > 0
-    assert n_samples > 0
-    assert cycles > 0
-    assert temperature >= 0
-
-    data = get_data()
-
+def _run_chain(config, data, samples_path, metrics_path, checkpoint_path, log, progressbar):
+    """Initializes a model and runs the sampler with `config`, writing to
+    `samples_path`, `metrics_path` and `checkpoint_path`. If `resume` is set,
+    continues from the checkpoint and appends to the files. Returns the model
+    and the samples after the first `skip_first` steps."""
+    c = config
+    resume = c["resume"] is not None
+    mode = ("a" if resume else "w")
     x_train = data.norm.train_X
     y_train = data.norm.train_y
 
-    x_test = data.norm.test_X
-    y_test = data.norm.test_y
-
-    model = get_model(x_train=x_train, y_train=y_train)
+    model = exp_utils.get_model(x_train=x_train, y_train=y_train, **{
+        k: c[k] for k in inspect.signature(exp_utils.get_model).parameters
+        if k not in ["x_train", "y_train"]})
 
-    if load_samples is None:
-        if init_method == "he":
+    if c["load_samples"] is None:
+        if c["init_method"] == "he":
             exp_utils.he_initialize(model)
-        elif init_method == "he_uniform":
+        elif c["init_method"] == "he_uniform":
             exp_utils.he_uniform_initialize(model)
-        elif init_method == "he_zerobias":
+        elif c["init_method"] == "he_zerobias":
             exp_utils.he_zerobias_initialize(model)
-        elif init_method == "prior":
+        elif c["init_method"] == "prior":
             pass
         else:
-            raise ValueError(f"unknown init_method={init_method}")
+            raise ValueError(f"unknown init_method={c['init_method']}")
     else:
-        state_dict = exp_utils.load_samples(load_samples, idx=-1, keep_steps=False)
+        state_dict = exp_utils.load_samples(c["load_samples"], idx=-1, keep_steps=False)
         model_sd = model.state_dict()
         for k in state_dict.keys():
             if k not in model_sd:
-                _log.warning(f"key {k} not in model, ignoring")
+                log.warning(f"key {k} not in model, ignoring")
                 del state_dict[k]
             elif model_sd[k].size() != state_dict[k].size():
-                _log.warning(f"key {k} size mismatch, model={model_sd[k].size()}, loaded={state_dict[k].size()}")
+                log.warning(f"key {k} size mismatch, model={model_sd[k].size()}, loaded={state_dict[k].size()}")
                 state_dict[k] = model_sd[k]
 
         missing_keys = set(model_sd.keys()) - set(state_dict.keys())
-        _log.warning(f"The following keys were not found in loaded state dict: {missing_keys}")
+        log.warning(f"The following keys were not found in loaded state dict: {missing_keys}")
         model_sd.update(state_dict)
         model.load_state_dict(model_sd)
         del state_dict
         del model_sd
 
-    if save_samples:
+    inference = c["inference"]
+    num_chains = _num_chains(c)
+    base_model = model
+    if num_chains is not None:
+        assert inference not in ["HMC", "FullBatchHMC"], "HMC samples one chain"
+        # The other chains start from the same kind of initialization
+        init_fn = {"he": exp_utils.he_initialize,
+                   "he_uniform": exp_utils.he_uniform_initialize,
+                   "he_zerobias": exp_utils.he_zerobias_initialize,
+                   "prior": None}[c["init_method"]]
+        model = MultiChainModel(base_model, num_chains, init_fn=init_fn)
+
+    if c["save_samples"]:
         model_saver_fn = (lambda: exp_utils.HDF5ModelSaver(
-            exp_utils.sneaky_artifact(_run, "samples.pt"), "w"))
+            samples_path, mode, queue_size=c["io_queue_size"],
+            chunk_size=c["samples_chunk_size"], n_rows=c["n_samples"] * (num_chains or 1),
+            compression=c["samples_compression"], shuffle=(c["samples_compression"] is not None)))
     else:
         @contextlib.contextmanager
         def model_saver_fn():
             yield None
 
-    with exp_utils.HDF5Metrics(
-            exp_utils.sneaky_artifact(_run, "metrics.h5"), "w") as metrics_saver,\
+    batch_size = c["batch_size"]
+    with exp_utils.HDF5Metrics(metrics_path, mode, queue_size=c["io_queue_size"]) as metrics_saver,\
          model_saver_fn() as model_saver:
+        run_kwargs = {}
         if inference == "HMC":
+            assert not resume, "Pyro's HMC cannot resume from a checkpoint"
             _potential_fn = model.get_potential(x_train, y_train, eff_num_data=len(x_train))
             kernel = HMC(potential_fn=_potential_fn,
                          adapt_step_size=False, adapt_mass_matrix=False,
                          step_size=1e-3, num_steps=32)
-            mcmc = MCMC(kernel, num_samples=n_samples, warmup_steps=warmup, initial_params=model.params_dict())
+            mcmc = MCMC(kernel, num_samples=c["n_samples"], warmup_steps=c["warmup"], initial_params=model.params_dict())
         else:
+            runner_kwargs = {}
             if inference == "SGLD":
                 runner_class = bnn_priors.inference.SGLDRunner
             elif inference == "VerletSGLD":
@@ -232,10 +307,21 @@ def main(inference, model, width, n_samples, warmup, init_method, burnin, skip,
                 runner_class = bnn_priors.inference_reject.HMCRunnerReject
             elif inference == "SGLDReject":
                 runner_class = bnn_priors.inference_reject.SGLDRunnerReject
+            elif inference == "ParallelTempering":
+                runner_class = bnn_priors.inference.ParallelTemperingRunner
+                runner_kwargs["temperatures"] = c["pt_temperatures"]
+                runner_kwargs["swap_every"] = c["swap_every"]
+            elif inference == "SAGALD":
+                runner_class = bnn_priors.inference.SAGALDRunner
+                runner_kwargs["max_table_bytes"] = c["saga_max_table_bytes"]
+            elif inference == "FullBatchHMC":
+                runner_class = bnn_priors.inference_reject.FullBatchHMCRunner
+                runner_kwargs["n_leapfrog"] = c["n_leapfrog"]
 
+            n_samples, skip, cycles = c["n_samples"], c["skip"], c["cycles"]
             assert (n_samples * skip) % cycles == 0
             sample_epochs = n_samples * skip // cycles
-            epochs_per_cycle = warmup + burnin + sample_epochs
+            epochs_per_cycle = c["warmup"] + c["burnin"] + sample_epochs
             if batch_size is None:
                 batch_size = len(data.norm.train)
             # Disable parallel loading for `TensorDataset`s.
@@ -243,17 +329,115 @@ def main(inference, model, width, n_samples, warmup, init_method, burnin, skip,
             dataloader = t.utils.data.DataLoader(data.norm.train, batch_size=batch_size, shuffle=True, drop_last=False, num_workers=num_workers)
             dataloader_test = t.utils.data.DataLoader(data.norm.test, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=num_workers)
             mcmc = runner_class(model=model, dataloader=dataloader, dataloader_test=dataloader_test, epochs_per_cycle=epochs_per_cycle,
-                                warmup_epochs=warmup, sample_epochs=sample_epochs, learning_rate=lr,
-                                skip=skip, metrics_skip=metrics_skip, sampling_decay=sampling_decay, cycles=cycles, temperature=temperature,
-                                momentum=momentum, precond_update=precond_update,
-                                metrics_saver=metrics_saver, model_saver=model_saver, reject_samples=reject_samples)
+                                warmup_epochs=c["warmup"], sample_epochs=sample_epochs, learning_rate=c["lr"],
+                                skip=skip, metrics_skip=c["metrics_skip"], sampling_decay=c["sampling_decay"], cycles=cycles, temperature=c["temperature"],
+                                momentum=c["momentum"], precond_update=c["precond_update"],
+                                metrics_saver=metrics_saver, model_saver=model_saver, reject_samples=c["reject_samples"],
+                                fused=c["fused"], flat=c["flat"], precond_type=c["precond_type"],
+                                adapt_lr=c["adapt_lr"], target_accept=c["target_accept"],
+                                autocast_dtype=c["autocast_dtype"],
+                                mh_test=c["mh_test"], mh_test_error=c["mh_test_error"],
+                                control_variate=c["control_variate"], anchor_update=c["anchor_update"],
+                                thermostat=c["thermostat"], thermostat_rate=c["thermostat_rate"],
+                                splitting=c["splitting"], seed=c["rng_seed"],
+                                checkpoint_path=checkpoint_path, checkpoint_every=c["checkpoint_every"],
+                                compile_step=c["compile_step"],
+                                **runner_kwargs)
+            run_kwargs["resume"] = resume
 
-        mcmc.run(progressbar=progressbar)
+        mcmc.run(progressbar=progressbar, **run_kwargs)
     samples = mcmc.get_samples()
-    samples = {k: v[skip_first:] for k, v in samples.items()}
-    model.eval()
+    samples = {k: v[_skip_rows(c):] for k, v in samples.items()}
+    return base_model, samples
+
+
+def _num_chains(config):
+    "Number of chains stacked in the model, or None"
+    if config["inference"] == "ParallelTempering" and config["num_chains"] is None:
+        return len(config["pt_temperatures"])
+    return config["num_chains"]
+
+
+def _skip_rows(config):
+    "Number of rows of the samples in the first `skip_first` steps"
+    # With several chains, every step has one sample per chain
+    return config["skip_first"] * (_num_chains(config) or 1)
+
+
+def _chain_worker(chain, seed, config, data, samples_path, metrics_path, checkpoint_path):
+    """Runs one of the independent chains in a worker process. Returns its
+    results and the path of its samples, which stay on disk."""
+    t.manual_seed(seed)
+    np.random.seed(seed)
+    if config["rng_seed"] is not None:
+        config = dict(config, rng_seed=config["rng_seed"] + chain)
+    log = logging.getLogger(f"bnn_training.chain{chain}")
+    model, samples = _run_chain(config, data, samples_path, metrics_path, checkpoint_path, log,
+                                progressbar=(config["progressbar"] and chain == 0))
+    results = exp_utils.evaluate_model(
+        model=model, dataloader_test=_test_dataloader(data, config["batch_size"]),
+        samples=samples, likelihood_eval=True, accuracy_eval=True,
+        calibration_eval=False)
+    return results, samples_path
+
+
+def _test_dataloader(data, batch_size):
+    batch_size = min(batch_size or len(data.norm.test), len(data.norm.test))
+    return t.utils.data.DataLoader(data.norm.test, batch_size=batch_size)
 
-    batch_size = min(batch_size, len(data.norm.test))
-    dataloader_test = t.utils.data.DataLoader(data.norm.test, batch_size=batch_size)
 
-    return evaluate_model(model, dataloader_test, samples)
+@ex.automain
+def main(inference, width, n_samples, cycles, temperature, batch_size,
+         parallel_chains, _config, _seed, _run, _log):
+    assert inference in ["SGLD", "SAGALD", "ParallelTempering", "HMC", "FullBatchHMC", "VerletSGLD", "OurHMC", "HMCReject", "VerletSGLDReject", "SGLDReject"]
+    assert width > 0
+    assert n_samples > 0
+    assert cycles > 0
+    assert temperature >= 0
+
+    data = get_data()
+    # A plain `dict`, that can be sent to worker processes
+    config = json.loads(json.dumps(_config))
+
+    def run_path(name):
+        "Path of the file `name` of this run, or of the run that it resumes"
+        if config["resume"] is not None:
+            return Path(config["resume"])/name
+        return exp_utils.sneaky_artifact(_run, name)
+
+    def samples_path(name):
+        return run_path(name) if config["save_samples"] else None
+
+    assert config["resume"] is None or config["checkpoint_every"] is not None, \
+        "`resume` needs the checkpoints"
+    def checkpoint_path(name):
+        return None if config["checkpoint_every"] is None else run_path(name)
+
+    if parallel_chains is None:
+        model, samples = _run_chain(
+            config, data, samples_path("samples.pt"), run_path("metrics.h5"),
+            checkpoint_path("checkpoint.pt"), _log,
+            progressbar=config["progressbar"])
+        model.eval()
+        return evaluate_model(model, _test_dataloader(data, batch_size), samples)
+
+    assert config["save_samples"], "the chains send their samples back in files"
+    assert inference != "HMC", "Pyro's HMC does not write its samples to a file"
+    # Every worker maps the same copy of the data set
+    exp_utils.share_data_(data)
+    args = [(chain, _seed + chain, config, data,
+             samples_path(f"samples_{chain}.pt"), run_path(f"metrics_{chain}.h5"),
+             checkpoint_path(f"checkpoint_{chain}.pt"))
+            for chain in range(parallel_chains)]
+    with t.multiprocessing.get_context("spawn").Pool(parallel_chains) as pool:
+        chain_outputs = pool.starmap(_chain_worker, args)
+
+    # Evaluate the samples of all chains together, one chain after the other,
+    # reading them from their files
+    model = get_model(x_train=data.norm.train_X, y_train=data.norm.train_y)
+    model.eval()
+    samples = [exp_utils.open_samples(path, idx=np.s_[_skip_rows(config):], keep_steps=False)
+               for _, path in chain_outputs]
+    results = evaluate_model(model, _test_dataloader(data, batch_size), samples)
+    results["chains"] = [r for r, _ in chain_outputs]
+    return results
@@ -5,6 +5,8 @@ from pathlib import Path
 
 from bnn_priors import exp_utils
 from bnn_priors.data import UCI, MNIST, RotatedMNIST, CIFAR10, CIFAR10_C
+from bnn_priors.models import ClassificationDenseNet
+from bnn_priors.third_party.calibration_error import ece
 import numpy as np
 import h5py
 
@@ -23,6 +25,50 @@ class TestExpUtils(unittest.TestCase):
         assert isinstance(exp_utils.get_data("mnist", device), MNIST)
         assert isinstance(exp_utils.get_data("rotated_mnist", device), RotatedMNIST)
 
+    def test_share_data(self):
+        data = exp_utils.share_data_(exp_utils.get_data("UCI_boston", torch.device("cpu")))
+        for split in [data.norm, data.unnorm]:
+            for v in [split.X, split.train_X, split.train_y, split.test_X, split.test_y]:
+                assert v.is_shared()
+            assert split.train.tensors[0] is split.train_X
+
+    def test_evaluate_model(self, N=50, n_samples=6, batch_size=16):
+        "The streaming ensemble gives the metrics of all the predictions at once"
+        torch.manual_seed(1)
+        x = torch.randn(N, 3)
+        y = torch.randint(0, 4, (N,))
+        model = ClassificationDenseNet(3, 4, 16)
+        samples = {k: torch.stack([v + 0.5*torch.randn_like(v) for _ in range(n_samples)])
+                   for k, v in model.state_dict().items()}
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=batch_size)
+        results = exp_utils.evaluate_model(model, dataloader, samples, likelihood_eval=True,
+                                           accuracy_eval=True, calibration_eval=True)
+
+        log_probs = []
+        with torch.no_grad():
+            for sample in exp_utils.sample_iter(samples):
+                model.load_state_dict(sample)
+                log_probs.append(model(x).logits.double())
+        log_probs = torch.stack(log_probs)
+        ensemble = log_probs.logsumexp(0) - np.log(n_samples)
+        lp = lambda logits: logits.gather(1, y[:, None]).mean().item()
+        acc = lambda logits: logits.argmax(1).eq(y).double().mean().item()
+        assert np.allclose(results["lp_ensemble"], lp(ensemble))
+        assert np.allclose(results["lp_last"], lp(log_probs[-1]))
+        assert np.allclose(results["acc_ensemble"], acc(ensemble))
+        assert np.allclose(results["acc_last"], acc(log_probs[-1]))
+        probs = ensemble.exp().numpy()
+        assert np.allclose(results["ece"], ece(y, probs).mean())
+
+        # Several sources of samples, like the chains of a run, are evaluated together
+        halves = [{k: v[:n_samples//2] for k, v in samples.items()},
+                  {k: v[n_samples//2:] for k, v in samples.items()}]
+        results_halves = exp_utils.evaluate_model(model, dataloader, halves, likelihood_eval=True,
+                                                  accuracy_eval=True, calibration_eval=True)
+        for k, v in results.items():
+            assert np.allclose(results_halves[k], v)
+
 
 class TestHDF5Saver(unittest.TestCase):
     def test_recorded_metrics(self):
@@ -78,3 +124,152 @@ class TestHDF5Saver(unittest.TestCase):
                 assert np.array_equal(f["step23"][1::23], np.arange(100//23 + 1))
                 for i in range(1, 23):
                     assert np.all(f["step23"][1+i::23] == -2**63)
+
+    def test_add_scalars(self):
+        names = ["a", "b", "c"]
+        with TemporaryDirectory() as directory:
+            fname = Path(directory)/"metrics_test.h5"
+            with exp_utils.HDF5Metrics(fname, "w", chunk_size=4) as metrics:
+                for step in range(10):
+                    metrics.add_scalars(names, np.arange(3, dtype=np.float64) + step, step)
+                    metrics.add_scalar("d", step, step)
+
+            with h5py.File(fname, "r") as f:
+                assert np.array_equal(f["steps"][:], np.arange(10))
+                for i, k in enumerate(names):
+                    assert f[k].dtype == np.float64
+                    assert np.array_equal(f[k][:], np.arange(10) + i)
+                assert np.array_equal(f["d"][:], np.arange(10))
+
+    def test_lazy_sample_selection(self, n_steps=10, skip_first=2, thin=2):
+        "Skipping, thinning, masking and rejecting samples reads only the ones that are kept"
+        with TemporaryDirectory() as directory:
+            fname = Path(directory)/"samples.pt"
+            with exp_utils.HDF5ModelSaver(fname, "w") as saver:
+                for step in range(n_steps):
+                    saver.add_state_dict({"w": torch.full((2,), float(step))}, step)
+            with h5py.File(Path(directory)/"metrics.h5", "w") as f:
+                f["steps"] = np.arange(n_steps)
+                f["acceptance/is_sample"] = np.ones(n_steps, dtype=np.int64)
+                f["acceptance/rejected"] = np.isin(np.arange(n_steps), [6, 8]).astype(np.int64)
+
+            samples = exp_utils.open_samples(fname, idx=np.s_[skip_first::thin])
+            assert isinstance(samples, exp_utils.LazySamples)
+            with h5py.File(Path(directory)/"metrics.h5", "r") as f:
+                exp_utils.reject_samples_(samples, f)
+            del samples["timestamps"]
+            assert samples.pop("steps").load().tolist() == [2, 4, 4, 4]
+            w = [s["w"][0].item() for s in exp_utils.sample_iter(samples)]
+            assert w == [2., 4., 4., 4.]
+            assert torch.equal(samples["w"][[False, True, False, True]].load()[:, 0],
+                               torch.tensor([4., 4.]))
+
+            mask = np.arange(n_steps) % 3 == 0
+            samples = exp_utils.LazySamples(fname, idx=mask, keep_steps=False)
+            assert torch.equal(samples["w"].load()[:, 0], torch.tensor([0., 3., 6., 9.]))
+
+    def test_background_writes(self, n_steps=30):
+        "Writing in a background thread gives the same files as writing in the loop"
+        contents = []
+        for queue_size in [0, 2]:
+            with TemporaryDirectory() as directory:
+                metrics_fname = Path(directory)/"metrics.h5"
+                samples_fname = Path(directory)/"samples.pt"
+                w = torch.zeros(3)
+                with exp_utils.HDF5Metrics(metrics_fname, "w", chunk_size=4, queue_size=queue_size) as metrics, \
+                        exp_utils.HDF5ModelSaver(samples_fname, "w", queue_size=queue_size) as saver:
+                    for step in range(n_steps):
+                        metrics.add_scalar("a", float(step), step)
+                        w += 1  # The saver has to keep its own copy
+                        saver.add_state_dict({"w": w}, step)
+                        saver.flush()
+                        if step % 7 == 0:
+                            metrics.flush()
+                    saver.wait()
+                    assert len(saver.load_samples()["w"]) == n_steps
+
+                with h5py.File(metrics_fname, "r") as f:
+                    metrics_data = (f["steps"][:], f["a"][:])
+                samples = exp_utils.load_samples(samples_fname)
+                contents.append((metrics_data, samples["steps"], samples["w"]))
+
+        (m0, steps0, w0), (m1, steps1, w1) = contents
+        assert all(np.array_equal(a, b) for a, b in zip(m0, m1))
+        assert np.array_equal(m1[1], np.arange(n_steps))
+        assert torch.equal(steps0, steps1)
+        assert torch.equal(w0, w1)
+        assert torch.equal(w1[:, 0], torch.arange(1., n_steps+1))
+
+    def test_chunked_samples(self, n_steps=11, chunk_size=4, n_rows=20):
+        "Chunked, compressed and pre-sized files hold the same samples"
+        with TemporaryDirectory() as directory:
+            fname = Path(directory)/"samples.pt"
+            with exp_utils.HDF5ModelSaver(fname, "w", chunk_size=chunk_size, n_rows=n_rows,
+                                          compression="gzip", shuffle=True) as saver:
+                w = torch.zeros(3)
+                for step in range(n_steps):
+                    w += 1
+                    saver.add_state_dict({"w": w}, step)
+
+            with h5py.File(fname, "r") as f:
+                assert f["w"].chunks == (chunk_size, 3)
+                assert f["w"].compression == "gzip"
+                assert len(f["w"]) == n_steps
+            samples = exp_utils.load_samples(fname)
+            assert torch.equal(samples["steps"], torch.arange(n_steps))
+            assert torch.equal(samples["w"][:, 0], torch.arange(1., n_steps+1))
+
+    def test_unfinished_presized_samples(self, n_steps=6, n_rows=20):
+        "The rows of a pre-sized file that were never written are left out"
+        with TemporaryDirectory() as directory:
+            fname = Path(directory)/"samples.pt"
+            saver = exp_utils.HDF5ModelSaver(fname, "w", chunk_size=4, n_rows=n_rows).__enter__()
+            for step in range(n_steps):
+                saver.add_state_dict({"w": torch.full((3,), float(step))}, step)
+            # Stop as if the run crashed, without truncating the datasets
+            saver.flush()
+            saver.f.close()
+
+            with h5py.File(fname, "r") as f:
+                assert len(f["w"]) == n_rows
+                # The unwritten rows hold an explicit fill value
+                assert f["steps"].fillvalue == -2**63
+                assert (f["steps"][n_steps:] == -2**63).all()
+            samples = exp_utils.load_samples(fname)
+            assert torch.equal(samples["steps"], torch.arange(n_steps))
+            assert torch.equal(exp_utils.load_samples(fname, idx=-1)["w"], torch.full((3,), n_steps-1.))
+            assert len(exp_utils.LazySamples(fname)["w"]) == n_steps
+
+    def test_chain_samples(self, num_chains=3, n_steps=4):
+        with TemporaryDirectory() as directory:
+            fname = Path(directory)/"samples.pt"
+            with exp_utils.HDF5ModelSaver(fname, "w") as saver:
+                for step in range(n_steps):
+                    for chain in range(num_chains):
+                        saver.add_state_dict({"w": torch.full((2,), float(10*step + chain))},
+                                             step, chain=chain)
+
+            samples = exp_utils.load_samples(fname)
+            assert np.array_equal(samples["chains"].numpy(), np.tile(np.arange(num_chains), n_steps))
+            assert np.array_equal(samples["steps"].numpy(), np.repeat(np.arange(n_steps), num_chains))
+            assert torch.equal(samples["w"][:, 0], (10*samples["steps"] + samples["chains"]).float())
+
+            samples = exp_utils.load_samples(fname, keep_steps=False)
+            assert set(samples.keys()) == {"w"}
+
+    def test_lazy_samples(self, n_steps=7):
+        with TemporaryDirectory() as directory:
+            fname = Path(directory)/"samples.pt"
+            with exp_utils.HDF5ModelSaver(fname, "w") as saver:
+                for step in range(n_steps):
+                    saver.add_state_dict({"w": torch.full((2,), float(step))}, step)
+            lazy = saver.lazy_samples(idx=slice(1, None), keep_steps=False)
+            assert set(lazy.keys()) == {"w"}
+            assert len(lazy["w"]) == n_steps - 1
+
+            samples = exp_utils.load_samples(fname, idx=slice(1, None), keep_steps=False)
+            assert torch.equal(lazy["w"].load(), samples["w"])
+            assert torch.equal(lazy["w"][-1], samples["w"][-1])
+            for idx in [slice(2, None), slice(None, None, -2), slice(4, 0, -1), slice(3, 3)]:
+                expected = np.ascontiguousarray(samples["w"].numpy()[idx])
+                assert np.array_equal(lazy["w"][idx].load().numpy(), expected)
@@ -3,11 +3,15 @@ import numpy as np
 import torch
 import scipy.stats
 import math
+import h5py
+from tempfile import TemporaryDirectory
+from pathlib import Path
 
 from gpytorch.distributions import MultivariateNormal
 from bnn_priors.mcmc import HMC
-from bnn_priors.models import DenseNet, GaussianModel
-from bnn_priors import prior
+from bnn_priors.models import DenseNet, ClassificationConvNet, GaussianModel
+from bnn_priors import prior, exp_utils
+from bnn_priors.inference_reject import FullBatchHMCRunner
 
 from .test_verlet_sgld import store_verlet_state, zip_allclose, new_model_loss
 from .utils import requires_float64
@@ -65,6 +69,133 @@ class HMCTest(unittest.TestCase):
         assert all(zip_allclose(m0, map(torch.neg, m0_neg)))
 
 
+    @requires_float64
+    def test_fused_equivalence(self, N=10, n_steps=5, seed=7):
+        "The fused and per-parameter steps follow the same trajectory"
+        trajectories = []
+        for fused in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = HMC(model.parameters(), lr=0.01, num_data=N, fused=fused)
+            for _, state in sgld.state.items():
+                state['preconditioner'] = torch.rand(()).item() + 0.2
+            sgld.sample_momentum()
+
+            trajectory = []
+            sgld.initial_step(loss)
+            for _ in range(n_steps):
+                sgld.step(loss)
+                trajectory.append(list(store_verlet_state(sgld)))
+            sgld.final_step(loss)
+            trajectory.append(list(store_verlet_state(sgld)))
+            trajectories.append(trajectory)
+
+        for (p_loop, m_loop), (p_fused, m_fused) in zip(*trajectories):
+            assert all(zip_allclose(p_loop, p_fused))
+            assert all(zip_allclose(m_loop, m_fused))
+
+    @requires_float64
+    def test_flat_equivalence(self, N=10, n_steps=5, seed=7):
+        "Storing the state in a flat arena does not change the trajectory"
+        trajectories = []
+        for flat in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = HMC(model.parameters(), lr=0.01, num_data=N, flat=flat)
+            for _, state in sgld.state.items():
+                state['preconditioner'] = torch.rand(()).item() + 0.2
+            sgld.sample_momentum()
+            # Use the same initial momentum for both
+            for _, state in sgld.state.items():
+                state['momentum_buffer'].copy_(torch.randn_like(state['momentum_buffer']))
+
+            trajectory = []
+            sgld.initial_step(loss)
+            for _ in range(n_steps):
+                sgld.step(loss)
+                trajectory.append(list(store_verlet_state(sgld)))
+            sgld.final_step(loss)
+            trajectory.append(list(store_verlet_state(sgld)))
+            trajectories.append(trajectory)
+
+        for (p_loop, m_loop), (p_flat, m_flat) in zip(*trajectories):
+            assert all(zip_allclose(p_loop, p_flat))
+            assert all(zip_allclose(m_loop, m_flat))
+
+    @requires_float64
+    def test_full_batch_runner(self, N=10, n_leapfrog=5, lr=0.01, seed=7):
+        "A trajectory of `FullBatchHMCRunner` is an HMC trajectory with the exact gradient"
+        x = torch.randn(N, 1)
+        y = x.sin()
+
+        def new_model():
+            torch.manual_seed(seed)
+            return DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+
+        model = new_model()
+        def loss():
+            model.zero_grad()
+            v = model.potential_avg(x, y, eff_num_data=N)
+            v.backward()
+            return v
+        sgld = HMC(model.parameters(), lr=lr, num_data=N, flat=True)
+        sgld.sample_momentum()
+        sgld.initial_step(loss)
+        for _ in range(n_leapfrog-1):
+            sgld.step(loss)
+        sgld.final_step(loss)
+
+        runner_model = new_model()
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=N//2)
+        with TemporaryDirectory() as tmpdir, \
+                exp_utils.HDF5Metrics(Path(tmpdir)/"metrics.h5", "w") as metrics:
+            runner = FullBatchHMCRunner(
+                runner_model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                sample_epochs=1, learning_rate=lr, momentum=1., sampling_decay="flat",
+                metrics_saver=metrics, n_leapfrog=n_leapfrog)
+            runner.run()
+
+        assert all(zip_allclose(model.parameters(), runner_model.parameters()))
+        samples = runner.get_samples()
+        for name, p in runner_model.named_parameters():
+            assert torch.allclose(samples[name][-1], p)
+
+    def test_autocast_acceptance(self, N=32, n_trajectories=20, n_leapfrog=10, lr=1e-3, seed=3):
+        "Computing the potential in bfloat16 keeps the M-H acceptance rate of float32"
+        x_dense = torch.randn(N, 4)
+        y_dense = x_dense.sum(-1, keepdim=True).sin()
+        x_conv = torch.randn(N, 1, 8, 8)
+        y_conv = torch.randint(0, 3, (N,))
+        models = [(lambda: DenseNet(4, 1, 16, noise_std=1.), x_dense, y_dense),
+                  (lambda: ClassificationConvNet(1, 8, 3, 8), x_conv, y_conv)]
+
+        for new_model, x, y in models:
+            accept_prob = {}
+            for autocast_dtype in [None, "bfloat16"]:
+                torch.manual_seed(seed)
+                model = new_model()
+                dataloader = torch.utils.data.DataLoader(
+                    torch.utils.data.TensorDataset(x, y), batch_size=N)
+                with TemporaryDirectory() as tmpdir:
+                    path = Path(tmpdir)/"metrics.h5"
+                    with exp_utils.HDF5Metrics(path, "w") as metrics:
+                        runner = FullBatchHMCRunner(
+                            model, dataloader, [], epochs_per_cycle=n_trajectories,
+                            warmup_epochs=0, sample_epochs=n_trajectories,
+                            learning_rate=lr, momentum=1., sampling_decay="flat",
+                            metrics_saver=metrics, reject_samples=True,
+                            n_leapfrog=n_leapfrog, autocast_dtype=autocast_dtype)
+                        runner.run()
+                    with h5py.File(path, "r") as f:
+                        delta_energy = f["delta_energy"][:]
+                # The parameters and sampler state are not affected
+                assert all(p.dtype == torch.float32 for p in model.parameters())
+                accept_prob[autocast_dtype] = np.minimum(1., np.exp(-delta_energy)).mean()
+
+            assert accept_prob[None] > 0.5
+            assert abs(accept_prob["bfloat16"] - accept_prob[None]) < 0.2
+
     def test_distribution_preservation(self, n_vars=50, n_dim=1000, n_samples=100, momentum_resample=4):
         """Tests whether HMC preserves the distribution of a  Gaussian potential correctly.
         """
@@ -3,10 +3,19 @@ import numpy as np
 import torch
 import math
 import scipy.stats
+import h5py
+import shutil
+from tempfile import TemporaryDirectory
+from pathlib import Path
 
-from bnn_priors import prior
-from bnn_priors.models import GaussianModel
-from bnn_priors.mcmc import SGLD
+from bnn_priors import prior, exp_utils
+from bnn_priors.models import GaussianModel, DenseNet, MultiChainModel
+from bnn_priors.mcmc import SGLD, SGNHT, RNGStreams
+from bnn_priors.inference import SGLDRunner, VerletSGLDRunner, SAGALDRunner, ParallelTemperingRunner
+from bnn_priors.inference_reject import VerletSGLDRunnerReject, SGLDRunnerReject
+
+from .test_verlet_sgld import store_verlet_state, zip_allclose, new_model_loss
+from .utils import requires_float64
 
 
 class SGLDTest(unittest.TestCase):
@@ -79,7 +88,405 @@ class SGLDTest(unittest.TestCase):
             sgld_sd.values(),
             model.state_dict().values()))
 
+    @requires_float64
+    def test_fused_equivalence(self, N=10, n_steps=5, seed=7):
+        "The fused and per-parameter steps follow the same trajectory"
+        trajectories = []
+        for fused in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = SGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                        temperature=1., fused=fused)
+            for _, state in sgld.state.items():
+                state['preconditioner'] = torch.rand(()).item() + 0.2
+            sgld.sample_momentum()
+
+            trajectory = []
+            for _ in range(n_steps):
+                sgld.step(loss)
+                trajectory.append(list(store_verlet_state(sgld)))
+            trajectories.append(trajectory)
+
+        for (p_loop, m_loop), (p_fused, m_fused) in zip(*trajectories):
+            assert all(zip_allclose(p_loop, p_fused))
+            assert all(zip_allclose(m_loop, m_fused))
+
+    def test_diagnostics(self, N=10, n_steps=3):
+        for flat in [False, True]:
+            model, loss = new_model_loss(N=N)
+            sgld = SGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                        temperature=1., flat=flat)
+            sgld.sample_momentum()
+            for _ in range(n_steps):
+                sgld.step(loss)
+
+            diagnostics = sgld.diagnostics()
+            params = list(model.parameters())
+            for k in ['est_temperature', 'est_config_temp', 'preconditioner']:
+                assert diagnostics[k].shape == (len(params),)
+            for i, p in enumerate(params):
+                state = sgld.state[p]
+                assert isinstance(state['est_temperature'], torch.Tensor)
+                assert np.allclose(diagnostics['est_temperature'][i],
+                                   state['est_temperature'].item())
+                assert np.allclose(diagnostics['est_config_temp'][i],
+                                   state['est_config_temp'].item())
+                assert diagnostics['preconditioner'][i] == state['preconditioner']
+
+    def test_elementwise_preconditioner(self, N=10):
+        "Each element gets its own preconditioner, normalized by the smallest mean of a parameter"
+        for flat in [False, True]:
+            torch.manual_seed(1)
+            model, loss = new_model_loss(N=N)
+            sgld = SGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                        rmsprop_eps=0., flat=flat, precond_type="elementwise")
+            for p in model.parameters():
+                assert torch.equal(sgld.state[p]['preconditioner'], torch.ones_like(p))
+                sgld.state[p]['square_avg'].copy_(torch.rand_like(p) + 0.1)
+
+            sgld.update_preconditioner()
+            square_avgs = [sgld.state[p]['square_avg'] for p in model.parameters()]
+            min_s = min(s.mean() for s in square_avgs)
+            for p, s in zip(model.parameters(), square_avgs):
+                expected = (s / min_s)**(-1/4)
+                assert torch.allclose(sgld.state[p]['preconditioner'], expected)
+            if flat:
+                arena = sgld._arenas[0]
+                views = arena.views(arena.buffers['preconditioner'])
+                for p, v in zip(model.parameters(), views):
+                    assert sgld.state[p]['preconditioner'].data_ptr() == v.data_ptr()
+
+            sgld.sample_momentum()
+            sgld.step(loss)
+            diagnostics = sgld.diagnostics()
+            for i, p in enumerate(model.parameters()):
+                assert np.allclose(diagnostics['preconditioner'][i],
+                                   sgld.state[p]['preconditioner'].mean().item())
+
+    def test_elementwise_preconditioner_dead_elements(self, N=10):
+        "Elements without gradient do not shrink the preconditioner of the others"
+        torch.manual_seed(1)
+        model, loss = new_model_loss(N=N)
+        sgld = SGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                    precond_type="elementwise")
+        params = list(model.parameters())
+        for p in params:
+            sgld.state[p]['square_avg'].fill_(1.)
+        # A block that never gets a gradient, like a dead ReLU unit
+        dead = params[0]
+        sgld.state[dead]['square_avg'].view(-1)[:dead.numel()//2] = 0.
+
+        sgld.update_preconditioner()
+        # Normalized by the smallest element (~rmsprop_eps), these would be ~0.01
+        live = [sgld.state[p]['preconditioner'].view(-1) for p in params[1:]]
+        live.append(sgld.state[dead]['preconditioner'].view(-1)[dead.numel()//2:])
+        for M_rsqrt in live:
+            assert torch.all((0.5 < M_rsqrt) & (M_rsqrt <= 1.))
+        assert torch.all(sgld.state[dead]['preconditioner'].view(-1)[:dead.numel()//2] > 1.)
+
+    @requires_float64
+    def test_control_variate(self, N=20, batch_size=5):
+        "The control variate reduces the variance of the minibatch gradients"
+        torch.manual_seed(2)
+        x = torch.randn(N, 1)
+        y = x.sin()
+        model = DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=batch_size)
+        runner = SGLDRunner(model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                            sample_epochs=1, control_variate=True)
+        runner.optimizer = runner._make_optimizer(runner._params)
+
+        def batch_grads():
+            grads = []
+            for x_b, y_b in dataloader:
+                runner._model_potential_and_grad(x_b, y_b)
+                grads.append(torch.cat([p.grad.reshape(-1) for p in runner._params]))
+            return torch.stack(grads)
+
+        # At the anchor, every corrected minibatch gradient is the full gradient
+        runner._maybe_update_anchor(0)
+        full_grad = torch.cat([g.reshape(-1) for _, g in runner._anchor])
+        for grad in batch_grads():
+            assert torch.allclose(grad, full_grad)
+
+        with torch.no_grad():
+            for p in runner._params:
+                p.add_(torch.randn_like(p), alpha=1e-2)
+        cv_variance = batch_grads().var(0).sum()
+        runner._anchor = None
+        assert batch_grads().var(0).sum() > 10 * cv_variance
+
+    @requires_float64
+    def test_saga(self, N=20, batch_size=5):
+        "With an up-to-date table, the SAGA gradient is the full-data gradient"
+        torch.manual_seed(4)
+        x = torch.randn(N, 1)
+        y = x.sin()
+        model = DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=batch_size, shuffle=True)
+
+        model.zero_grad()
+        model.potential_avg(x, y, eff_num_data=N).backward()
+        full_grad = [p.grad.clone() for p in model.parameters()]
+
+        with TemporaryDirectory() as tmpdir, \
+                exp_utils.HDF5Metrics(Path(tmpdir)/"metrics.h5", "w") as metrics:
+            runner = SAGALDRunner(model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                                  sample_epochs=1, metrics_saver=metrics)
+            runner.optimizer = runner._make_optimizer(runner._params)
+            for x_b, y_b in runner.dataloader:
+                runner._model_potential_and_grad(x_b, y_b)
+                assert all(zip_allclose((p.grad for p in model.parameters()), full_grad))
+
+            runner = SAGALDRunner(model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                                  sample_epochs=1, metrics_saver=metrics, max_table_bytes=1000)
+            with self.assertRaises(MemoryError):
+                runner._make_optimizer(runner._params)
+
+    def test_sgnht_equivalence(self, N=10, n_steps=5, seed=3):
+        "SGNHT with a thermostat that does not move is SGLD"
+        trajectories = []
+        for cls, kwargs in [(SGLD, {}), (SGNHT, {"thermostat_rate": 0.})]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = cls(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                       temperature=1., **kwargs)
+            sgld.sample_momentum()
+            trajectory = []
+            for _ in range(n_steps):
+                sgld.step(loss)
+                trajectory.append(list(store_verlet_state(sgld)))
+            trajectories.append(trajectory)
+
+        for (p_sgld, m_sgld), (p_sgnht, m_sgnht) in zip(*trajectories):
+            assert all(zip_allclose(p_sgld, p_sgnht))
+            assert all(zip_allclose(m_sgld, m_sgnht))
+
+    def test_sgnht_temperature(self, n_vars=10, n_dim=100, n_steps=600, grad_noise=10.):
+        "The thermostat absorbs the gradient noise that heats up SGLD"
+        temperatures = {}
+        for name in ["SGLD", "group", "element"]:
+            torch.manual_seed(5)
+            model = GaussianModel(N=n_vars, D=n_dim, mean=1., std=2.)
+            if name == "SGLD":
+                sgld = SGLD(model.parameters(), lr=1/512, num_data=1, momentum=0.9)
+            else:
+                sgld = SGNHT(model.parameters(), lr=1/512, num_data=1, momentum=0.9,
+                             thermostat=name)
+            sgld.sample_momentum()
+
+            def noisy_closure():
+                loss = model.potential_avg_closure()
+                for p in model.parameters():
+                    p.grad.add_(torch.randn_like(p), alpha=grad_noise)
+                return loss
+
+            temps = []
+            for step in range(n_steps):
+                sgld.step(noisy_closure)
+                if step >= n_steps // 2:
+                    temps.append(np.mean(sgld.diagnostics()['est_temperature']))
+            temperatures[name] = np.mean(temps)
+
+        assert temperatures["SGLD"] > 1.5
+        assert abs(temperatures["group"] - 1.) < 0.15
+        assert abs(temperatures["element"] - 1.) < 0.15
+
+    def test_parallel_tempering(self, N=20, num_chains=3):
+        torch.manual_seed(6)
+        x = torch.randn(N, 1)
+        y = x.sin()
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=5)
+        model = MultiChainModel(DenseNet(1, 1, 100, noise_std=0.1), num_chains)
+
+        # Each chain's noise has its own temperature
+        temperatures = [1., 4., 9.]
+        sgld = SGLD(model.parameters(), lr=0.01, num_data=N, num_chains=num_chains,
+                    chain_temperatures=temperatures)
+        sgld.sample_momentum()
+        momenta = torch.cat([sgld.state[p]['momentum_buffer'].reshape(num_chains, -1)
+                             for p in model.parameters()], 1)
+        assert np.allclose(momenta.var(1).numpy(), temperatures, rtol=0.3)
+
+        with TemporaryDirectory() as tmpdir, \
+                exp_utils.HDF5Metrics(Path(tmpdir)/"metrics.h5", "w") as metrics:
+            # With equal temperatures, every swap is accepted
+            runner = ParallelTemperingRunner(
+                model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                sample_epochs=1, metrics_saver=metrics, temperatures=[1.]*num_chains,
+                swap_every=1)
+            runner.optimizer = runner._make_optimizer(runner._params)
+            params = [p.detach().clone() for p in model.parameters()]
+            _, _, potential, _ = runner._model_potential_and_grad(x, y)
+            for p, p0 in zip(model.parameters(), params):
+                assert torch.equal(p.detach(), p0[[1, 0, 2]])
+            _, _, expected_potential, _, _ = model.split_potential_and_acc(x, y, N)
+            assert torch.allclose(potential, expected_potential)
+            metrics.flush()
+            assert "swap/accept_prob/chain0-1" in metrics.f
+
+    @requires_float64
+    def test_rng_streams(self, N=10, n_steps=5):
+        "With `rng`, the noise does not depend on the global generator or the kind of step"
+        trajectories = []
+        for i, kwargs in enumerate([{}, {"fused": True}, {"flat": True}]):
+            torch.manual_seed(0)
+            model, loss = new_model_loss(N=N)
+            torch.manual_seed(i + 1)
+            sgld = SGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                        temperature=1., rng=RNGStreams(5), **kwargs)
+            sgld.sample_momentum()
+            trajectory = []
+            for _ in range(n_steps):
+                sgld.step(loss)
+                trajectory.append(list(store_verlet_state(sgld)))
+            trajectories.append(trajectory)
+
+        for other in trajectories[1:]:
+            for (p_a, m_a), (p_b, m_b) in zip(trajectories[0], other):
+                assert all(zip_allclose(p_a, p_b))
+                assert all(zip_allclose(m_a, m_b))
+
+        # Restoring the state of the streams repeats their numbers
+        rng = RNGStreams(5)
+        x = [torch.zeros(3, 2), torch.zeros(4)]
+        first = rng.normal_like(x, "step", 0)
+        state = rng.state_dict()
+        second = rng.normal_like(x, "step", 0)
+        assert not torch.equal(first[0], second[0])
+        restored = RNGStreams(0)
+        restored.load_state_dict(state)
+        assert all(torch.equal(a, b) for a, b in zip(second, restored.normal_like(x, "step", 0)))
+
+    @requires_float64
+    def test_resume(self, N=20, batch_size=5):
+        "A run resumed from a checkpoint continues the same chain, and its files"
+        torch.manual_seed(8)
+        x = torch.randn(N, 1)
+        y = x.sin()
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=batch_size, shuffle=True)
+
+        def run(directory, resume):
+            model = DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+            mode = ("a" if resume else "w")
+            with exp_utils.HDF5Metrics(directory/"metrics.h5", mode) as metrics, \
+                    exp_utils.HDF5ModelSaver(directory/"samples.pt", mode) as model_saver:
+                # The only checkpoint is after the first epoch of the second cycle
+                runner = VerletSGLDRunner(
+                    model, dataloader, [], epochs_per_cycle=2, warmup_epochs=1,
+                    sample_epochs=1, cycles=2, momentum=0.9, precond_update=1,
+                    metrics_saver=metrics, model_saver=model_saver, seed=3,
+                    checkpoint_path=directory/"checkpoint.pt", checkpoint_every=3)
+                runner.run(resume=resume)
+            return model
+
+        with TemporaryDirectory() as tmpdir:
+            full_dir, resumed_dir = Path(tmpdir)/"full", Path(tmpdir)/"resumed"
+            full_dir.mkdir()
+            full_model = run(full_dir, resume=False)
+            # The files of the interrupted run also have the steps after the checkpoint
+            shutil.copytree(full_dir, resumed_dir)
+            resumed_model = run(resumed_dir, resume=True)
+
+            assert all(zip_allclose(full_model.parameters(), resumed_model.parameters()))
+            full, resumed = (exp_utils.load_samples(d/"samples.pt") for d in [full_dir, resumed_dir])
+            assert np.array_equal(full["steps"].numpy(), resumed["steps"].numpy())
+            for k in full.keys():
+                if k != "timestamps":
+                    assert torch.allclose(full[k], resumed[k])
+            with h5py.File(full_dir/"metrics.h5", "r") as full, \
+                    h5py.File(resumed_dir/"metrics.h5", "r") as resumed:
+                for k in ["steps", "loss", "delta_energy", "total_energy", "est_temperature/all"]:
+                    np.testing.assert_allclose(full[k][:], resumed[k][:])
+
+    def test_sequential_mh_test_without_rejection(self, N=20, batch_size=5):
+        "The sequential M-H test runs with `reject_samples=False`, and needs `VerletSGLD`"
+        torch.manual_seed(5)
+        x = torch.randn(N, 1)
+        y = x.sin()
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=batch_size, shuffle=True)
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir)/"metrics.h5"
+            with exp_utils.HDF5Metrics(path, "w") as metrics:
+                model = DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+                runner = VerletSGLDRunnerReject(
+                    model, dataloader, [], epochs_per_cycle=3, warmup_epochs=0,
+                    sample_epochs=2, momentum=0.9, metrics_saver=metrics,
+                    reject_samples=False, mh_test="sequential", mh_test_batch_size=batch_size)
+                runner.run()
+            with h5py.File(path, "r") as f:
+                mh_test_data = f["acceptance/mh_test_data"][:]
+            # Each test used at least one batch
+            assert mh_test_data.max() >= batch_size
+
+            with exp_utils.HDF5Metrics(Path(tmpdir)/"metrics_sgld.h5", "w") as metrics:
+                model = DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+                runner = SGLDRunnerReject(
+                    model, dataloader, [], epochs_per_cycle=3, warmup_epochs=0,
+                    sample_epochs=2, momentum=0.9, metrics_saver=metrics,
+                    mh_test="sequential")
+                with self.assertRaises(AssertionError):
+                    runner.run()
+
+    @requires_float64
+    def test_tensor_step_sizes(self, N=10, n_steps=5, seed=7):
+        "The steps within `tensor_step_sizes` follow the same trajectory as without"
+        runs = []
+        for tensor_step_sizes in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = SGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                        temperature=1., flat=True, rng=RNGStreams(seed))
+            sgld.sample_momentum()
+            for i in range(n_steps):
+                # A new step size at every step, as with a schedule
+                sgld.param_groups[0]['lr'] *= 0.9
+                loss()
+                if tensor_step_sizes:
+                    with sgld.tensor_step_sizes():
+                        assert isinstance(sgld.param_groups[0]['hn'], torch.Tensor)
+                        sgld.step(calc_metrics=(i % 2 == 0))
+                    assert isinstance(sgld.param_groups[0]['hn'], float)
+                else:
+                    sgld.step(calc_metrics=(i % 2 == 0))
+            runs.append((list(model.parameters()), sgld.diagnostics()))
+        (params_a, diag_a), (params_b, diag_b) = runs
+        assert all(zip_allclose(params_a, params_b))
+        for k in diag_a.keys():
+            np.testing.assert_allclose(diag_a[k], diag_b[k])
+
+    @requires_float64
+    def test_compile_step(self, N=20, batch_size=5):
+        "The compiled step and update (or their eager fallback) follow the same chain"
+        torch.manual_seed(9)
+        x = torch.randn(N, 1)
+        y = x.sin()
+        dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(x, y), batch_size=batch_size)
 
+        for Runner in [SGLDRunner, VerletSGLDRunner]:
+            models = []
+            for compile_step in [False, True]:
+                torch.manual_seed(10)
+                model = DenseNet(x.size(-1), y.size(-1), 10, noise_std=0.1)
+                with TemporaryDirectory() as tmpdir, \
+                        exp_utils.HDF5Metrics(Path(tmpdir)/"metrics.h5", "w") as metrics:
+                    runner = Runner(model, dataloader, [], epochs_per_cycle=1, warmup_epochs=0,
+                                    sample_epochs=1, momentum=0.9, flat=True, seed=2,
+                                    metrics_saver=metrics, compile_step=compile_step)
+                    runner.optimizer = runner._make_optimizer(runner._params)
+                    runner.optimizer.sample_momentum()
+                    runner.scheduler = runner._make_scheduler(runner.optimizer)
+                    # Both variants of the update, with and without metrics
+                    for i, (x_b, y_b) in enumerate(dataloader):
+                        runner.step(i, x_b, y_b, store_metrics=(i % 2 == 0))
+                models.append(model)
+            assert all(zip_allclose(models[0].parameters(), models[1].parameters()))
 
 if __name__ == '__main__':
     unittest.main()
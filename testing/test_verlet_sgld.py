@@ -6,8 +6,8 @@ import scipy.stats
 from typing import Tuple, List
 
 from gpytorch.distributions import MultivariateNormal
-from bnn_priors.mcmc import VerletSGLD
-from bnn_priors.models import DenseNet, GaussianModel, NealFunnelT
+from bnn_priors.mcmc import VerletSGLD, HMC, DualAveragingStepSize, SequentialMHTest, RNGStreams
+from bnn_priors.models import DenseNet, GaussianModel, NealFunnelT, MultiChainModel
 from bnn_priors import prior
 
 from .utils import requires_float64
@@ -145,14 +145,15 @@ class VerletSGLDTest(unittest.TestCase):
         assert_or_store(pvalue >= 0.3, "the kinetic temperature is not Chi^2 with p<0.3")
         return success
 
-    def test_accept_prob(self, n_samples=10, seed=145):
+    def test_accept_prob(self, n_samples=10, seed=145, precond_type="scalar"):
         torch.manual_seed(seed)
         model = NealFunnelT()
         temperature = 3/4
         momentum = 127/128
         # `num_data=1` to prevent scaling the Gaussian potential
         sgld = VerletSGLD(model.parameters(), lr=1/32, num_data=1,
-                          momentum=momentum, temperature=temperature)
+                          momentum=momentum, temperature=temperature,
+                          precond_type=precond_type)
         # Because `num_data=1`, we can say that time step squared is learning rate
         time_step_sq = sgld.param_groups[0]['lr']
         preconditioners = []
@@ -161,7 +162,10 @@ class VerletSGLDTest(unittest.TestCase):
         # Set the preconditioner randomly
         for p in model.parameters():
             state = sgld.state[p]
-            state['preconditioner'] = (torch.rand(()).item() + 0.2) / math.sqrt(4)
+            if precond_type == "elementwise":
+                state['preconditioner'] = (torch.rand_like(p) + 0.2) / math.sqrt(4)
+            else:
+                state['preconditioner'] = (torch.rand(()).item() + 0.2) / math.sqrt(4)
             preconditioners.append(state['preconditioner'])
         sgld.sample_momentum()
 
@@ -184,8 +188,8 @@ class VerletSGLDTest(unittest.TestCase):
         _, grads0, _ = states[0]
         _, grads1, _ = states[-1]
         for g0, g1, precond in zip(grads0, grads1, preconditioners):
-            C = (time_step_sq * precond**2 / 8)
-            delta_energy_ref += C*(dot(g1, g1) - dot(g0, g0))
+            C = time_step_sq * precond**2 / 8
+            delta_energy_ref += dot(C*g1, g1) - dot(C*g0, g0)
 
         point_energies = 0.
         group = sgld.param_groups[0]
@@ -210,6 +214,300 @@ class VerletSGLDTest(unittest.TestCase):
 
         assert np.allclose(delta_energy_ref, delta_energy), f"{delta_energy_ref} != {delta_energy}"
 
+    def test_accept_prob_elementwise(self):
+        self.test_accept_prob(precond_type="elementwise")
+
+    @requires_float64
+    def test_fused_equivalence(self, N=10, n_steps=5, seed=7):
+        "The fused and per-parameter steps follow the same trajectory and energy"
+        trajectories = []
+        energies = []
+        for fused in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N,
+                              momentum=0.9, temperature=1., fused=fused)
+            for _, state in sgld.state.items():
+                state['preconditioner'] = torch.rand(()).item() + 0.2
+            sgld.sample_momentum()
+
+            trajectory = []
+            U0 = sgld.initial_step(loss, save_state=True).item()
+            trajectory.append(list(store_verlet_state(sgld)))
+            for _ in range(n_steps):
+                sgld.step(loss)
+                trajectory.append(list(store_verlet_state(sgld)))
+            U1 = sgld.final_step(loss).item()
+            trajectory.append(list(store_verlet_state(sgld)))
+            trajectories.append(trajectory)
+            energies.append(sgld.delta_energy(U0, U1))
+
+        for (p_loop, m_loop), (p_fused, m_fused) in zip(*trajectories):
+            assert all(zip_allclose(p_loop, p_fused))
+            assert all(zip_allclose(m_loop, m_fused))
+        assert np.allclose(*energies)
+
+    @requires_float64
+    def test_device_delta_energy(self, N=10, n_steps=5, seed=7):
+        """The energy is accumulated in tensors, and is the same whether it is
+        calculated per parameter or for the whole flat arena"""
+        energies = []
+        for flat in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            # temperature=0 so that both runs are deterministic
+            sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N,
+                              momentum=0.9, temperature=0., flat=flat)
+            for _, state in sgld.state.items():
+                state['preconditioner'] = torch.rand(()).item() + 0.2
+            sgld.sample_momentum()
+
+            U0 = sgld.initial_step(loss, save_state=True).item()
+            for _ in range(n_steps):
+                sgld.step(loss, calc_metrics=False)
+            U1 = sgld.final_step(loss, calc_metrics=False).item()
+            if flat:
+                accumulators = sgld._arenas[0].group_state.values()
+            else:
+                accumulators = (v for state in sgld.state.values()
+                                for k, v in state.items()
+                                if k in ['delta_energy', 'prev_new_momentum_delta'])
+            assert all(isinstance(v, torch.Tensor) for v in accumulators)
+            energies.append(sgld.delta_energy(U0, U1))
+        assert isinstance(energies[0], float)
+        assert np.allclose(*energies)
+
+    def test_flat_arena(self, N=10, n_steps=3, seed=7):
+        torch.manual_seed(seed)
+        model, loss = new_model_loss(N=N)
+        sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N,
+                          momentum=0.9, temperature=1., flat=True)
+        arena, = sgld._arenas
+        # The parameters of the `Prior` modules are views into the arena
+        for p, view in zip(model.parameters(), arena.views(arena.param)):
+            assert p.data_ptr() == view.data_ptr()
+
+        sgld.sample_momentum()
+        # Rejecting goes back to the state before `initial_step`
+        loss()
+        p0, g0, m0 = store_verlet_grad_state(sgld)
+        sgld.initial_step(save_state=True)
+        for _ in range(n_steps):
+            sgld.step(loss)
+        sgld.final_step(loss)
+        p1, _, m1 = store_verlet_grad_state(sgld)
+        assert not any(zip_allclose(p0, p1))
+        # The arena is still linked to the model after `zero_grad` in `loss`
+        for p, view in zip(model.parameters(), arena.views(arena.param)):
+            assert p.data_ptr() == view.data_ptr()
+            assert p.grad.data_ptr() in [v.data_ptr() for v in arena.views(arena.grad)]
+
+        rejected, _ = sgld.maybe_reject(math.inf)
+        assert rejected
+        p2, g2, m2 = store_verlet_grad_state(sgld)
+        assert all(zip_allclose(p0, p2))
+        assert all(zip_allclose(g0, g2))
+        assert all(zip_allclose(m0, m2))
+
+    def test_snapshot(self, N=10, n_steps=3, seed=7):
+        "Rejecting swaps the snapshot on the device with the current state"
+        for flat in [False, True]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                              temperature=1., flat=flat, snapshot_placement="device")
+            sgld.sample_momentum()
+            loss()
+            for _ in range(2):  # The second time reuses the buffers
+                p0, g0, m0 = store_verlet_grad_state(sgld)
+                data_ptrs = [p.data_ptr() for p in model.parameters()]
+                sgld.initial_step(save_state=True)
+                for _ in range(n_steps):
+                    sgld.step(loss)
+                sgld.final_step(loss)
+
+                rejected, _ = sgld.maybe_reject(math.inf)
+                assert rejected
+                p1, g1, m1 = store_verlet_grad_state(sgld)
+                assert all(zip_allclose(p0, p1))
+                assert all(zip_allclose(g0, g1))
+                assert all(zip_allclose(m0, m1))
+                # The parameters now live in what was the snapshot
+                for p, ptr in zip(model.parameters(), data_ptrs):
+                    assert p.data_ptr() != ptr
+            if flat:
+                arena, = sgld._arenas
+                for p, view in zip(model.parameters(), arena.views(arena.param)):
+                    assert p.data_ptr() == view.data_ptr()
+
+    @requires_float64
+    def test_multi_chain(self, N=10, n_steps=4, num_chains=3):
+        "Stacked chains follow the same trajectories as separate runs"
+        torch.manual_seed(3)
+        x = torch.randn(N, 1)
+        y = x.sin()
+
+        def run(model, num_chains=None):
+            # temperature=0 makes the trajectory deterministic
+            sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                              temperature=0., num_chains=num_chains)
+            def potential():
+                sgld.zero_grad()
+                _, _, potential, _, _ = model.split_potential_and_acc(x, y, N)
+                potential.sum().backward()
+                return potential.detach()
+            sgld.sample_momentum()
+            U0 = potential()
+            sgld.initial_step(save_state=True)
+            for i in range(n_steps):
+                potential()
+                sgld.step()
+                if i == 1:
+                    sgld.update_preconditioner()
+            U1 = potential()
+            sgld.final_step()
+            return sgld, sgld.delta_energy(U0, U1)
+
+        vectorize_options = [False, True] if hasattr(torch, "func") else [False]
+        for vectorize in vectorize_options:
+            multi = MultiChainModel(DenseNet(1, 1, 10, noise_std=0.1), num_chains,
+                                    vectorize=vectorize)
+            singles = []
+            for c in range(num_chains):
+                model = DenseNet(1, 1, 10, noise_std=0.1)
+                model.load_state_dict({k: v[c] for k, v in multi.state_dict().items()})
+                singles.append(model)
+
+            sgld, delta_energy = run(multi, num_chains)
+            assert delta_energy.shape == (num_chains,)
+            diagnostics = sgld.diagnostics()
+            for c, model in enumerate(singles):
+                sgld_c, delta_energy_c = run(model)
+                for p_multi, p in zip(multi.parameters(), model.parameters()):
+                    assert torch.allclose(p_multi[c], p)
+                assert np.allclose(delta_energy[c], delta_energy_c)
+                diagnostics_c = sgld_c.diagnostics()
+                for k in ['est_temperature', 'est_config_temp', 'preconditioner']:
+                    assert np.allclose(diagnostics[k][:, c], diagnostics_c[k])
+
+    def test_dual_averaging(self, target_accept=0.8, n_iter=2000):
+        "Dual averaging finds the step size with the target acceptance probability"
+        def accept_prob(step_size):
+            return math.exp(-step_size)
+        adapter = DualAveragingStepSize(1e-3, target_accept=target_accept)
+        step_size = 1e-3
+        for _ in range(n_iter):
+            step_size = adapter.update(accept_prob(step_size))
+        expected = -math.log(target_accept)
+        assert abs(adapter.final_step_size() - expected) / expected < 0.05
+
+    def test_sequential_mh_test(self, num_data=10000, batch_size=100, n_tests=100, seed=5):
+        "The sequential M-H test agrees with the exact one, using a subset of the data"
+        rng = np.random.RandomState(seed)
+        n_used = []
+        n_wrong = 0
+        for _ in range(n_tests):
+            offset = rng.uniform(0.05, 0.3) * rng.choice([-1, 1])
+            diffs = rng.randn(num_data) + offset
+            test = SequentialMHTest(0., num_data, error=0.05)
+            for i in range(0, num_data, batch_size):
+                accept = test.add(diffs[i:i+batch_size])
+                if accept is not None:
+                    break
+            assert accept is not None
+            n_used.append(test.n)
+            n_wrong += int(accept != (diffs.mean() > 0.))
+        assert n_wrong / n_tests <= 0.1
+        assert np.mean(n_used) < num_data / 4
+
+        # With all the data, the decision is exact
+        test = SequentialMHTest(0., 4, error=0.05)
+        assert test.add([1e-3, -1e-3]) is None
+        assert test.add([1e-3, 0.]) is True
+
+    def _run_trajectory(self, sgld, loss, n_steps):
+        "Run a trajectory, return its states and energy error"
+        trajectory = []
+        U0 = sgld.initial_step(loss, save_state=True).item()
+        trajectory.append(list(store_verlet_state(sgld)))
+        for _ in range(n_steps):
+            sgld.step(loss)
+            trajectory.append(list(store_verlet_state(sgld)))
+        U1 = sgld.final_step(loss).item()
+        trajectory.append(list(store_verlet_state(sgld)))
+        return trajectory, sgld.delta_energy(U0, U1)
+
+    @requires_float64
+    def test_splitting(self, N=10, n_steps=5, seed=7):
+        # Without friction, OBABO and BAOAB are both leapfrog
+        runs = []
+        for splitting in ["OBABO", "BAOAB"]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N, momentum=1.,
+                              temperature=1., splitting=splitting)
+            sgld.sample_momentum()
+            runs.append(self._run_trajectory(sgld, loss, n_steps))
+        (traj_a, energy_a), (traj_b, energy_b) = runs
+        for (p_a, m_a), (p_b, m_b) in zip(traj_a, traj_b):
+            assert all(zip_allclose(p_a, p_b))
+            assert all(zip_allclose(m_a, m_b))
+        assert np.allclose(energy_a, energy_b)
+
+        # The per-parameter, fused and flat BAOAB steps agree
+        runs = []
+        for kwargs in [{}, {"fused": True}, {"flat": True}]:
+            torch.manual_seed(seed)
+            model, loss = new_model_loss(N=N)
+            # temperature=0 so that the flat run is deterministic too
+            sgld = VerletSGLD(model.parameters(), lr=0.01, num_data=N, momentum=0.9,
+                              temperature=0., splitting="BAOAB", **kwargs)
+            sgld.sample_momentum()
+            runs.append(self._run_trajectory(sgld, loss, n_steps))
+        (traj_a, energy_a), *others = runs
+        for traj_b, energy_b in others:
+            for (p_a, m_a), (p_b, m_b) in zip(traj_a, traj_b):
+                assert all(zip_allclose(p_a, p_b))
+                assert all(zip_allclose(m_a, m_b))
+            assert np.allclose(energy_a, energy_b)
+
+    @requires_float64
+    def test_tensor_step_sizes(self, N=10, n_steps=5, seed=7):
+        "The steps within `tensor_step_sizes` follow the same trajectory as without"
+        for make_sgld in [lambda params: VerletSGLD(params, lr=0.01, num_data=N, momentum=0.9,
+                                                     temperature=1., flat=True, rng=RNGStreams(seed)),
+                          lambda params: VerletSGLD(params, lr=0.01, num_data=N, momentum=0.9,
+                                                     temperature=1., flat=True, splitting="BAOAB",
+                                                     rng=RNGStreams(seed)),
+                          lambda params: HMC(params, lr=0.01, num_data=N, flat=True)]:
+            runs = []
+            for tensor_step_sizes in [False, True]:
+                torch.manual_seed(seed)
+                model, loss = new_model_loss(N=N)
+                sgld = make_sgld(model.parameters())
+                sgld.sample_momentum()
+
+                trajectory = []
+                U0 = sgld.initial_step(loss, save_state=True).item()
+                for _ in range(n_steps):
+                    # A new step size at every step, as with a schedule
+                    sgld.param_groups[0]['lr'] *= 0.9
+                    loss()
+                    if tensor_step_sizes:
+                        with sgld.tensor_step_sizes():
+                            sgld.step()
+                        assert isinstance(sgld.param_groups[0]['bh'], float)
+                    else:
+                        sgld.step()
+                    trajectory.append(list(store_verlet_state(sgld)))
+                U1 = sgld.final_step(loss).item()
+                runs.append((trajectory, sgld.delta_energy(U0, U1)))
+            (traj_a, energy_a), (traj_b, energy_b) = runs
+            for (p_a, m_a), (p_b, m_b) in zip(traj_a, traj_b):
+                assert all(zip_allclose(p_a, p_b))
+                assert all(zip_allclose(m_a, m_b))
+            assert np.allclose(energy_a, energy_b)
+
 
 if __name__ == '__main__':
     """ There are 4 probabilistic assertions in the test in `verlet_sgld.py`.